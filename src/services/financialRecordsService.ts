@@ -97,6 +97,47 @@ const convertFromDBFormat = (dbRecord: DBFinancialRecord): FinancialRecord => {
   };
 };
 
+const TEXT_COLUMNS = ['profitability_label', 'performance_category', 'marketing_efficiency_label', 'dominant_sales_channel'];
+
+// Ratios are recomputed from the summed parts, or averaged where a part is missing
+const RATIO_COLUMNS: Record<string, [string, string]> = {
+  average_order_value: ['gross_sales', 'total_orders'],
+  marketing_efficiency_ratio: ['net_sales', 'total_marketing_spend'],
+};
+
+const combineDay = (rows: any[]): any => {
+  const day = { ...rows[0] };
+  for (const row of rows.slice(1)) {
+    for (const [key, value] of Object.entries(row)) {
+      if (TEXT_COLUMNS.includes(key)) {
+        if (value) day[key] = value;
+      } else if (typeof value === 'number' && !(key in RATIO_COLUMNS)) {
+        day[key] = (day[key] || 0) + value;
+      }
+    }
+  }
+  for (const [ratio, [numerator, denominator]] of Object.entries(RATIO_COLUMNS)) {
+    const values = rows.map(row => row[ratio]).filter(value => typeof value === 'number');
+    if (day[denominator] > 0) {
+      day[ratio] = day[numerator] / day[denominator];
+    } else if (values.length) {
+      day[ratio] = values.reduce((total, value) => total + value, 0) / values.length;
+    }
+  }
+  return day;
+};
+
+// The table holds one row per user and day, so rows sharing a date are combined
+// the way the Flask bulk loader does: amounts summed, ratios recomputed, the last label kept
+const combineDays = (dbRecords: any[]): any[] => {
+  const days = new Map<string, any[]>();
+  for (const row of dbRecords) {
+    if (!days.has(row.date)) days.set(row.date, []);
+    days.get(row.date)!.push(row);
+  }
+  return [...days.values()].map(rows => (rows.length === 1 ? rows[0] : combineDay(rows)));
+};
+
 export const saveFinancialRecords = async (records: FinancialRecord[], userId: string): Promise<void> => {
   // First, delete existing records for this user
   await supabase
@@ -104,12 +145,16 @@ export const saveFinancialRecords = async (records: FinancialRecord[], userId: s
     .delete()
     .eq('user_id', userId);
 
-  // Insert new records
-  const dbRecords = records.map(record => convertToDBFormat(record, userId));
-  
+  // Upsert new records, so a concurrent save or backend sync can't hit the unique index
+  const rows = records.map(record => convertToDBFormat(record, userId));
+  const dbRecords = combineDays(rows);
+  if (dbRecords.length < rows.length) {
+    console.warn(`Combined ${rows.length - dbRecords.length} records that share a date with another record.`);
+  }
+
   const { error } = await supabase
     .from('financial_records')
-    .insert(dbRecords);
+    .upsert(dbRecords, { onConflict: 'user_id,date' });
 
   if (error) {
     console.error('Error saving financial records:', error);
@@ -0,0 +1,115 @@
+-- One row per user and day, so bulk loads from the Flask backend can upsert on (user_id, date)
+-- Where a user already has several rows for one day, they are merged into the most
+-- recently updated one the way the loaders combine a day (amounts summed, average
+-- order value and marketing efficiency recomputed from the summed parts, the newest
+-- label kept). Every original row is kept here, with the id it was merged into.
+CREATE TABLE public.financial_records_merged_duplicates (
+  LIKE public.financial_records,
+  merged_into UUID NOT NULL
+);
+
+ALTER TABLE public.financial_records_merged_duplicates ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own merged duplicate records"
+ON public.financial_records_merged_duplicates
+FOR SELECT
+TO authenticated
+USING (auth.uid() = user_id);
+
+INSERT INTO public.financial_records_merged_duplicates
+SELECT r.*, d.keep_id
+FROM public.financial_records r
+JOIN (
+  SELECT user_id, date, (array_agg(id ORDER BY updated_at DESC, id DESC))[1] AS keep_id
+  FROM public.financial_records
+  GROUP BY user_id, date
+  HAVING count(*) > 1
+) d USING (user_id, date);
+
+UPDATE public.financial_records r SET
+  amazon_sales = g.amazon_sales,
+  flipkart_sales = g.flipkart_sales,
+  website_sales = g.website_sales,
+  offline_sales = g.offline_sales,
+  myntra_sales = g.myntra_sales,
+  meesho_sales = g.meesho_sales,
+  gross_sales = g.gross_sales,
+  total_orders = g.total_orders,
+  average_order_value = g.average_order_value,
+  returns = g.returns,
+  net_sales = g.net_sales,
+  cogs = g.cogs,
+  gross_profit = g.gross_profit,
+  platform_fees = g.platform_fees,
+  marketing_spend_digital = g.marketing_spend_digital,
+  marketing_spend_offline = g.marketing_spend_offline,
+  total_marketing_spend = g.total_marketing_spend,
+  marketing_efficiency_ratio = g.marketing_efficiency_ratio,
+  contribution_margin = g.contribution_margin,
+  fixed_cost_allocation = g.fixed_cost_allocation,
+  myntra_profit = g.myntra_profit,
+  meesho_profit = g.meesho_profit,
+  flipkart_profit = g.flipkart_profit,
+  net_profit_loss = g.net_profit_loss,
+  debt_repayment_cash_out = g.debt_repayment_cash_out,
+  net_cash_flow = g.net_cash_flow,
+  profitability_label = g.profitability_label,
+  performance_category = g.performance_category,
+  marketing_efficiency_label = g.marketing_efficiency_label,
+  dominant_sales_channel = g.dominant_sales_channel
+FROM (
+  SELECT merged_into,
+    sum(amazon_sales) AS amazon_sales,
+    sum(flipkart_sales) AS flipkart_sales,
+    sum(website_sales) AS website_sales,
+    sum(offline_sales) AS offline_sales,
+    sum(myntra_sales) AS myntra_sales,
+    sum(meesho_sales) AS meesho_sales,
+    sum(gross_sales) AS gross_sales,
+    sum(total_orders) AS total_orders,
+    coalesce(sum(gross_sales) / nullif(sum(total_orders), 0), avg(average_order_value)) AS average_order_value,
+    sum(returns) AS returns,
+    sum(net_sales) AS net_sales,
+    sum(cogs) AS cogs,
+    sum(gross_profit) AS gross_profit,
+    sum(platform_fees) AS platform_fees,
+    sum(marketing_spend_digital) AS marketing_spend_digital,
+    sum(marketing_spend_offline) AS marketing_spend_offline,
+    sum(total_marketing_spend) AS total_marketing_spend,
+    coalesce(sum(net_sales) / nullif(sum(total_marketing_spend), 0), avg(marketing_efficiency_ratio)) AS marketing_efficiency_ratio,
+    sum(contribution_margin) AS contribution_margin,
+    sum(fixed_cost_allocation) AS fixed_cost_allocation,
+    sum(myntra_profit) AS myntra_profit,
+    sum(meesho_profit) AS meesho_profit,
+    sum(flipkart_profit) AS flipkart_profit,
+    sum(net_profit_loss) AS net_profit_loss,
+    sum(debt_repayment_cash_out) AS debt_repayment_cash_out,
+    sum(net_cash_flow) AS net_cash_flow,
+    (array_agg(profitability_label ORDER BY updated_at DESC, id DESC) FILTER (WHERE profitability_label IS NOT NULL))[1] AS profitability_label,
+    (array_agg(performance_category ORDER BY updated_at DESC, id DESC) FILTER (WHERE performance_category IS NOT NULL))[1] AS performance_category,
+    (array_agg(marketing_efficiency_label ORDER BY updated_at DESC, id DESC) FILTER (WHERE marketing_efficiency_label IS NOT NULL))[1] AS marketing_efficiency_label,
+    (array_agg(dominant_sales_channel ORDER BY updated_at DESC, id DESC) FILTER (WHERE dominant_sales_channel IS NOT NULL))[1] AS dominant_sales_channel
+  FROM public.financial_records_merged_duplicates
+  GROUP BY merged_into
+) g
+WHERE r.id = g.merged_into;
+
+DELETE FROM public.financial_records r
+USING public.financial_records_merged_duplicates d
+WHERE r.id = d.id AND d.id <> d.merged_into;
+
+DO $$
+DECLARE
+  merged_rows integer;
+  merged_days integer;
+BEGIN
+  SELECT count(*), count(DISTINCT merged_into) INTO merged_rows, merged_days
+  FROM public.financial_records_merged_duplicates;
+  IF merged_rows > 0 THEN
+    RAISE NOTICE 'financial_records: merged % rows into % user-days; originals are in financial_records_merged_duplicates', merged_rows, merged_days;
+  END IF;
+END $$;
+
+-- Also serves date-ordered, keyset-paginated reads of one user's records
+CREATE UNIQUE INDEX IF NOT EXISTS financial_records_user_id_date_key
+ON public.financial_records (user_id, date);
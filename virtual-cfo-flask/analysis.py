@@ -0,0 +1,488 @@
+import os
+import shutil
+import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # Use a non-interactive backend for Matplotlib
+from matplotlib.figure import Figure
+import seaborn as sns
+
+from tracing import span, traced
+
+# Pre-aggregated rollup cubes (period x dimension sums/counts/min/max)
+try:
+    from rollups import category_totals, period_series
+except Exception:
+    category_totals = None
+    period_series = None
+
+# Out-of-core (chunked) engine for datasets larger than RAM
+try:
+    from outofcore import (use_out_of_core, scan_schema, group_sum_chunked, pearson_corr_chunked,
+                           quantiles_chunked, sample_rows, filter_rows)
+except Exception:
+    use_out_of_core = None
+
+# Block-wise top-k and FFT lagged correlations for wide datasets
+from correlation import top_k_pairs, top_k_from_matrix, lead_lag
+from ledger import forecast_from_tail
+
+STATIC_DIR = 'static'
+os.makedirs(STATIC_DIR, exist_ok=True)
+
+# Handlers draw on their own Figure objects rather than pyplot's global
+# "current figure", so request and background-job threads can plot at once.
+
+@traced('find_csv_columns')
+def find_csv_columns(csv_path):
+    """Detect a likely date column and a primary numeric value column.
+
+    Heuristics:
+    - Prefer columns whose name contains 'date'/'time' and whose parse success rate > 80%.
+    - Otherwise, evaluate all object-like columns and pick the one with the highest parse success.
+    - Choose a numeric value column that is not an id/year-like field.
+    """
+    try:
+        df_sample = pd.read_csv(csv_path, nrows=500)
+        date_candidates = list(df_sample.columns)
+
+        def parse_rate(series):
+            parsed = pd.to_datetime(series, errors='coerce', utc=False, dayfirst=False, infer_datetime_format=True)
+            return parsed.notna().mean()
+
+        # Score columns by name hint and parse success
+        best_col = None
+        best_score = 0.0
+        for col in date_candidates:
+            # Only attempt on non-numeric columns to avoid mis-parsing numeric values as dates
+            if pd.api.types.is_numeric_dtype(df_sample[col]):
+                continue
+            score = parse_rate(df_sample[col])
+            name_bonus = 0.3 if any(k in col.lower() for k in ['date', 'time', 'day', 'month']) else 0.0
+            total = score + name_bonus
+            if total > best_score:
+                best_score = total
+                best_col = col
+
+        date_col = best_col if best_col and best_score >= 0.6 else None
+
+        numeric_cols = [c for c in df_sample.select_dtypes(include=[np.number]).columns
+                        if 'id' not in c.lower() and 'year' not in c.lower() and 'month' not in c.lower()]
+        value_col = numeric_cols[-1] if numeric_cols else None
+
+        return date_col, value_col
+    except Exception as e:
+        print(f"Error analyzing CSV columns: {e}")
+        return None, None
+
+@traced('detect_anomalies')
+def detect_anomalies(csv_path, date_col, value_col, bounds=None, df=None, out_dir=None):
+    """Detect anomalies in a numeric column using the IQR method and plot them.
+
+    Precomputed (lower, upper) bounds, e.g. from the ledger's running statistics,
+    skip the quantile computation. An already-loaded df skips reading the CSV.
+    """
+    if not value_col:
+        return "Could not identify a primary numeric column for anomaly detection.", None
+    
+    out_of_core = df is None and use_out_of_core is not None and use_out_of_core(csv_path)
+    if out_of_core:
+        # Stream the file: exact quantiles in bounded memory, plot a strided sample
+        columns = pd.read_csv(csv_path, nrows=0).columns
+        if value_col not in columns:
+            return f"Column '{value_col}' not found.", None
+        usecols = [c for c in (date_col, value_col) if c and c in columns]
+        if bounds is None:
+            Q1, Q3 = quantiles_chunked(csv_path, value_col, [0.25, 0.75])
+            IQR = Q3 - Q1
+            bounds = (Q1 - 1.5 * IQR, Q3 + 1.5 * IQR)
+        lower_bound, upper_bound = bounds
+        anomalies = filter_rows(csv_path, usecols, value_col, lower_bound, upper_bound)
+        df = sample_rows(csv_path, usecols)
+    else:
+        if df is None:
+            with span('csv_parse'):
+                df = pd.read_csv(csv_path)
+        if value_col not in df.columns:
+            return f"Column '{value_col}' not found.", None
+
+        if bounds is not None:
+            lower_bound, upper_bound = bounds
+        else:
+            Q1 = df[value_col].quantile(0.25)
+            Q3 = df[value_col].quantile(0.75)
+            IQR = Q3 - Q1
+            lower_bound = Q1 - 1.5 * IQR
+            upper_bound = Q3 + 1.5 * IQR
+
+        anomalies = df[(df[value_col] < lower_bound) | (df[value_col] > upper_bound)]
+
+    if anomalies.empty:
+        return "No significant anomalies detected in the data.", None
+    
+    fig = Figure(figsize=(12, 6))
+    
+    ax = fig.subplots()
+    sns.lineplot(data=df, x=date_col if date_col and date_col in df.columns else df.index, y=value_col, label='Data', errorbar=None, ax=ax)
+    sns.scatterplot(data=anomalies, x=date_col if date_col and date_col in df.columns else anomalies.index, y=value_col, color='red', s=100, label='Anomalies', ax=ax)
+    ax.set_title(f'Anomaly Detection for {value_col}')
+    ax.set_xlabel(date_col if date_col else 'Index')
+    ax.set_ylabel(value_col)
+    ax.legend()
+    ax.grid(True)
+    plot_path = os.path.join(out_dir or STATIC_DIR, 'anomaly_plot.png')
+    with span('savefig'):
+        fig.savefig(plot_path)
+
+    summary = f"Detected {len(anomalies)} potential anomalies in '{value_col}'. These are values significantly lower than {lower_bound:.2f} or higher than {upper_bound:.2f}."
+    return summary, f'/{plot_path}'
+
+@traced('predict_timeseries')
+def predict_timeseries(csv_path, date_col, value_col, prediction_length=12, df=None, out_dir=None, history=None):
+    """Predict future values using a lightweight linear trend over recent data and generate a plot.
+
+    Also returns a short natural-language explanation derived from the latest
+    historical values and forecast trajectory so the frontend can describe the
+    chart meaningfully. When df holds only the recent rows, history (all rows'
+    dates and values) is what the chart shows as historical data.
+    """
+    if not date_col or not value_col:
+        return "Could not identify suitable date and value columns for forecasting.", None
+        
+    # Read CSV and parse only the detected date column
+    if df is None:
+        with span('csv_parse'):
+            df = pd.read_csv(csv_path)
+    def by_date(frame):
+        frame = frame.copy()
+        frame[date_col] = pd.to_datetime(frame[date_col], errors='coerce')
+        return frame.dropna(subset=[date_col]).sort_values(by=date_col).reset_index(drop=True)
+
+    use_index = not (date_col in df.columns and not by_date(df[[date_col]]).empty)
+    if not use_index:
+        df = by_date(df)
+    shown = df
+    if history is not None:
+        shown = history if use_index else by_date(history)
+    
+    # Same linear-trend fit the ledger runs on its stored tail
+    forecast = forecast_from_tail(df[[value_col] if use_index else [date_col, value_col]],
+                                  None if use_index else date_col, value_col, prediction_length)
+    if forecast is None:
+        return "Not enough data points to build a forecast.", None
+    mean_prediction = forecast['values']
+    future_dates = np.array(forecast['periods']) if use_index else pd.to_datetime(forecast['periods'])
+
+    fig = Figure(figsize=(12, 6))
+
+    ax = fig.subplots()
+    if not use_index:
+        ax.plot(shown[date_col], shown[value_col], label='Historical Data')
+        ax.plot(future_dates, mean_prediction, label='Forecast', linestyle='--')
+        ax.set_xlabel(date_col)
+    else:
+        # Index-based periods continue the fitted rows; history ends where they do
+        ax.plot(np.arange(len(df) - len(shown), len(df)), shown[value_col], label='Historical Data')
+        ax.plot(future_dates, mean_prediction, label='Forecast', linestyle='--')
+        ax.set_xlabel('Index')
+    ax.set_title(f'Forecast for {value_col}')
+    ax.set_ylabel(value_col)
+    ax.legend()
+    ax.grid(True)
+    plot_path = os.path.join(out_dir or STATIC_DIR, 'forecast_plot.png')
+    with span('savefig'):
+        fig.savefig(plot_path)
+    
+    # Build a concise, data-grounded explanation
+    recent_window = min(len(df), max(6, prediction_length))
+    recent_series = df[value_col].tail(recent_window)
+    recent_change = (recent_series.iloc[-1] - recent_series.iloc[0]) if recent_window > 1 else 0
+    recent_pct = (recent_change / recent_series.iloc[0] * 100.0) if recent_window > 1 and recent_series.iloc[0] != 0 else 0
+    forecast_change = mean_prediction[-1] - (recent_series.iloc[-1] if len(recent_series) else 0)
+    forecast_dir = "increase" if forecast_change > 0 else ("decrease" if forecast_change < 0 else "remain roughly flat")
+
+    summary = (
+        f"Forecast generated for the next {prediction_length} periods. "
+        f"Recent trend: {recent_pct:.1f}% change over the last {recent_window} observations. "
+        f"The projection suggests a {forecast_dir} toward the horizon. See the chart for details."
+    )
+    return summary, f'/{plot_path}'
+
+@traced('plot_rate_of_change')
+def plot_rate_of_change(csv_path, date_col, value_col, two_month_window=True, cube=None, df=None, out_dir=None,
+                        export_copy=None):
+    """Compute daily percentage rate of change, plot it, optionally aggregate by 2-month windows,
+    save to static and also export a copy to the project root as 'amazon_sales_roc.png'. Additionally,
+    forecast the rate-of-change series and save a separate forecast plot.
+
+    When a rollup cube is given, the daily series is read from it instead of the CSV.
+    The export copy is written when export_copy is true, by default only without an out_dir.
+    """
+    if not value_col:
+        return "Could not identify a numeric column for rate-of-change.", None, None
+
+    s = period_series(cube, value_col, 'daily') if cube is not None and date_col else None
+    if s is None:
+        if df is None:
+            with span('csv_parse'):
+                df = pd.read_csv(csv_path)
+        if date_col and date_col in df.columns:
+            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+            df = df.dropna(subset=[date_col])
+            df = df.sort_values(by=date_col)
+            x = df[date_col]
+        else:
+            df = df.reset_index().rename(columns={'index': 'idx'})
+            x = df['idx']
+
+        y = pd.to_numeric(df[value_col], errors='coerce')
+        s = pd.Series(y.values, index=x)
+
+    # If index is datetime-like, ensure daily frequency for ROC
+    if isinstance(s.index, pd.DatetimeIndex):
+        s = s.asfreq('D')
+        s = s.interpolate(limit_direction='both')
+    roc = s.pct_change().mul(100.0)
+
+    fig = Figure(figsize=(12, 6))
+
+    ax = fig.subplots()
+    ax.plot(roc.index, roc.values, marker='o', linestyle='-', linewidth=1, markersize=2)
+    ax.set_title(f'Daily Rate of Change in {value_col} (%)')
+    ax.set_xlabel('Date' if isinstance(roc.index, pd.DatetimeIndex) else 'Index')
+    ax.set_ylabel('Percentage Change (%)')
+    ax.grid(True, alpha=0.3)
+
+    # Optional two-month window smoothing/aggregation
+    if two_month_window and isinstance(roc.index, pd.DatetimeIndex):
+        two_m = roc.resample('2MS').mean()  # mean at each 2-month start
+        ax.plot(two_m.index, two_m.values, color='orange', linewidth=2, label='2-month avg')
+        ax.legend()
+
+    roc_path_static = os.path.join(out_dir or STATIC_DIR, 'roc_plot.png')
+    with span('savefig'):
+        fig.savefig(roc_path_static)
+
+    # Save an additional export copy in project root as requested
+    if out_dir is None if export_copy is None else export_copy:
+        export_path = os.path.join(os.getcwd(), 'amazon_sales_roc.png')
+        try:
+            shutil.copyfile(roc_path_static, export_path)
+        except Exception as _:
+            pass
+
+    # Forecast the ROC series using the same linear-trend method
+    if isinstance(roc.index, pd.DatetimeIndex):
+        clean = roc.dropna()
+        if len(clean) >= 5:
+            y_recent = clean.values[-min(60, len(clean)) :]
+            x_recent = np.arange(len(y_recent), dtype=float)
+            try:
+                slope, intercept = np.polyfit(x_recent, y_recent, 1)
+            except Exception:
+                slope, intercept = 0.0, float(y_recent[-1])
+            horizon = 14
+            x_future = np.arange(len(y_recent), len(y_recent) + horizon, dtype=float)
+            y_future = slope * x_future + intercept
+            last_date = clean.index[-1]
+            future_idx = pd.date_range(last_date, periods=horizon + 1, freq='D')[1:]
+
+            fig = Figure(figsize=(12, 6))
+
+            ax = fig.subplots()
+            ax.plot(clean.index, clean.values, label='ROC (historical)')
+            ax.plot(future_idx, y_future, linestyle='--', label='ROC forecast')
+            ax.set_title('Rate-of-Change Forecast (%)')
+            ax.set_xlabel('Date')
+            ax.set_ylabel('Percentage Change (%)')
+            ax.legend()
+            ax.grid(True, alpha=0.3)
+            roc_forecast_path = os.path.join(out_dir or STATIC_DIR, 'roc_forecast_plot.png')
+            with span('savefig'):
+                fig.savefig(roc_forecast_path)
+        else:
+            roc_forecast_path = None
+    else:
+        roc_forecast_path = None
+
+    summary = (
+        "Computed daily percentage rate of change and generated the plot. "
+        "A 2-month average line is included for smoother trends. An export copy was saved as 'amazon_sales_roc.png'."
+    )
+    return summary, f'/{roc_path_static}', (f'/{roc_forecast_path}' if roc_forecast_path else None)
+
+@traced('plot_linear_relationships')
+def plot_linear_relationships(csv_path, date_col, df=None, out_dir=None, method='pearson'):
+    """Find strong linear relations between numeric columns and plot them in subplots.
+    We compute Pearson (or Spearman rank) correlations and plot the top correlated pairs side-by-side.
+    """
+    schema = None
+    if df is None and use_out_of_core is not None and use_out_of_core(csv_path):
+        schema = scan_schema(csv_path)
+        numeric_cols = schema['numeric_cols']
+    else:
+        if df is None:
+            with span('csv_parse'):
+                df = pd.read_csv(csv_path)
+        numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    if len(numeric_cols) < 2:
+        return "Not enough numeric columns to assess linear relations.", None
+
+    note = ""
+    if df is None:
+        # Ranks need whole columns, so the chunked path is Pearson only
+        if method == 'spearman':
+            method, note = 'pearson', " Spearman needs the full columns in memory, so Pearson was used for this large file."
+        top_pairs = top_k_from_matrix(pearson_corr_chunked(csv_path, numeric_cols), 6)
+    else:
+        top_pairs = top_k_pairs(df[numeric_cols], 6, method=method)
+    if not top_pairs:
+        return "No clear linear relations found between numeric columns.", None
+    if df is None:
+        plotted = sorted({c for (a, b), _ in top_pairs for c in (a, b)}, key=numeric_cols.index)
+        df = sample_rows(csv_path, plotted, row_count=schema['row_count'])
+
+    symbol = 'rho' if method == 'spearman' else 'r'
+    n = len(top_pairs)
+    rows = int(np.ceil(n / 2))
+    fig = Figure(figsize=(12, 4*rows))
+    axes = fig.subplots(rows, 2)
+    axes = np.array(axes).reshape(-1)
+    for idx, ((a, b), r) in enumerate(top_pairs):
+        ax = axes[idx]
+        ax.plot(df[a], label=a)
+        ax.plot(df[b], label=b)
+        ax.set_title(f"{a} vs {b} ({symbol}={r:.2f})")
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+    for j in range(idx+1, len(axes)):
+        axes[j].axis('off')
+    fig.tight_layout()
+    out_path = os.path.join(out_dir or STATIC_DIR, 'linear_relations.png')
+    with span('savefig'):
+        fig.savefig(out_path)
+    kind = "Spearman rank" if method == 'spearman' else "linear"
+    return f"Plotted top {kind} relations across numeric columns.{note}", f'/{out_path}'
+
+def _period_frame(csv_path, date_col, columns, cube=None, df=None):
+    """Daily totals of the given columns on a complete daily index (NaN for days
+    without rows); rows in file order when there is no date column."""
+    daily = cube['tables'].get(('daily', None)) if cube is not None and date_col else None
+    if daily is not None and all(c in cube['meta']['numeric_cols'] for c in columns):
+        frame = pd.DataFrame({c: daily[(c, 'sum')].where(daily[(c, 'count')] > 0) for c in columns})
+        frame.index = frame.index.to_timestamp()
+        return frame.asfreq('D'), 'day'
+    if df is None:
+        with span('csv_parse'):
+            df = pd.read_csv(csv_path, usecols=[c for c in [date_col, *columns] if c])
+    values = df[columns].apply(pd.to_numeric, errors='coerce')
+    if not date_col or date_col not in df.columns:
+        return values.reset_index(drop=True), 'row'
+    dates = pd.to_datetime(df[date_col], errors='coerce').dt.normalize()
+    frame = values[dates.notna()].groupby(dates[dates.notna()]).sum(min_count=1)
+    return frame.asfreq('D'), 'day'
+
+@traced('plot_lead_lag')
+def plot_lead_lag(csv_path, date_col, drivers, targets, cube=None, df=None, max_lag=30, out_dir=None):
+    """Does one metric move before another? Correlates each driver with each target
+    shifted by -max_lag..max_lag periods and reports the strongest lag."""
+    frame, unit = _period_frame(csv_path, date_col, list(dict.fromkeys(drivers + targets)), cube=cube, df=df)
+    if len(frame) < 3 * max_lag:
+        max_lag = max(1, len(frame) // 3)
+    table, curves = lead_lag(frame, drivers, targets, max_lag=max_lag)
+    table = table.dropna(subset=['r'])
+    if table.empty:
+        return "Not enough overlapping data to measure a lead or lag between these metrics.", None
+
+    def describe(row):
+        lag, r = int(row['best_lag']), row['r']
+        if lag > 0:
+            return f"{row['driver']} leads {row['target']} by {lag} {unit}(s): r={r:.2f} at that lag vs {row['r_same_period']:.2f} same {unit}"
+        if lag < 0:
+            return f"{row['driver']} follows {row['target']} by {-lag} {unit}(s): r={r:.2f} at that lag vs {row['r_same_period']:.2f} same {unit}"
+        return f"{row['driver']} and {row['target']} move together in the same {unit} (r={r:.2f})"
+
+    best = table.iloc[0]
+    if abs(best['r']) < 0.2:
+        headline = (f"No meaningful lead or lag within ±{max_lag} {unit}s; the strongest relation is weak "
+                    f"({best['driver']} vs {best['target']}, r={best['r']:.2f} at lag {int(best['best_lag'])}).")
+    else:
+        headline = describe(best) + "."
+    lines = [headline]
+    if len(table) > 1:
+        lines.append("Other pairs:")
+        lines += [f"- {describe(row)}" for _, row in table.iloc[1:5].iterrows()]
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    for _, row in table.head(3).iterrows():
+        ax.plot(lags, curves[(row['driver'], row['target'])], marker='o', markersize=2,
+                 label=f"{row['driver']} → {row['target']}")
+        ax.scatter([row['best_lag']], [row['r']], s=60, zorder=3)
+    ax.axvline(0, color='gray', linewidth=1)
+    ax.axhline(0, color='gray', linewidth=1)
+    ax.set_title(f"Lagged correlation (positive lag: driver moves first, in {unit}s)")
+    ax.set_xlabel(f"Lag ({unit}s)")
+    ax.set_ylabel('Correlation (r)')
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+    out_path = os.path.join(out_dir or STATIC_DIR, 'lead_lag.png')
+    with span('savefig'):
+        fig.savefig(out_path)
+    return "\n".join(lines), f'/{out_path}'
+
+@traced('plot_top_sales_channels')
+def plot_top_sales_channels(csv_path, date_col, value_col, cube=None, df=None, out_dir=None):
+    """Detect a categorical 'channel' column and plot top 5 by total value_col.
+
+    With a rollup cube the column choice and totals come from the cube, so the CSV
+    is only read when the chosen column is not one of the cube's dimensions.
+    """
+    out_of_core = df is None and use_out_of_core is not None and use_out_of_core(csv_path)
+    if cube is not None or out_of_core:
+        meta = cube['meta'] if cube is not None else scan_schema(csv_path)
+        columns = meta['columns']
+        categorical_cols = [c for c in meta['categorical_cols'] if c != date_col]
+        cardinality = meta['cardinality']
+    else:
+        if df is None:
+            with span('csv_parse'):
+                df = pd.read_csv(csv_path)
+        columns = df.columns
+        categorical_cols = [c for c in df.columns if c != date_col and not pd.api.types.is_numeric_dtype(df[c])]
+        cardinality = None
+    if not value_col or value_col not in columns:
+        return "Could not identify a numeric value column for sales.", None
+    # Find a categorical column with reasonable cardinality
+    best_cat = None
+    best_card = None
+    for c in categorical_cols:
+        unique = cardinality[c] if cardinality is not None else df[c].nunique(dropna=True)
+        if 2 <= unique <= 20 and (best_card is None or unique < best_card):
+            best_cat, best_card = c, unique
+        if 'channel' in c.lower():
+            best_cat = c
+            break
+    if not best_cat:
+        return "No suitable categorical column found for channels.", None
+    totals = category_totals(cube, best_cat, value_col) if cube is not None else None
+    if totals is None and out_of_core:
+        totals = group_sum_chunked(csv_path, best_cat, value_col)
+    elif totals is None:
+        if df is None:
+            with span('csv_parse'):
+                df = pd.read_csv(csv_path)
+        totals = df.groupby(best_cat)[value_col].sum()
+    grouped = totals.sort_values(ascending=False).head(5)
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    sns.barplot(x=grouped.values, y=grouped.index, orient='h', ax=ax)
+    ax.set_title('Top 5 Sales Channels')
+    ax.set_xlabel(value_col)
+    ax.set_ylabel(best_cat)
+    ax.grid(True, axis='x', alpha=0.2)
+    out_path = os.path.join(out_dir or STATIC_DIR, 'top_channels.png')
+    with span('savefig'):
+        fig.savefig(out_path)
+    return f"Top 5 '{best_cat}' by total {value_col}.", f'/{out_path}'
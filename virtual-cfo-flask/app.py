@@ -1,15 +1,19 @@
 import os
 import sys
 import shutil
+import uuid
+import hmac
+import threading
 import pandas as pd
 import numpy as np
 import matplotlib
 matplotlib.use('Agg') # Use a non-interactive backend for Matplotlib
-import matplotlib.pyplot as plt
-import seaborn as sns
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+import time
+from urllib.parse import quote
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, g, Response
 from flask_cors import CORS
+from contextlib import ExitStack
 
 # LangChain and AI Imports
 import google.generativeai as genai
@@ -29,20 +33,125 @@ try:
 except Exception:
     generate_chart = None
 
+# Chart data (JSON/Arrow) for client-side rendering
+try:
+    from chart_data import (parse_params, chart_data_etag, build_chart_data, encode, ArrowUnavailable,
+                            cached as cached_chart_data)
+except Exception:
+    build_chart_data = None
+
+# Receivables aging, DSO and collections worklist
+try:
+    from receivables import receivables_report, summarize as summarize_receivables, SignInRequired
+except Exception:
+    receivables_report = None
+
+# Cached, parallel text extraction for knowledge-base PDFs
+try:
+    from kb_cache import load_documents as load_kb_documents, split_documents as split_kb_documents, \
+        warm_cache_subprocess as warm_kb_cache
+except Exception:
+    load_kb_documents = None
+
+# Period-over-period P&L bridges (volume / mix / price / cost drivers)
+try:
+    from bridge import pnl_bridges, parse_bridge_request, summarize as summarize_bridge, BRIDGE_PATTERN
+    from charts import plot_bridge
+except Exception:
+    pnl_bridges = None
+
+# Caller identity from Supabase access tokens, for routes that bypass row-level security
+from supabase_auth import bearer_token, verify_token, AuthError
+
+# Bulk sync with the Supabase financial_records table
+try:
+    from records_store import load_csv as load_records, fetch_page as fetch_records, export_csv as export_records
+except Exception:
+    load_records = None
+
+# Dataset analysis handlers (forecast, ROC, anomalies, correlations, lead/lag, channels)
+from analysis import (find_csv_columns, detect_anomalies, predict_timeseries, plot_rate_of_change,
+                      plot_linear_relationships, plot_lead_lag, plot_top_sales_channels)
+from correlation import LEAD_LAG_WORDS, parse_lead_lag
+
+# Async jobs key their dedupe on the dataset fingerprint whether or not rollups
+# are in use, so it is imported unguarded (rollups needs only pandas and numpy)
+from rollups import dataset_fingerprint
+
+# Pre-aggregated rollup cubes (period x dimension sums/counts/min/max)
+try:
+    from rollups import get_rollup
+except Exception:
+    get_rollup = None
+
+# Incremental append support for growing ledgers
+try:
+    from ledger import ingest, append_rows, anomaly_bounds, forecast_tail, forecast_history
+except Exception:
+    ingest = None
+    append_rows = None
+    anomaly_bounds = None
+    forecast_tail = None
+
+# Batch report packs across many datasets
+try:
+    from batch import run_batch_subprocess, REPORT_TYPES
+except Exception:
+    run_batch_subprocess = None
+
+# Background job queue (SQLite job table + in-process worker pool)
+try:
+    from jobs import init_jobs, enqueue, get_job, register
+except Exception:
+    enqueue = None
+    get_job = None
+
+# Per-stage tracing, LLM token counts and Prometheus metrics
+from tracing import (span, start_trace, end_trace, current_trace, observe, timing_header, llm_config,
+                     render_metrics, TIMING_HEADER_ALWAYS)
+
+# LLM gateway: rate limiting, priority lanes, retries, coalescing, tenant budgets
+from llm_gateway import GatewayChatModel, GatewayError, BudgetExceeded, llm_context, tenant_usage, tenant_for_key
+
+# Precomputed dataset summaries for the CSV agent prompt
+try:
+    from context_pack import get_context_pack
+except Exception:
+    get_context_pack = None
+AGENT_CONTEXT_PACK = os.getenv("AGENT_CONTEXT_PACK", "1") == "1"
+
+# Pre-forked, resource-limited worker processes for the agent's generated code
+try:
+    from sandbox import pool as sandbox_pool, sandboxed_csv_agent, in_process_csv_agent, AVAILABLE as SANDBOX_AVAILABLE
+except Exception:
+    sandbox_pool = None
+    in_process_csv_agent = None
+    SANDBOX_AVAILABLE = False
+AGENT_SANDBOX = os.getenv("AGENT_SANDBOX", "1") == "1" and SANDBOX_AVAILABLE
+
+# On-demand profiling (X-Profile header or sampled traffic)
+from profiling import requested_modes, start_profile, stop_profile, list_profiles, authorized, PROFILE_DIR
+
 # Load environment variables from .env file
 load_dotenv()
 
+# MODEL_BACKEND=stub swaps Gemini and the HuggingFace embeddings for deterministic
+# local stand-ins (no API key or model download); used by loadtest.py
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+
 # Configure the API key globally
-try:
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-    print("SUCCESS: Google API key configured successfully.")
-except Exception as e:
-    print(f"ERROR: Failed to configure Google API key. Please check your .env file. Error: {e}")
-    sys.exit(1)
+if MODEL_BACKEND != "stub":
+    try:
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        print("SUCCESS: Google API key configured successfully.")
+    except Exception as e:
+        print(f"ERROR: Failed to configure Google API key. Please check your .env file. Error: {e}")
+        sys.exit(1)
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "http://localhost:8080", "supports_credentials": True}})
+CORS(app, resources={r"/*": {"origins": "http://localhost:8080", "supports_credentials": True}},
+     expose_headers=["X-Timing", "X-Profile-Id"])
 app.secret_key = os.environ.get("SECRET_KEY", os.urandom(24))
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['STATIC_FOLDER'] = 'static'
@@ -51,9 +160,16 @@ os.makedirs(app.config['STATIC_FOLDER'], exist_ok=True)
 
 # --- Global Variables & Pre-loading ---
 KNOWLEDGE_BASE_PATH = "knowledge_base"
-FAISS_INDEX_PATH = "faiss_index"
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "faiss_index")
+# POST /kb/rebuild needs a matching X-Admin-Token; without one set it is refused
+KB_ADMIN_TOKEN = os.getenv("KB_ADMIN_TOKEN")
 
-llm = ChatGoogleGenerativeAI(
+if MODEL_BACKEND == "stub":
+    from stub_models import StubChatModel, StubEmbeddings
+    print("INFO: MODEL_BACKEND=stub, using local stand-ins for Gemini and embeddings.")
+
+# Retries are owned by the gateway, so the client itself makes a single attempt
+upstream_llm = StubChatModel() if MODEL_BACKEND == "stub" else ChatGoogleGenerativeAI(
     model="gemini-pro-latest",
     temperature=0.1,
     safety_settings={
@@ -62,40 +178,104 @@ llm = ChatGoogleGenerativeAI(
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
     },
+    max_retries=1,
 )
+llm = GatewayChatModel(inner=upstream_llm)
 
 # Initialize embeddings with offline mode and error handling
-try:
-    # Try to load embeddings with offline mode first
-    embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'},
-        encode_kwargs={'normalize_embeddings': True}
-    )
-    print("SUCCESS: HuggingFace embeddings loaded successfully.")
-except Exception as e:
-    print(f"WARNING: Failed to load HuggingFace embeddings: {e}")
-    print("INFO: Attempting to use offline mode...")
+if MODEL_BACKEND == "stub":
+    embeddings = StubEmbeddings()
+else:
     try:
-        # Try offline mode
+        # Try to load embeddings with offline mode first
         embeddings = HuggingFaceEmbeddings(
             model_name="all-MiniLM-L6-v2",
             model_kwargs={'device': 'cpu'},
             encode_kwargs={'normalize_embeddings': True}
         )
-        print("SUCCESS: HuggingFace embeddings loaded in offline mode.")
-    except Exception as e2:
-        print(f"ERROR: Failed to load embeddings even in offline mode: {e2}")
-        print("INFO: Application will run without knowledge base functionality.")
-        embeddings = None
+        print("SUCCESS: HuggingFace embeddings loaded successfully.")
+    except Exception as e:
+        print(f"WARNING: Failed to load HuggingFace embeddings: {e}")
+        print("INFO: Attempting to use offline mode...")
+        try:
+            # Try offline mode
+            embeddings = HuggingFaceEmbeddings(
+                model_name="all-MiniLM-L6-v2",
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'normalize_embeddings': True}
+            )
+            print("SUCCESS: HuggingFace embeddings loaded in offline mode.")
+        except Exception as e2:
+            print(f"ERROR: Failed to load embeddings even in offline mode: {e2}")
+            print("INFO: Application will run without knowledge base functionality.")
+            embeddings = None
 
 knowledge_chain = None
 
 # --- Knowledge Base Pre-processing Function ---
-def initialize_knowledge_base():
+def _build_index(chunk_size=None, chunk_overlap=None):
+    """
+    Indexes the knowledge_base documents into a temporary directory and swaps
+    it in for FAISS_INDEX_PATH, so the current index stays in place until the
+    new one is complete. Returns the vector store, or None without documents.
+    """
+    os.makedirs(KNOWLEDGE_BASE_PATH, exist_ok=True)
+    if load_kb_documents is not None:
+        # New PDFs are parsed by a separate process; this one only reads the cache
+        status = warm_kb_cache(KNOWLEDGE_BASE_PATH)
+        if status != 0:
+            print(f"WARNING: Knowledge-base extraction exited with status {status}; parsing what's left in-process.")
+        documents = load_kb_documents(KNOWLEDGE_BASE_PATH, workers=1)
+    else:
+        pdf_loader = DirectoryLoader(KNOWLEDGE_BASE_PATH, glob="**/*.pdf", loader_cls=PyPDFLoader, recursive=True)
+        txt_loader = DirectoryLoader(KNOWLEDGE_BASE_PATH, glob="**/*.txt", loader_cls=TextLoader, recursive=True)
+        documents = pdf_loader.load() + txt_loader.load()
+    if not documents:
+        return None
+
+    if load_kb_documents is not None:
+        texts = split_kb_documents(documents, chunk_size, chunk_overlap)
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size or 1000,
+                                                       chunk_overlap=150 if chunk_overlap is None else chunk_overlap)
+        texts = text_splitter.split_documents(documents)
+    print(f"INFO: Indexing {len(texts)} chunks.")
+    vector_store = FAISS.from_documents(texts, embeddings)
+
+    build_path = f"{FAISS_INDEX_PATH}.tmp-{uuid.uuid4().hex}"
+    old_path = None
+    try:
+        vector_store.save_local(build_path)
+        # os.replace won't move a directory over a non-empty one, so the old index steps aside first
+        if os.path.exists(FAISS_INDEX_PATH):
+            old_path = f"{FAISS_INDEX_PATH}.old-{uuid.uuid4().hex}"
+            os.replace(FAISS_INDEX_PATH, old_path)
+        os.replace(build_path, FAISS_INDEX_PATH)
+    except Exception:
+        if old_path and not os.path.exists(FAISS_INDEX_PATH):
+            os.replace(old_path, FAISS_INDEX_PATH)
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise
+    if old_path:
+        shutil.rmtree(old_path, ignore_errors=True)
+    print(f"SUCCESS: Index created and saved to '{FAISS_INDEX_PATH}'.")
+    return vector_store
+
+def _retrieval_chain(vector_store):
+    retriever = vector_store.as_retriever(search_kwargs={'k': 3})
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=retriever,
+        return_source_documents=False
+    )
+
+def initialize_knowledge_base(chunk_size=None, chunk_overlap=None, rebuild=False):
     """
     Loads documents from the knowledge_base, creates a vector store,
-    and saves it to disk if it doesn't already exist.
+    and saves it to disk if it doesn't already exist (or if rebuild is set).
+    PDF text comes from the kb_cache extraction cache, so only new or changed
+    PDFs are parsed.
     """
     global knowledge_chain
     
@@ -105,7 +285,7 @@ def initialize_knowledge_base():
         knowledge_chain = "Knowledge base unavailable - embeddings not loaded."
         return
     
-    if os.path.exists(FAISS_INDEX_PATH):
+    if os.path.exists(FAISS_INDEX_PATH) and not rebuild:
         print("SUCCESS: Loading existing FAISS index for knowledge base.")
         try:
             vector_store = FAISS.load_local(FAISS_INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
@@ -116,117 +296,25 @@ def initialize_knowledge_base():
             return
     else:
         print("INFO: Creating new FAISS index for knowledge base...")
-        os.makedirs(KNOWLEDGE_BASE_PATH, exist_ok=True)
-        pdf_loader = DirectoryLoader(KNOWLEDGE_BASE_PATH, glob="**/*.pdf", loader_cls=PyPDFLoader, recursive=True)
-        txt_loader = DirectoryLoader(KNOWLEDGE_BASE_PATH, glob="**/*.txt", loader_cls=TextLoader, recursive=True)
-        documents = pdf_loader.load() + txt_loader.load()
-
-        if not documents:
-            print("WARNING: No documents found in the knowledge_base folder. Strategic advice will be limited.")
-            knowledge_chain = "No knowledge base loaded."
-            return
-
         try:
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-            texts = text_splitter.split_documents(documents)
-            vector_store = FAISS.from_documents(texts, embeddings)
-            vector_store.save_local(FAISS_INDEX_PATH)
-            print(f"SUCCESS: Index created and saved to '{FAISS_INDEX_PATH}'.")
+            vector_store = _build_index(chunk_size, chunk_overlap)
         except Exception as e:
             print(f"ERROR: Failed to create FAISS index: {e}")
             knowledge_chain = "Knowledge base unavailable - index creation failed."
             return
+        if vector_store is None:
+            print("WARNING: No documents found in the knowledge_base folder. Strategic advice will be limited.")
+            knowledge_chain = "No knowledge base loaded."
+            return
 
     try:
-        retriever = vector_store.as_retriever(search_kwargs={'k': 3})
-        knowledge_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=False
-        )
+        knowledge_chain = _retrieval_chain(vector_store)
         print("SUCCESS: Virtual CFO Knowledge Base is ready.")
     except Exception as e:
         print(f"ERROR: Failed to create knowledge chain: {e}")
         knowledge_chain = "Knowledge base unavailable - chain creation failed."
 
 # --- Helper Functions for AI Models ---
-def find_csv_columns(csv_path):
-    """Detect a likely date column and a primary numeric value column.
-
-    Heuristics:
-    - Prefer columns whose name contains 'date'/'time' and whose parse success rate > 80%.
-    - Otherwise, evaluate all object-like columns and pick the one with the highest parse success.
-    - Choose a numeric value column that is not an id/year-like field.
-    """
-    try:
-        df_sample = pd.read_csv(csv_path, nrows=500)
-        date_candidates = list(df_sample.columns)
-
-        def parse_rate(series):
-            parsed = pd.to_datetime(series, errors='coerce', utc=False, dayfirst=False, infer_datetime_format=True)
-            return parsed.notna().mean()
-
-        # Score columns by name hint and parse success
-        best_col = None
-        best_score = 0.0
-        for col in date_candidates:
-            # Only attempt on non-numeric columns to avoid mis-parsing numeric values as dates
-            if pd.api.types.is_numeric_dtype(df_sample[col]):
-                continue
-            score = parse_rate(df_sample[col])
-            name_bonus = 0.3 if any(k in col.lower() for k in ['date', 'time', 'day', 'month']) else 0.0
-            total = score + name_bonus
-            if total > best_score:
-                best_score = total
-                best_col = col
-
-        date_col = best_col if best_col and best_score >= 0.6 else None
-
-        numeric_cols = [c for c in df_sample.select_dtypes(include=[np.number]).columns
-                        if 'id' not in c.lower() and 'year' not in c.lower() and 'month' not in c.lower()]
-        value_col = numeric_cols[-1] if numeric_cols else None
-
-        return date_col, value_col
-    except Exception as e:
-        print(f"Error analyzing CSV columns: {e}")
-        return None, None
-
-def detect_anomalies(csv_path, date_col, value_col):
-    """Detect anomalies in a numeric column using the IQR method and plot them."""
-    if not value_col:
-        return "Could not identify a primary numeric column for anomaly detection.", None
-    
-    df = pd.read_csv(csv_path)
-    if value_col not in df.columns:
-        return f"Column '{value_col}' not found.", None
-
-    Q1 = df[value_col].quantile(0.25)
-    Q3 = df[value_col].quantile(0.75)
-    IQR = Q3 - Q1
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-
-    anomalies = df[(df[value_col] < lower_bound) | (df[value_col] > upper_bound)]
-
-    if anomalies.empty:
-        return "No significant anomalies detected in the data.", None
-    
-    plt.figure(figsize=(12, 6))
-    sns.lineplot(data=df, x=date_col if date_col and date_col in df.columns else df.index, y=value_col, label='Data')
-    sns.scatterplot(data=anomalies, x=date_col if date_col and date_col in df.columns else anomalies.index, y=value_col, color='red', s=100, label='Anomalies')
-    plt.title(f'Anomaly Detection for {value_col}')
-    plt.xlabel(date_col if date_col else 'Index')
-    plt.ylabel(value_col)
-    plt.legend()
-    plt.grid(True)
-    plot_path = os.path.join(app.config['STATIC_FOLDER'], 'anomaly_plot.png')
-    plt.savefig(plot_path)
-    plt.close()
-
-    summary = f"Detected {len(anomalies)} potential anomalies in '{value_col}'. These are values significantly lower than {lower_bound:.2f} or higher than {upper_bound:.2f}."
-    return summary, f'/{plot_path}'
-
 def format_response_with_bold_tags(text):
     """Format response text by converting markdown to HTML, removing ###, ***, and highlighting numbers."""
     import re
@@ -249,238 +337,93 @@ def format_response_with_bold_tags(text):
     
     return text
 
-def predict_timeseries(csv_path, date_col, value_col, prediction_length=12):
-    """Predict future values using a lightweight linear trend over recent data and generate a plot.
+# --- Request Tracing ---
+@app.before_request
+def begin_request_trace():
+    g.trace_token = start_trace()
 
-    Also returns a short natural-language explanation derived from the latest
-    historical values and forecast trajectory so the frontend can describe the
-    chart meaningfully.
-    """
-    if not date_col or not value_col:
-        return "Could not identify suitable date and value columns for forecasting.", None
-        
-    # Read CSV and parse only the detected date column
-    df = pd.read_csv(csv_path)
-    use_index = False
-    if date_col and date_col in df.columns:
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        df = df.dropna(subset=[date_col])
-        if df.empty:
-            use_index = True
-        else:
-            df = df.sort_values(by=date_col).reset_index(drop=True)
-    else:
-        use_index = True
-    
-    data = df[value_col].astype(float).values
-    # Use a recent window to fit a simple linear trend
-    recent_window = int(min(max(10, prediction_length * 2), len(data)))
-    y_recent = data[-recent_window:]
-    x_recent = np.arange(len(y_recent), dtype=float)
-    try:
-        slope, intercept = np.polyfit(x_recent, y_recent, 1)
-    except Exception:
-        slope, intercept = 0.0, float(y_recent[-1]) if len(y_recent) else 0.0
+@app.after_request
+def finish_request_trace(response):
+    trace = current_trace()
+    if trace is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe('cfo_request_duration_seconds', time.perf_counter() - trace['started'],
+            endpoint=endpoint, method=request.method, status=response.status_code)
+    # Opt in per request with an X-Timing header, or globally with TIMING_HEADER=1
+    if TIMING_HEADER_ALWAYS or request.headers.get('X-Timing'):
+        response.headers['X-Timing'] = timing_header(trace)
+    return response
 
-    x_future = np.arange(len(y_recent), len(y_recent) + prediction_length, dtype=float)
-    mean_prediction = (slope * x_future + intercept).tolist()
+@app.teardown_request
+def end_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
 
-    if not use_index:
-        freq = pd.infer_freq(df[date_col]) if len(df[date_col]) > 2 else 'D'
-        last_date = df[date_col].iloc[-1]
-        future_dates = pd.date_range(start=last_date, periods=prediction_length + 1, freq=freq)[1:]
-    else:
-        # Fallback to simple index-based x-axis
-        future_dates = np.arange(len(df), len(df) + prediction_length)
-
-    plt.figure(figsize=(12, 6))
-    if not use_index:
-        plt.plot(df[date_col], df[value_col], label='Historical Data')
-        plt.plot(future_dates, mean_prediction, label='Forecast', linestyle='--')
-        plt.xlabel(date_col)
-    else:
-        plt.plot(np.arange(len(df)), df[value_col], label='Historical Data')
-        plt.plot(future_dates, mean_prediction, label='Forecast', linestyle='--')
-        plt.xlabel('Index')
-    plt.title(f'Forecast for {value_col}')
-    plt.ylabel(value_col)
-    plt.legend()
-    plt.grid(True)
-    plot_path = os.path.join(app.config['STATIC_FOLDER'], 'forecast_plot.png')
-    plt.savefig(plot_path)
-    plt.close()
-    
-    # Build a concise, data-grounded explanation
-    recent_window = min(len(df), max(6, prediction_length))
-    recent_series = df[value_col].tail(recent_window)
-    recent_change = (recent_series.iloc[-1] - recent_series.iloc[0]) if recent_window > 1 else 0
-    recent_pct = (recent_change / recent_series.iloc[0] * 100.0) if recent_window > 1 and recent_series.iloc[0] != 0 else 0
-    forecast_change = mean_prediction[-1] - (recent_series.iloc[-1] if len(recent_series) else 0)
-    forecast_dir = "increase" if forecast_change > 0 else ("decrease" if forecast_change < 0 else "remain roughly flat")
-
-    summary = (
-        f"Forecast generated for the next {prediction_length} periods. "
-        f"Recent trend: {recent_pct:.1f}% change over the last {recent_window} observations. "
-        f"The projection suggests a {forecast_dir} toward the horizon. See the chart for details."
-    )
-    return summary, f'/{plot_path}'
+# Registered after the tracing hooks, so profiling starts inside the trace and
+# stops (after_request runs in reverse order) before the trace is finished.
+@app.before_request
+def begin_request_profile():
+    modes = requested_modes(request.headers)
+    if modes:
+        g.profile = start_profile(modes)
 
-def plot_rate_of_change(csv_path, date_col, value_col, two_month_window=True):
-    """Compute daily percentage rate of change, plot it, optionally aggregate by 2-month windows,
-    save to static and also export a copy to the project root as 'amazon_sales_roc.png'. Additionally,
-    forecast the rate-of-change series and save a separate forecast plot.
-    """
-    if not value_col:
-        return "Could not identify a numeric column for rate-of-change.", None, None
-
-    df = pd.read_csv(csv_path)
-    if date_col and date_col in df.columns:
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        df = df.dropna(subset=[date_col])
-        df = df.sort_values(by=date_col)
-        x = df[date_col]
-    else:
-        df = df.reset_index().rename(columns={'index': 'idx'})
-        x = df['idx']
-
-    y = pd.to_numeric(df[value_col], errors='coerce')
-    s = pd.Series(y.values, index=x)
-
-    # If index is datetime-like, ensure daily frequency for ROC
-    if isinstance(s.index, pd.DatetimeIndex):
-        s = s.asfreq('D')
-        s = s.interpolate(limit_direction='both')
-    roc = s.pct_change().mul(100.0)
-
-    plt.figure(figsize=(12, 6))
-    plt.plot(roc.index, roc.values, marker='o', linestyle='-', linewidth=1, markersize=2)
-    plt.title(f'Daily Rate of Change in {value_col} (%)')
-    plt.xlabel('Date' if isinstance(roc.index, pd.DatetimeIndex) else 'Index')
-    plt.ylabel('Percentage Change (%)')
-    plt.grid(True, alpha=0.3)
-
-    # Optional two-month window smoothing/aggregation
-    if two_month_window and isinstance(roc.index, pd.DatetimeIndex):
-        two_m = roc.resample('2MS').mean()  # mean at each 2-month start
-        plt.plot(two_m.index, two_m.values, color='orange', linewidth=2, label='2-month avg')
-        plt.legend()
-
-    roc_path_static = os.path.join(app.config['STATIC_FOLDER'], 'roc_plot.png')
-    plt.savefig(roc_path_static)
-    plt.close()
-
-    # Save an additional export copy in project root as requested
-    export_copy = os.path.join(os.getcwd(), 'amazon_sales_roc.png')
+def _finish_request_profile(status):
+    state = g.pop('profile', None)
+    if state is None:
+        return None
+    trace = current_trace() or {'stages': {}}
+    csv_path = session.get('csv_path')
+    meta = {
+        'endpoint': request.url_rule.rule if request.url_rule else request.path,
+        'method': request.method,
+        'status': status,
+        'dataset': os.path.basename(csv_path) if csv_path else None,
+        'stages': {stage: round(seconds * 1000, 1) for stage, (seconds, _) in trace['stages'].items()},
+    }
+    if request.path == '/chat' and request.is_json:
+        # Only the size: prompts can carry customer data and profiles are kept on disk
+        meta['prompt_chars'] = len((request.get_json(silent=True) or {}).get('prompt') or '')
     try:
-        shutil.copyfile(roc_path_static, export_copy)
-    except Exception as _:
-        pass
+        return stop_profile(state, meta)
+    except Exception as e:
+        print(f"WARNING: Failed to write request profile: {e}")
+        return None
 
-    # Forecast the ROC series using the same linear-trend method
-    if isinstance(roc.index, pd.DatetimeIndex):
-        clean = roc.dropna()
-        if len(clean) >= 5:
-            y_recent = clean.values[-min(60, len(clean)) :]
-            x_recent = np.arange(len(y_recent), dtype=float)
-            try:
-                slope, intercept = np.polyfit(x_recent, y_recent, 1)
-            except Exception:
-                slope, intercept = 0.0, float(y_recent[-1])
-            horizon = 14
-            x_future = np.arange(len(y_recent), len(y_recent) + horizon, dtype=float)
-            y_future = slope * x_future + intercept
-            last_date = clean.index[-1]
-            future_idx = pd.date_range(last_date, periods=horizon + 1, freq='D')[1:]
-
-            plt.figure(figsize=(12, 6))
-            plt.plot(clean.index, clean.values, label='ROC (historical)')
-            plt.plot(future_idx, y_future, linestyle='--', label='ROC forecast')
-            plt.title('Rate-of-Change Forecast (%)')
-            plt.xlabel('Date')
-            plt.ylabel('Percentage Change (%)')
-            plt.legend()
-            plt.grid(True, alpha=0.3)
-            roc_forecast_path = os.path.join(app.config['STATIC_FOLDER'], 'roc_forecast_plot.png')
-            plt.savefig(roc_forecast_path)
-            plt.close()
-        else:
-            roc_forecast_path = None
-    else:
-        roc_forecast_path = None
+@app.after_request
+def finish_request_profile(response):
+    profile_id = _finish_request_profile(response.status_code)
+    if profile_id:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
 
-    summary = (
-        "Computed daily percentage rate of change and generated the plot. "
-        "A 2-month average line is included for smoother trends. An export copy was saved as 'amazon_sales_roc.png'."
-    )
-    return summary, f'/{roc_path_static}', (f'/{roc_forecast_path}' if roc_forecast_path else None)
+@app.teardown_request
+def abandon_request_profile(exc=None):
+    if 'profile' in g:
+        _finish_request_profile(500)
 
-def plot_linear_relationships(csv_path, date_col):
-    """Find strong linear relations between numeric columns and plot them in subplots.
-    We compute Pearson correlations and plot the top correlated pairs side-by-side.
-    """
-    df = pd.read_csv(csv_path)
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-    if len(numeric_cols) < 2:
-        return "Not enough numeric columns to assess linear relations.", None
-
-    corr = df[numeric_cols].corr(method='pearson').abs()
-    pairs = []
-    for i, a in enumerate(numeric_cols):
-        for b in numeric_cols[i+1:]:
-            pairs.append(((a, b), corr.loc[a, b]))
-    pairs.sort(key=lambda x: x[1], reverse=True)
-    top_pairs = [p for p in pairs if np.isfinite(p[1])][:6]
-    if not top_pairs:
-        return "No clear linear relations found between numeric columns.", None
-
-    n = len(top_pairs)
-    rows = int(np.ceil(n / 2))
-    fig, axes = plt.subplots(rows, 2, figsize=(12, 4*rows))
-    axes = np.array(axes).reshape(-1)
-    for idx, ((a, b), r) in enumerate(top_pairs):
-        ax = axes[idx]
-        ax.plot(df[a], label=a)
-        ax.plot(df[b], label=b)
-        ax.set_title(f"{a} vs {b} (|r|={r:.2f})")
-        ax.legend()
-        ax.grid(True, alpha=0.3)
-    for j in range(idx+1, len(axes)):
-        axes[j].axis('off')
-    plt.tight_layout()
-    out_path = os.path.join(app.config['STATIC_FOLDER'], 'linear_relations.png')
-    plt.savefig(out_path)
-    plt.close()
-    return "Plotted top linear relations across numeric columns.", f'/{out_path}'
-
-def plot_top_sales_channels(csv_path, date_col, value_col):
-    """Detect a categorical 'channel' column and plot top 5 by total value_col."""
-    df = pd.read_csv(csv_path)
-    if not value_col or value_col not in df.columns:
-        return "Could not identify a numeric value column for sales.", None
-    # Find a categorical column with reasonable cardinality
-    categorical_cols = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
-    best_cat = None
-    best_card = None
-    for c in categorical_cols:
-        unique = df[c].nunique(dropna=True)
-        if 2 <= unique <= 20 and (best_card is None or unique < best_card):
-            best_cat, best_card = c, unique
-        if 'channel' in c.lower():
-            best_cat = c
-            break
-    if not best_cat:
-        return "No suitable categorical column found for channels.", None
-    grouped = df.groupby(best_cat)[value_col].sum().sort_values(ascending=False).head(5)
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x=grouped.values, y=grouped.index, orient='h')
-    plt.title('Top 5 Sales Channels')
-    plt.xlabel(value_col)
-    plt.ylabel(best_cat)
-    plt.grid(True, axis='x', alpha=0.2)
-    out_path = os.path.join(app.config['STATIC_FOLDER'], 'top_channels.png')
-    plt.savefig(out_path)
-    plt.close()
-    return f"Top 5 '{best_cat}' by total {value_col}.", f'/{out_path}'
+def _profile_access_denied():
+    if authorized(request.headers):
+        return None
+    return jsonify({"error": "A valid X-Profile-Token is required to read profiles."}), 403
+
+@app.route('/profiles', methods=['GET'])
+def profiles():
+    denied = _profile_access_denied()
+    if denied: return denied
+    return jsonify(list_profiles(request.args.get('limit', 100, type=int)))
+
+@app.route('/profiles/<profile_id>/<filename>', methods=['GET'])
+def profile_file(profile_id, filename):
+    denied = _profile_access_denied()
+    if denied: return denied
+    mimetype = 'application/octet-stream' if filename.endswith('.pstats') else 'text/plain'
+    return send_from_directory(os.path.abspath(PROFILE_DIR), f"{profile_id}/{filename}", mimetype=mimetype)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 # --- Flask Routes ---
 @app.route('/', methods=['GET', 'POST'])
@@ -493,339 +436,790 @@ def home():
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
             file.save(filepath)
             session['csv_path'] = filepath
+            # Materialize the columnar copy, rollup cube and running statistics at ingest
+            # so later charts read O(cube), not O(rows), and appends stay incremental
+            if ingest is not None:
+                try:
+                    date_col, value_col = find_csv_columns(filepath)
+                    ingest(filepath, date_col, value_col)
+                except Exception as e:
+                    print(f"WARNING: Failed to ingest dataset: {e}")
             return render_template('index.html', file_uploaded=True, filename=file.filename)
     return render_template('index.html', file_uploaded=False)
 
+@app.route('/append', methods=['POST'])
+def append():
+    """Append new rows (an uploaded CSV or a JSON list of records) to the current dataset."""
+    csv_path = session.get('csv_path')
+    if not csv_path or not os.path.exists(csv_path): return jsonify({"error": "CSV file not found. Please upload a file first."}), 400
+    if append_rows is None: return jsonify({"error": "Append mode unavailable."}), 500
+
+    has_file = 'file' in request.files and request.files['file'].filename
+    payload = request.get_json(silent=True) or {}
+    if not has_file and not payload.get("rows"):
+        return jsonify({"error": "No rows provided."}), 400
+
+    try:
+        try:
+            new_rows = pd.read_csv(request.files['file']) if has_file else pd.DataFrame(payload["rows"])
+        except Exception as e:
+            return jsonify({"error": f"Could not read the appended rows: {e}"}), 400
+        date_col, value_col = find_csv_columns(csv_path)
+        return jsonify(append_rows(csv_path, new_rows, date_col, value_col))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during append: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Run report packs for several uploaded datasets and return the run manifest."""
+    if run_batch_subprocess is None: return jsonify({"error": "Batch runner unavailable."}), 500
+    payload = request.json or {}
+    names = payload.get("datasets") or [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.lower().endswith('.csv')]
+    datasets = [os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(n)) for n in names]
+    missing = [os.path.basename(d) for d in datasets if not os.path.exists(d)]
+    if missing: return jsonify({"error": f"Datasets not found: {', '.join(missing)}"}), 400
+
+    reports = payload.get("reports") or REPORT_TYPES
+    if payload.get("async") and enqueue is not None:
+        job_id = enqueue('batch', {"datasets": datasets, "reports": reports, "workers": payload.get("workers")})
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+    try:
+        manifest = run_batch_subprocess(datasets, reports, payload.get("workers"))
+        return jsonify(manifest)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during batch run: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
 @app.route('/static/<path:filename>')
 def static_files(filename):
     return send_from_directory(app.config['STATIC_FOLDER'], filename)
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    user_prompt = request.json.get("prompt", "").lower()
-    csv_path = session.get('csv_path')
-    response_data = {}
+def _authenticated_user():
+    """(user id, None) for the signed-in caller, from a verified Supabase access token
+    or the signed session it was stored in; (None, error response) otherwise.
+    A user_id sent by the client is never trusted: these routes bypass row-level security."""
+    token = bearer_token(request.headers)
+    if token:
+        try:
+            user_id, expires = verify_token(token)
+        except AuthError as e:
+            return None, (jsonify({"error": str(e)}), 401)
+        except Exception as e:
+            print(f"ERROR: Could not verify access token: {e}")
+            return None, (jsonify({"error": "Could not verify the access token."}), 503)
+        session['user_id'], session['user_expires'] = user_id, expires
+        return user_id, None
+    if session.get('user_id') and session.get('user_expires', 0) > time.time():
+        return session['user_id'], None
+    return None, (jsonify({"error": "Sign in required: send your access token as 'Authorization: Bearer <token>'."}), 401)
 
-    if not user_prompt: return jsonify({"error": "No prompt provided."}), 400
+@app.route('/records/sync', methods=['POST'])
+def sync_records():
+    """Upsert the current dataset into financial_records for a user."""
+    csv_path = session.get('csv_path')
     if not csv_path or not os.path.exists(csv_path): return jsonify({"error": "CSV file not found. Please upload a file first."}), 400
+    if load_records is None: return jsonify({"error": "Financial records store unavailable."}), 500
+    payload = request.get_json(silent=True) or {}
+    user_id, denied = _authenticated_user()
+    if denied: return denied
+
+    date_col, _ = find_csv_columns(csv_path)
+    if payload.get("async") and enqueue is not None:
+        job_id = enqueue('records_sync', {"csv_path": csv_path, "user_id": user_id, "date_col": date_col,
+                                          "fingerprint": dataset_fingerprint(csv_path)})
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+    try:
+        return jsonify(load_records(csv_path, user_id, date_col))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during records sync: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+@app.route('/records', methods=['GET'])
+def list_records():
+    """One keyset page of a user's records: pass next_after back as ?after= for the next page."""
+    if load_records is None: return jsonify({"error": "Financial records store unavailable."}), 500
+    user_id, denied = _authenticated_user()
+    if denied: return denied
+    columns = [c for c in request.args.get("columns", "").split(",") if c] or None
     try:
+        frame, next_after = fetch_records(user_id, after=request.args.get("after"),
+                                          limit=min(request.args.get("limit", 1000, type=int), 10000),
+                                          columns=columns, start=request.args.get("start"), end=request.args.get("end"))
+        frame['date'] = frame['date'].map(lambda d: d.isoformat())
+        records = frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
+        return jsonify({"records": records, "next_after": next_after})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during records read: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/records/open', methods=['POST'])
+def open_records():
+    """Make a user's stored records the current dataset, so chat analyses run on them."""
+    if load_records is None: return jsonify({"error": "Financial records store unavailable."}), 500
+    payload = request.get_json(silent=True) or {}
+    user_id, denied = _authenticated_user()
+    if denied: return denied
+    try:
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"financial_records_{user_id}.csv")
+        rows = export_records(user_id, filepath, start=payload.get("start"), end=payload.get("end"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during records export: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    session['csv_path'] = filepath
+    if ingest is not None:
+        try:
+            date_col, value_col = find_csv_columns(filepath)
+            ingest(filepath, date_col, value_col)
+        except Exception as e:
+            print(f"WARNING: Failed to ingest dataset: {e}")
+    return jsonify({"rows": rows, "filename": os.path.basename(filepath)})
+
+RECEIVABLES_KEYWORDS = ["receivable", "aging", "ageing", "dso", "days sales outstanding", "overdue invoice",
+                        "unpaid invoice", "collections"]
+
+@app.route('/receivables', methods=['GET', 'POST'])
+def receivables():
+    """Aging, DSO and the collections worklist for an uploaded invoice CSV or the invoices table."""
+    if receivables_report is None: return jsonify({"error": "Receivables analytics unavailable."}), 500
+    args = request.args if request.method == 'GET' else (request.form if request.files else (request.get_json(silent=True) or {}))
+    csv_path = session.get('csv_path')
+    if csv_path and not os.path.exists(csv_path):
+        csv_path = None
+    # Only the invoices table needs a user; an upload or invoice dataset doesn't
+    user_id, denied = _authenticated_user()
+
+    try:
+        invoices = None
+        if 'file' in request.files and request.files['file'].filename:
+            try:
+                invoices = pd.read_csv(request.files['file'])
+            except Exception as e:
+                return jsonify({"error": f"Could not read the invoice file: {e}"}), 400
+        cube = None
+        value_col = None
+        if csv_path and invoices is None:
+            date_col, value_col = find_csv_columns(csv_path)
+            if get_rollup is not None:
+                with span('rollup'):
+                    cube = get_rollup(csv_path, date_col)
+        return jsonify(receivables_report(csv_path, cube=cube, value_col=value_col, invoices=invoices,
+                                          user_id=user_id, as_of=args.get("as_of"),
+                                          top=int(args.get("top", 20))))
+    except SignInRequired:
+        return denied
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during receivables analysis: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/chart-data', methods=['GET'])
+def chart_data():
+    """Aggregated, downsampled chart data (JSON or Arrow) for client-side rendering."""
+    csv_path = session.get('csv_path')
+    if not csv_path or not os.path.exists(csv_path): return jsonify({"error": "CSV file not found. Please upload a file first."}), 400
+    if build_chart_data is None: return jsonify({"error": "Chart data unavailable."}), 500
+    try:
+        params = parse_params(request.args, request.headers.get('Accept', ''))
+    except ArrowUnavailable as e:
+        return jsonify({"error": str(e)}), 406
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # The ETag depends only on the dataset fingerprint and params, so revalidation skips all work
+    etag = chart_data_etag(csv_path, params)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache", "Vary": "Accept"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    def build():
         date_col, value_col = find_csv_columns(csv_path)
-        final_response_text = ""
-        
-        # --- Keyword-based Task Router ---
+        cube = None
+        if get_rollup is not None:
+            try:
+                with span('rollup'):
+                    cube = get_rollup(csv_path, date_col)
+            except Exception as e:
+                print(f"WARNING: Rollup cube unavailable, reading CSV directly: {e}")
+        return encode(build_chart_data(csv_path, date_col, value_col, cube, params), params['format'])
+
+    try:
+        body, mimetype = cached_chart_data(etag, build)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error during chart data: {e}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    return Response(body, mimetype=mimetype, headers=headers)
+
+# Each chat writes its images to its own static/charts/<id>/ directory, so
+# concurrent requests and background jobs never overwrite each other's PNGs
+CHART_DIR = os.path.join(app.config['STATIC_FOLDER'], 'charts')
+CHART_KEEP = int(os.getenv("CHART_KEEP", "500"))
+
+def _chart_dir():
+    """A fresh per-chat image directory; the oldest beyond CHART_KEEP are removed."""
+    os.makedirs(CHART_DIR, exist_ok=True)
+    try:
+        entries = sorted(os.scandir(CHART_DIR), key=lambda e: e.stat().st_mtime)
+        for entry in entries[:max(len(entries) - CHART_KEEP + 1, 0)]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    except OSError as e:
+        print(f"WARNING: Could not prune old chart images: {e}")
+    out_dir = os.path.join(CHART_DIR, uuid.uuid4().hex)
+    os.makedirs(out_dir)
+    return out_dir
+
+def run_chat(user_prompt, csv_path, progress=None, render="image", user_id=None):
+    """Answer one chat prompt against a dataset and return the /chat JSON payload.
+
+    progress(fraction, message) is called as the work advances, so the same
+    code can run inline in a request or from a background job. With
+    render="data", chart intents return a chart_data_url instead of a PNG.
+    user_id is the signed-in user, for data read from the app's database.
+    """
+    progress = progress or (lambda fraction, message: None)
+    response_data = {}
+    progress(0.1, "Detecting dataset columns")
+    date_col, value_col = find_csv_columns(csv_path)
+    cube = None
+    if get_rollup is not None:
+        try:
+            with span('rollup'):
+                cube = get_rollup(csv_path, date_col)
+        except Exception as e:
+            print(f"WARNING: Rollup cube unavailable, reading CSV directly: {e}")
+    final_response_text = ""
+    out_dir = _chart_dir()
+
+    def chart(kind):
+        if render == "data" and build_chart_data is not None:
+            response_data['chart_data_url'] = f"/chart-data?type={kind}"
+            return f"{kind.capitalize()} chart data is ready.", None
+        return generate_chart(kind, csv_path, date_col, value_col, cube=cube, out_dir=out_dir)
+
+    # "Does marketing lead revenue?" -- resolved to driver and target columns up front
+    lead_lag_request = None
+    if LEAD_LAG_WORDS.search(user_prompt):
+        if cube is not None:
+            numeric_cols = cube['meta']['numeric_cols']
+        else:
+            numeric_cols = pd.read_csv(csv_path, nrows=200).select_dtypes(include=[np.number]).columns.tolist()
+        lead_lag_request = parse_lead_lag(user_prompt, [c for c in numeric_cols if c != date_col])
+    
+    use_agent = False
+    # --- Keyword-based Task Router ---
         
-        # 1. Handle special tasks first
-        # Rate-of-change / growth requests
-        if any(k in user_prompt for k in ["rate of change", "roc", "growth rate", "percentage change"]):
-            summary, roc_url, roc_forecast_url = plot_rate_of_change(csv_path, date_col, value_col, two_month_window=True)
-            if roc_url: response_data['image_url'] = roc_url
-            if roc_forecast_url: response_data['secondary_image_url'] = roc_forecast_url
-            final_response_text = summary
-
-        # Linear relationships across numeric columns
-        elif any(k in user_prompt for k in ["linear relation", "linear relationship", "correlation", "sub plots", "subplots"]):
-            summary, img_url = plot_linear_relationships(csv_path, date_col)
-            if img_url: response_data['image_url'] = img_url
-            final_response_text = summary
+    # 1. Handle special tasks first
+    # Receivables aging / DSO / which invoices to chase
+    if any(k in user_prompt for k in RECEIVABLES_KEYWORDS) and receivables_report is not None:
+        try:
+            report = receivables_report(csv_path, cube=cube, value_col=value_col, user_id=user_id)
+            response_data['receivables'] = report
+            final_response_text = summarize_receivables(report)
+        except ValueError as e:
+            final_response_text = str(e)
 
-        # Top sales channels
-        elif any(k in user_prompt for k in ["top 5", "top five", "best sales channel", "top sales channel", "top channels"]):
-            summary, img_url = plot_top_sales_channels(csv_path, date_col, value_col)
-            if img_url: response_data['image_url'] = img_url
-            final_response_text = summary
+    # Rate-of-change / growth requests
+    elif any(k in user_prompt for k in ["rate of change", "roc", "growth rate", "percentage change"]):
+        summary, roc_url, roc_forecast_url = plot_rate_of_change(csv_path, date_col, value_col, two_month_window=True, cube=cube,
+                                                                  out_dir=out_dir, export_copy=True)
+        if roc_url: response_data['image_url'] = roc_url
+        if roc_forecast_url: response_data['secondary_image_url'] = roc_forecast_url
+        final_response_text = summary
+
+    # Lead/lag between named metrics (lagged cross-correlation)
+    elif lead_lag_request is not None:
+        drivers, targets = lead_lag_request
+        summary, img_url = plot_lead_lag(csv_path, date_col, drivers, targets, cube=cube, out_dir=out_dir)
+        if img_url: response_data['image_url'] = img_url
+        final_response_text = summary
+
+    # Linear relationships across numeric columns
+    elif any(k in user_prompt for k in ["linear relation", "linear relationship", "correlation", "spearman", "sub plots", "subplots"]):
+        method = 'spearman' if any(k in user_prompt for k in ["spearman", "rank correlation"]) else 'pearson'
+        summary, img_url = plot_linear_relationships(csv_path, date_col, method=method, out_dir=out_dir)
+        if img_url: response_data['image_url'] = img_url
+        final_response_text = summary
 
-        # Chart requests - check if user wants explanation with chart
-        elif "pie" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+    # Top sales channels
+    elif any(k in user_prompt for k in ["top 5", "top five", "best sales channel", "top sales channel", "top channels"]):
+        summary, img_url = plot_top_sales_channels(csv_path, date_col, value_col, cube=cube, out_dir=out_dir)
+        if img_url: response_data['image_url'] = img_url
+        final_response_text = summary
+
+    # P&L bridge / profit walk between consecutive periods, e.g. "quarterly bridge by region"
+    elif pnl_bridges is not None and BRIDGE_PATTERN.search(user_prompt):
+        dimensions = cube['meta']['dimensions'] if cube is not None else \
+            pd.read_csv(csv_path, nrows=200).select_dtypes(exclude=[np.number]).columns.tolist()
+        grain, dimension = parse_bridge_request(user_prompt, [d for d in dimensions if d != date_col])
+        try:
+            result = pnl_bridges(csv_path, date_col, cube, grain, dimension, last=12)
+            response_data['bridge'] = result
+            if render == "data" and build_chart_data is not None:
+                response_data['chart_data_url'] = f"/chart-data?type=bridge&grain={grain}" + \
+                    (f"&category={quote(dimension)}" if dimension else "")
             else:
-                msg, img_url = generate_chart('pie', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+                response_data['image_url'] = plot_bridge(result, out_dir)
+            final_response_text = summarize_bridge(result)
+        except ValueError as e:
+            final_response_text = str(e)
+
+    # Chart requests - check if user wants explanation with chart
+    elif "pie" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('pie')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about pie chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
-        
-        elif "bar" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt) and "stacked" not in user_prompt:
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about pie chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
             else:
-                msg, img_url = generate_chart('bar', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
-                
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about bar chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
+                final_response_text = msg
         
-        elif "line" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
-            else:
-                msg, img_url = generate_chart('line', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+    elif "bar" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt) and "stacked" not in user_prompt:
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('bar')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about line chart trend analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
-        
-        elif "area" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about bar chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
             else:
-                msg, img_url = generate_chart('area', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
-                
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about area chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
+                final_response_text = msg
         
-        elif "scatter" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
-            else:
-                msg, img_url = generate_chart('scatter', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+    elif "line" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('line')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about scatter plot correlation analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
-        
-        elif "box" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about line chart trend analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
             else:
-                msg, img_url = generate_chart('box', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+                final_response_text = msg
+        
+    elif "area" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('area')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about box plot distribution analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about area chart analysis for {value_col or 'financial metrics'}. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
+            else:
+                final_response_text = msg
         
-        elif ("heatmap" in user_prompt or "heat map" in user_prompt) and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt or "correlation" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+    elif "scatter" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('scatter')
+            if img_url: response_data['image_url'] = img_url
+                
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about scatter plot correlation analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
             else:
-                msg, img_url = generate_chart('heatmap', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+                final_response_text = msg
+        
+    elif "box" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('box')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about correlation heatmap analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about box plot distribution analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
+            else:
+                final_response_text = msg
         
-        elif "waterfall" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
-            if generate_chart is None:
-                final_response_text = "Chart generator unavailable."
+    elif ("heatmap" in user_prompt or "heat map" in user_prompt) and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt or "correlation" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('heatmap')
+            if img_url: response_data['image_url'] = img_url
+                
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about correlation heatmap analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
             else:
-                msg, img_url = generate_chart('waterfall', csv_path, date_col, value_col)
-                if img_url: response_data['image_url'] = img_url
+                final_response_text = msg
+        
+    elif "waterfall" in user_prompt and ("chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt):
+        if generate_chart is None:
+            final_response_text = "Chart generator unavailable."
+        else:
+            msg, img_url = chart('waterfall')
+            if img_url: response_data['image_url'] = img_url
                 
-                # Check if user wants explanation
-                if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
-                    explanation = ""
-                    if knowledge_chain and not isinstance(knowledge_chain, str):
-                        try:
-                            kb_query = f"Provide concise insights about waterfall chart financial breakdown analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
-                            kb_res = knowledge_chain.invoke({"query": kb_query})
-                            explanation = kb_res.get('result', '')
-                        except Exception:
-                            pass
-                    final_response_text = msg + ("\n\n" + explanation if explanation else "")
-                else:
-                    final_response_text = msg
-
-        # Forecast/predict requests
-        elif "forecast" in user_prompt or "predict" in user_prompt:
-            summary, plot_url = predict_timeseries(csv_path, date_col, value_col)
-            if plot_url: response_data['image_url'] = plot_url
-            final_response_text = summary
+            # Check if user wants explanation
+            if any(word in user_prompt for word in ['explain', 'tell me', 'what', 'why', 'how', 'analyze', 'insight']):
+                explanation = ""
+                if knowledge_chain and not isinstance(knowledge_chain, str):
+                    try:
+                        kb_query = f"Provide concise insights about waterfall chart financial breakdown analysis. Focus on practical CFO-level interpretation. Keep under 100 words."
+                        kb_res = knowledge_chain.invoke({"query": kb_query}, config=llm_config())
+                        explanation = kb_res.get('result', '')
+                    except Exception:
+                        pass
+                final_response_text = msg + ("\n\n" + explanation if explanation else "")
+            else:
+                final_response_text = msg
+
+    # Forecast/predict requests
+    elif "forecast" in user_prompt or "predict" in user_prompt:
+        # The ledger keeps the most recent rows, which is all the trend fit needs;
+        # the chart still shows every row's date and value
+        tail = forecast_tail(csv_path, date_col, value_col) if forecast_tail is not None else None
+        history = forecast_history(csv_path, date_col, value_col) if tail is not None else None
+        summary, plot_url = predict_timeseries(csv_path, date_col, value_col, df=tail, out_dir=out_dir, history=history)
+        if plot_url: response_data['image_url'] = plot_url
+        final_response_text = summary
         
-        # Generic chart/graph/plot requests - default to asking user to be specific
-        elif "chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt or "compare" in user_prompt:
-            final_response_text = "I can generate various types of charts for you. Please specify which type you'd like:\n\n" + \
-                                  "- **Pie chart** - for showing proportions and percentages\n" + \
-                                  "- **Bar chart** - for comparing categories\n" + \
-                                  "- **Line chart** - for showing trends over time\n" + \
-                                  "- **Area chart** - for cumulative trends\n" + \
-                                  "- **Scatter plot** - for showing relationships\n" + \
-                                  "- **Box plot** - for distribution analysis\n" + \
-                                  "- **Heatmap** - for correlation analysis\n" + \
-                                  "- **Waterfall chart** - for financial breakdown\n\n" + \
-                                  "Or you can ask for a **forecast** to predict future trends."
+    # Generic chart/graph/plot requests - default to asking user to be specific
+    elif "chart" in user_prompt or "graph" in user_prompt or "plot" in user_prompt or "compare" in user_prompt:
+        final_response_text = "I can generate various types of charts for you. Please specify which type you'd like:\n\n" + \
+                              "- **Pie chart** - for showing proportions and percentages\n" + \
+                              "- **Bar chart** - for comparing categories\n" + \
+                              "- **Line chart** - for showing trends over time\n" + \
+                              "- **Area chart** - for cumulative trends\n" + \
+                              "- **Scatter plot** - for showing relationships\n" + \
+                              "- **Box plot** - for distribution analysis\n" + \
+                              "- **Heatmap** - for correlation analysis\n" + \
+                              "- **Waterfall chart** - for financial breakdown\n" + \
+                              "- **P&L bridge** - profit walk between months, quarters or years (e.g. by region)\n\n" + \
+                              "Or you can ask for a **forecast** to predict future trends."
             
-        elif "anomaly" in user_prompt or "outlier" in user_prompt:
-            summary, plot_url = detect_anomalies(csv_path, date_col, value_col)
-            if plot_url: response_data['image_url'] = plot_url
-            final_response_text = summary
+    elif "anomaly" in user_prompt or "outlier" in user_prompt:
+        bounds = anomaly_bounds(csv_path, value_col) if anomaly_bounds is not None else None
+        summary, plot_url = detect_anomalies(csv_path, date_col, value_col, bounds=bounds, out_dir=out_dir)
+        if plot_url: response_data['image_url'] = plot_url
+        final_response_text = summary
         
-        else:
-            # ALWAYS ANALYZE DATASET FIRST, THEN ADD KNOWLEDGE BASE INSIGHTS
-            print("➡️ Analyzing dataset first, then adding knowledge base insights...")
-            
-            # Get data insights first using CSV agent
-            print("➡️ Analyzing dataset...")
-            data_agent_prompt = f"""
-            Analyze the financial dataset to answer: '{user_prompt}'
-            
-            INSTRUCTIONS:
-            1. Extract relevant data points related to the user's question
-            2. Calculate key metrics (totals, averages, trends, etc.)
-            3. Provide specific numbers and insights from the dataset
-            4. Be concise and to-the-point - avoid long explanations
-            5. Use bullet points with hyphens (-) for listing items
-            6. Your response MUST start with "Final Answer:"
-            7. Be specific with numbers, dates, and amounts
-            8. Always base your answer on the actual data in the CSV file
-            9. Keep response under 200 words
-            
-            User's question: {user_prompt}
-            """
-
-            csv_agent = create_csv_agent(
-                llm,
-                csv_path,
-                verbose=False,
-                allow_dangerous_code=True,
-                agent_executor_kwargs={
-                    "handle_parsing_errors": True
-                },
-                max_iterations=30,
-                max_execution_time=120
-            )
+    else:
+        use_agent = True
+
+    if use_agent:
+        # ALWAYS ANALYZE DATASET FIRST, THEN ADD KNOWLEDGE BASE INSIGHTS
+        print("➡️ Analyzing dataset first, then adding knowledge base insights...")
+        
+        # Get data insights first using CSV agent
+        print("➡️ Analyzing dataset...")
+        progress(0.3, "Analyzing dataset")
+        data_agent_prompt = f"""
+        Analyze the financial dataset to answer: '{user_prompt}'
+        
+        INSTRUCTIONS:
+        1. Extract relevant data points related to the user's question
+        2. Calculate key metrics (totals, averages, trends, etc.)
+        3. Provide specific numbers and insights from the dataset
+        4. Be concise and to-the-point - avoid long explanations
+        5. Use bullet points with hyphens (-) for listing items
+        6. Your response MUST start with "Final Answer:"
+        7. Be specific with numbers, dates, and amounts
+        8. Always base your answer on the actual data in the CSV file
+        9. Keep response under 200 words
+        
+        User's question: {user_prompt}
+        """
 
-            data_insights = ""
+        # A precomputed summary of the whole file saves the agent the schema-discovery
+        # round trips (df.columns, df.describe()...) it would otherwise start with
+        if AGENT_CONTEXT_PACK and get_context_pack is not None:
             try:
-                data_result = csv_agent.invoke({"input": data_agent_prompt})
-                data_insights = data_result.get('output', "")
+                with span('context_pack'):
+                    context_pack = get_context_pack(csv_path, date_col, value_col, cube=cube)
+                data_agent_prompt += f"""
+        DATASET CONTEXT (precomputed from the full file, `df` in your tool). Answer from it
+        directly when it covers the question; only run code for what it doesn't cover:
+        {context_pack}
+        """
+            except Exception as e:
+                print(f"WARNING: Dataset context pack unavailable: {e}")
+
+        agent_kwargs = dict(
+            verbose=False,
+            agent_executor_kwargs={
+                "handle_parsing_errors": True
+            },
+            max_iterations=30,
+            max_execution_time=120
+        )
+
+        data_insights = ""
+        try:
+            with ExitStack() as agent_stack:
+                with span('agent_setup'):
+                    if AGENT_SANDBOX:
+                        # Generated code runs in a leased sandbox worker that already holds the dataset
+                        csv_agent = agent_stack.enter_context(sandboxed_csv_agent(llm, csv_path, **agent_kwargs))
+                    elif in_process_csv_agent is not None:
+                        # Parses the whole CSV into the agent's DataFrame; print output is captured per thread
+                        csv_agent = in_process_csv_agent(llm, csv_path, **agent_kwargs)
+                    else:
+                        csv_agent = create_csv_agent(llm, csv_path, allow_dangerous_code=True, **agent_kwargs)
+                with span('agent'):
+                    data_result = csv_agent.invoke({"input": data_agent_prompt}, config=llm_config())
+            data_insights = data_result.get('output', "")
+            
+            if "Final Answer:" in data_insights:
+                data_insights = data_insights.split("Final Answer:")[-1].strip()
                 
-                if "Final Answer:" in data_insights:
-                    data_insights = data_insights.split("Final Answer:")[-1].strip()
+        except GatewayError:
+            raise
+        except Exception as agent_error:
+            print(f"Data analysis failed: {agent_error}")
+            data_insights = f"Unable to analyze dataset: {str(agent_error)}"
+        
+        # Get strategic advice from knowledge base ONLY if relevant
+        strategic_advice = ""
+        if knowledge_chain and not isinstance(knowledge_chain, str):
+            # Only query knowledge base for strategic/improvement questions
+            strategic_keywords = ['improve', 'strategy', 'recommendation', 'advice', 'how to', 'what should', 'best practice', 'optimize', 'increase', 'decrease', 'reduce', 'grow', 'turnaround']
+            if any(keyword in user_prompt for keyword in strategic_keywords):
+                print("➡️ Getting strategic advice from knowledge base...")
+                progress(0.8, "Consulting knowledge base")
+                try:
+                    kb_prompt = f"""
+                    Based on the user's question: '{user_prompt}'
+                    And the data context: {data_insights[:300] if data_insights else 'N/A'}
                     
-            except Exception as agent_error:
-                print(f"Data analysis failed: {agent_error}")
-                data_insights = f"Unable to analyze dataset: {str(agent_error)}"
-            
-            # Get strategic advice from knowledge base ONLY if relevant
-            strategic_advice = ""
-            if knowledge_chain and not isinstance(knowledge_chain, str):
-                # Only query knowledge base for strategic/improvement questions
-                strategic_keywords = ['improve', 'strategy', 'recommendation', 'advice', 'how to', 'what should', 'best practice', 'optimize', 'increase', 'decrease', 'reduce', 'grow', 'turnaround']
-                if any(keyword in user_prompt for keyword in strategic_keywords):
-                    print("➡️ Getting strategic advice from knowledge base...")
-                    try:
-                        kb_prompt = f"""
-                        Based on the user's question: '{user_prompt}'
-                        And the data context: {data_insights[:300] if data_insights else 'N/A'}
-                        
-                        Provide concise, actionable CFO-level recommendations.
-                        - Keep response under 150 words
-                        - Use bullet points with hyphens (-)
-                        - Focus on practical actions
-                        - Avoid generic advice
-                        """
-                        strategy_result = knowledge_chain.invoke({"query": kb_prompt})
-                        strategic_advice = strategy_result['result']
-                    except Exception as e:
-                        print(f"Knowledge base query failed: {e}")
-                        strategic_advice = ""
-            
-            # Combine insights concisely
-            if data_insights and strategic_advice:
-                final_response_text = f"{data_insights}\n\n<b>Recommendations:</b>\n{strategic_advice}"
-            elif data_insights:
-                final_response_text = data_insights
-            elif strategic_advice:
-                final_response_text = strategic_advice
-            else:
-                final_response_text = "I need more context to provide a helpful analysis. Could you please be more specific about what you'd like to know?"
-
-        # Format response with bold tags for better presentation
-        final_response_text = format_response_with_bold_tags(final_response_text)
+                    Provide concise, actionable CFO-level recommendations.
+                    - Keep response under 150 words
+                    - Use bullet points with hyphens (-)
+                    - Focus on practical actions
+                    - Avoid generic advice
+                    """
+                    strategy_result = knowledge_chain.invoke({"query": kb_prompt}, config=llm_config())
+                    strategic_advice = strategy_result['result']
+                except GatewayError:
+                    raise
+                except Exception as e:
+                    print(f"Knowledge base query failed: {e}")
+                    strategic_advice = ""
         
-        response_data['response'] = final_response_text
-        return jsonify(response_data)
+        # Combine insights concisely
+        if data_insights and strategic_advice:
+            final_response_text = f"{data_insights}\n\n<b>Recommendations:</b>\n{strategic_advice}"
+        elif data_insights:
+            final_response_text = data_insights
+        elif strategic_advice:
+            final_response_text = strategic_advice
+        else:
+            final_response_text = "I need more context to provide a helpful analysis. Could you please be more specific about what you'd like to know?"
+
+    # Format response with bold tags for better presentation
+    final_response_text = format_response_with_bold_tags(final_response_text)
+    
+    response_data['response'] = final_response_text
+    try:
+        os.rmdir(out_dir)  # only succeeds when no image was written
+    except OSError:
+        pass
+    progress(1.0, "Done")
+    return response_data
+
+def _request_tenant():
+    """LLM budget tenant: from a configured X-Api-Key (remembered in the signed
+    session cookie), never from a client-chosen name; otherwise "default"."""
+    tenant = tenant_for_key(request.headers.get("X-Api-Key"))
+    if tenant:
+        session['tenant'] = tenant
+    return tenant or session.get('tenant') or "default"
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    user_prompt = request.json.get("prompt", "").lower()
+    render = request.json.get("render", "image")
+    csv_path = session.get('csv_path')
+
+    if not user_prompt: return jsonify({"error": "No prompt provided."}), 400
+    if not csv_path or not os.path.exists(csv_path): return jsonify({"error": "CSV file not found. Please upload a file first."}), 400
+
+    tenant = _request_tenant()
+    user_id, _ = _authenticated_user()
 
+    # Long analyses can run in the background; poll /jobs/<id> for the result
+    if request.json.get("async") and enqueue is not None:
+        job_id = enqueue('chat', {"prompt": user_prompt, "csv_path": csv_path, "tenant": tenant,
+                                  "render": render, "user_id": user_id, "fingerprint": dataset_fingerprint(csv_path)})
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+    try:
+        with llm_context(tenant=tenant, priority="interactive"):
+            return jsonify(run_chat(user_prompt, csv_path, render=render, user_id=user_id))
+    except BudgetExceeded as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except GatewayError as e:
+        print(f"WARNING: LLM gateway rejected chat request: {e}")
+        return jsonify({"error": "The AI service is busy. Please try again shortly."}), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         print(f"Error during chat processing: {e}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    if get_job is None: return jsonify({"error": "Job queue unavailable."}), 500
+    job = get_job(job_id)
+    if job is None: return jsonify({"error": "Job not found."}), 404
+    return jsonify(job)
+
+@app.route('/llm/usage', methods=['GET'])
+def llm_usage():
+    return jsonify(tenant_usage())
+
+def _kb_admin_denied():
+    token = request.headers.get('X-Admin-Token')
+    if KB_ADMIN_TOKEN and token and hmac.compare_digest(token, KB_ADMIN_TOKEN):
+        return None
+    return jsonify({"error": "A valid X-Admin-Token is required to rebuild the knowledge base."}), 403
+
+@app.route('/kb/rebuild', methods=['POST'])
+def rebuild_knowledge_base():
+    denied = _kb_admin_denied()
+    if denied: return denied
+    if enqueue is None: return jsonify({"error": "Job queue unavailable."}), 500
+    payload = request.get_json(silent=True) or {}
+    params = {}
+    try:
+        for key in ("chunk_size", "chunk_overlap"):
+            if payload.get(key) is not None:
+                params[key] = int(payload[key])
+    except (TypeError, ValueError):
+        return jsonify({"error": "chunk_size and chunk_overlap must be integers."}), 400
+    if params.get("chunk_size", 1) <= 0 or params.get("chunk_overlap", 0) < 0:
+        return jsonify({"error": "chunk_size must be positive and chunk_overlap non-negative."}), 400
+    job_id = enqueue('kb_rebuild', params)
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+# --- Background Jobs ---
+def _chat_job(params, progress):
+    # Background chats use the batch lane so they never delay interactive requests
+    with llm_context(tenant=params.get("tenant"), priority="batch"):
+        return run_chat(params["prompt"], params["csv_path"], progress, params.get("render", "image"),
+                        params.get("user_id"))
+
+def _batch_job(params, progress):
+    progress(0.1, f"Running reports for {len(params['datasets'])} dataset(s)")
+    return run_batch_subprocess(params["datasets"], params["reports"], params.get("workers"))
+
+def _records_sync_job(params, progress):
+    progress(0.1, "Loading records")
+    return load_records(params["csv_path"], params["user_id"], params["date_col"])
+
+_kb_rebuild_lock = threading.Lock()
+
+def _kb_rebuild_job(params, progress):
+    # The live index and chain keep serving until the new ones are ready;
+    # a failed rebuild leaves them as they were
+    global knowledge_chain
+    if embeddings is None:
+        raise ValueError("Embeddings are not loaded; the knowledge base can't be rebuilt.")
+    progress(0.1, "Waiting for any running rebuild")
+    with _kb_rebuild_lock:
+        progress(0.2, "Rebuilding knowledge base index")
+        vector_store = _build_index(params.get("chunk_size"), params.get("chunk_overlap"))
+        if vector_store is None:
+            raise ValueError("No documents found in the knowledge_base folder; the current index was kept.")
+        knowledge_chain = _retrieval_chain(vector_store)
+    return {"knowledge_base": "ready"}
+
+# The sandbox pool starts with the first agent request (SandboxPool.lease)
+if not AGENT_SANDBOX and sandbox_pool is not None:
+    print("WARNING: Sandboxed agent execution is off; generated code runs in the web process.")
+
+if enqueue is not None:
+    register('chat')(_chat_job)
+    register('batch')(_batch_job)
+    register('kb_rebuild')(_kb_rebuild_job)
+    if load_records is not None:
+        register('records_sync')(_records_sync_job)
+    init_jobs()
+
 # --- Main Application Execution ---
 if __name__ == '__main__':
     if '--rebuild' in sys.argv:
-        if os.path.exists(FAISS_INDEX_PATH):
-            print(f"INFO: '--rebuild' flag detected. Deleting existing index '{FAISS_INDEX_PATH}'...")
-            shutil.rmtree(FAISS_INDEX_PATH)
-            print("SUCCESS: Index deleted.")
+        print(f"INFO: '--rebuild' flag detected. Rebuilding index '{FAISS_INDEX_PATH}'...")
     
-    initialize_knowledge_base()
+    initialize_knowledge_base(rebuild='--rebuild' in sys.argv)
     app.run(debug=True)
\ No newline at end of file
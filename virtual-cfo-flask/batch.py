@@ -0,0 +1,194 @@
+"""Batch report runner: nightly CFO packs for many datasets at once.
+
+Usage:
+    python batch.py uploads/*.csv --reports forecast roc anomalies --workers 8
+
+The web app runs batches through run_batch_subprocess, so the process pool is
+only ever forked from this single-threaded CLI process, never from the
+multi-threaded server.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from analysis import (find_csv_columns, detect_anomalies, predict_timeseries, plot_rate_of_change,
+                      plot_top_sales_channels)
+from charts import generate_chart
+from rollups import get_rollup
+
+RUNS_DIR = 'runs'
+REPORT_TYPES = ['forecast', 'roc', 'anomalies', 'waterfall', 'top_channels']
+
+
+def _run_report(report, csv_path, df, date_col, value_col, cube, out_dir):
+    """Run one report on an already-parsed dataset; returns (summary, [image urls])."""
+    # Handlers parse dates in place, so each one gets its own copy of the frame
+    if report == 'forecast':
+        summary, url = predict_timeseries(csv_path, date_col, value_col, df=df.copy(), out_dir=out_dir)
+        return summary, [url]
+    if report == 'roc':
+        summary, url, forecast_url = plot_rate_of_change(
+            csv_path, date_col, value_col, two_month_window=True, cube=cube, df=df.copy(), out_dir=out_dir
+        )
+        return summary, [url, forecast_url]
+    if report == 'anomalies':
+        summary, url = detect_anomalies(csv_path, date_col, value_col, df=df.copy(), out_dir=out_dir)
+        return summary, [url]
+    if report == 'waterfall':
+        summary, url = generate_chart('waterfall', csv_path, date_col, value_col, df=df.copy(), out_dir=out_dir)
+        return summary, [url]
+    if report == 'top_channels':
+        summary, url = plot_top_sales_channels(csv_path, date_col, value_col, cube=cube, df=df.copy(), out_dir=out_dir)
+        return summary, [url]
+    raise ValueError(f"Unknown report type '{report}'.")
+
+
+def run_dataset(csv_path, reports, run_dir):
+    """Parse and detect columns once for a dataset, then produce every requested report."""
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    out_dir = os.path.join(run_dir, name)
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+
+    started = time.perf_counter()
+    try:
+        df = pd.read_csv(csv_path)
+        parse_seconds = time.perf_counter() - started
+        date_col, value_col = find_csv_columns(csv_path)
+        cube = get_rollup(csv_path, date_col, df=df.copy())
+        prepare_seconds = time.perf_counter() - started
+    except Exception as e:
+        return {'dataset': csv_path, 'status': 'error', 'error': str(e), 'tasks': tasks,
+                'seconds': time.perf_counter() - started}
+
+    for report in reports:
+        task_started = time.perf_counter()
+        task = {'report': report}
+        try:
+            summary, urls = _run_report(report, csv_path, df, date_col, value_col, cube, out_dir)
+            task.update(status='ok', summary=summary,
+                        files=[os.path.relpath(u.lstrip('/'), run_dir) for u in urls if u])
+        except Exception as e:
+            task.update(status='error', error=str(e))
+        task['seconds'] = time.perf_counter() - task_started
+        tasks.append(task)
+
+    return {
+        'dataset': csv_path,
+        'status': 'ok' if all(t['status'] == 'ok' for t in tasks) else 'partial',
+        'date_col': date_col,
+        'value_col': value_col,
+        'parse_seconds': parse_seconds,
+        'prepare_seconds': prepare_seconds,
+        'seconds': time.perf_counter() - started,
+        'tasks': tasks,
+    }
+
+
+def _check_reports(reports):
+    reports = reports or REPORT_TYPES
+    unknown = [r for r in reports if r not in REPORT_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown report types: {unknown}. Choose from {REPORT_TYPES}.")
+    return reports
+
+
+def _new_run_id():
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def run_batch(datasets, reports=None, workers=None, runs_dir=RUNS_DIR, run_id=None):
+    """Fan datasets out over a process pool and write a manifest for the run.
+
+    Forks worker processes, so call it from a single-threaded process (the
+    CLI); threaded callers should use run_batch_subprocess.
+    """
+    reports = _check_reports(reports)
+    run_id = run_id or _new_run_id()
+    run_dir = os.path.join(runs_dir, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_dataset, path, reports, run_dir) for path in datasets]
+        for future in as_completed(futures):
+            results.append(future.result())
+    elapsed = time.perf_counter() - started
+
+    results.sort(key=lambda r: r['dataset'])
+    task_count = sum(len(r['tasks']) for r in results)
+    manifest = {
+        'run_id': run_id,
+        'run_dir': run_dir,
+        'reports': reports,
+        'workers': workers or os.cpu_count(),
+        'datasets': len(results),
+        'tasks': task_count,
+        'failed_tasks': sum(1 for r in results for t in r['tasks'] if t['status'] != 'ok'),
+        'failed_datasets': sum(1 for r in results if r['status'] == 'error'),
+        'seconds': elapsed,
+        'datasets_per_second': len(results) / elapsed if elapsed else None,
+        'tasks_per_second': task_count / elapsed if elapsed else None,
+        'results': results,
+    }
+    with open(os.path.join(run_dir, 'manifest.json'), 'w', encoding='utf-8') as fh:
+        json.dump(manifest, fh, indent=2, default=str)
+    return manifest
+
+
+def run_batch_subprocess(datasets, reports=None, workers=None, runs_dir=RUNS_DIR):
+    """run_batch in a fresh `python batch.py` process; returns its manifest."""
+    reports = _check_reports(reports)
+    run_id = _new_run_id()
+    cmd = [sys.executable, os.path.abspath(__file__), *datasets, '--reports', *reports,
+           '--out', runs_dir, '--run-id', run_id]
+    if workers:
+        cmd += ['--workers', str(int(workers))]
+    returncode = subprocess.call(cmd)
+    manifest_path = os.path.join(runs_dir, run_id, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        raise RuntimeError(f"Batch runner exited with status {returncode} without writing a manifest.")
+    with open(manifest_path, encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate CFO report packs for many datasets.")
+    parser.add_argument('datasets', nargs='*', help="CSV files or glob patterns (default: uploads/*.csv)")
+    parser.add_argument('--reports', nargs='+', default=REPORT_TYPES, choices=REPORT_TYPES)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--out', default=RUNS_DIR, help="Directory for run outputs")
+    parser.add_argument('--run-id', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    patterns = args.datasets or [os.path.join('uploads', '*.csv')]
+    # Existing paths are taken literally, so file names with glob characters still work
+    datasets = sorted({path for pattern in patterns
+                       for path in ([pattern] if os.path.exists(pattern) else glob.glob(pattern))})
+    if not datasets:
+        print("ERROR: No datasets matched.")
+        return 1
+
+    print(f"INFO: Running {len(args.reports)} report(s) across {len(datasets)} dataset(s)...")
+    manifest = run_batch(datasets, args.reports, args.workers, args.out, args.run_id)
+    for result in manifest['results']:
+        timings = ', '.join(f"{t['report']}={t['seconds']:.2f}s" for t in result['tasks'])
+        print(f"  {result['status']:>7}  {os.path.basename(result['dataset'])}  "
+              f"({result['seconds']:.2f}s; {timings or result.get('error', '')})")
+    print(f"SUCCESS: {manifest['tasks']} task(s) in {manifest['seconds']:.2f}s "
+          f"({manifest['tasks_per_second']:.1f} tasks/s). Manifest: "
+          f"{os.path.join(manifest['run_dir'], 'manifest.json')}")
+    return 0 if not manifest['failed_tasks'] and not manifest['failed_datasets'] else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
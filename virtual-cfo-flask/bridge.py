@@ -0,0 +1,306 @@
+"""Period-over-period P&L bridges (profit walks) at any grain and dimension.
+
+pnl_bridges() walks profit from each period to the next for every pair of
+consecutive periods at once:
+
+    Volume        change in units at last period's average price
+    Mix           shift of units between segments of the dimension (e.g. Region)
+    Price         change in unit prices within each segment
+    COGS volume   COGS change explained by the unit change
+    COGS rate     change in unit cost
+    <cost line>   every other cost column, one step each
+    Other         whatever the columns above don't explain, so each bridge ties out
+
+Without a units column, revenue is one step per segment (or a single
+"Revenue" step without a dimension). The inputs are one period x segment
+table of sums, taken from the rollup cube when it has the grain and
+dimension, otherwise from a single grouped pass over the CSV, so a year of
+monthly bridges by region costs the same as one.
+"""
+import re
+import numpy as np
+import pandas as pd
+
+from tracing import span, traced
+from rollups import reduce_table, infer_date_format, parse_dates
+
+# Bridge grains, mapped to pandas period frequencies
+GRAINS = {'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q', 'yearly': 'Y'}
+# Cube grain each bridge grain is read from (yearly is re-aggregated from quarters)
+CUBE_GRAINS = {'weekly': 'weekly', 'monthly': 'monthly', 'quarterly': 'quarterly', 'yearly': 'quarterly'}
+GRAIN_WORDS = [
+    ('weekly', r'\b(?:week|weekly|wow)\b'),
+    ('quarterly', r'\b(?:quarter|quarterly|qoq|q[1-4])\b'),
+    ('yearly', r'\b(?:year|yearly|annual|annually|yoy|fy)\b'),
+    ('monthly', r'\b(?:month|monthly|mom)\b'),
+]
+BRIDGE_PATTERN = re.compile(r"\b(?:bridge|p&l walk|pnl walk|profit walk|price[/ ,-]*volume|volume[/ ,-]*price|pvm)\b")
+# Segments shown as separate revenue steps when there is no units column
+MAX_SEGMENT_STEPS = 6
+
+# Column roles, matched on snake_case names: exact names in priority order first
+REVENUE_NAMES = ['revenue', 'total_revenue', 'net_revenue', 'net_sales', 'sales', 'total_sales', 'gross_sales',
+                 'turnover']
+UNITS_NAMES = ['units', 'units_sold', 'quantity', 'qty', 'volume', 'total_orders', 'orders', 'order_count',
+               'products_sold', 'product_sold']
+COGS_NAMES = ['cogs', 'cost_of_goods_sold', 'cost_of_sales', 'cost_of_goods']
+PROFIT_NAMES = ['operating_income', 'operating_income_ebit', 'ebit', 'operating_profit', 'net_profit_loss',
+                'net_profit', 'net_income', 'profit']
+COST_WORDS = ['salar', 'wage', 'payroll', 'rent', 'utilit', 'marketing', 'advertis', 'ad_spend', 'platform_fee',
+              'r_d', 'research', 'opex', 'operating_exp', 'overhead', 'fixed_cost', 'shipping', 'logistic',
+              'commission', 'software', 'expense']
+NOT_COST_WORDS = ['interest', 'loan', 'debt', 'tax', 'capex', 'cash', 'budget', 'ratio', 'margin', 'pct',
+                  'percent', 'rate', 'growth', 'efficiency', 'per_']
+
+_roles_cache = {}
+
+
+# --- Column roles ---
+def _snake(name):
+    return re.sub(r'[^a-z0-9]+', '_', str(name).lower()).strip('_')
+
+
+def _pick(names, by_snake, fallback_words=()):
+    for name in names:
+        if name in by_snake:
+            return by_snake[name]
+    for word in fallback_words:
+        for snake, col in by_snake.items():
+            if word in snake and not any(w in snake for w in NOT_COST_WORDS):
+                return col
+    return None
+
+
+def column_roles(numeric_cols):
+    """Which numeric columns are revenue, units, COGS, other costs and profit.
+
+    Cached per column list, so repeated bridges over one schema skip the
+    matching. Totals like Total_OpEx are used only when no component cost
+    columns exist, so costs are not counted twice.
+    """
+    key = tuple(numeric_cols)
+    roles = _roles_cache.get(key)
+    if roles is not None:
+        return roles
+    by_snake = {}
+    for col in numeric_cols:
+        by_snake.setdefault(_snake(col), col)
+    revenue = _pick(REVENUE_NAMES, by_snake, ['revenue', 'sales'])
+    units = _pick(UNITS_NAMES, by_snake)
+    cogs = _pick(COGS_NAMES, by_snake, ['cogs', 'cost_of_goods'])
+    profit = _pick(PROFIT_NAMES, by_snake, ['operating_income', 'ebit', 'profit'])
+    taken = {revenue, units, cogs, profit}
+    costs = [col for snake, col in by_snake.items()
+             if col not in taken and any(w in snake for w in COST_WORDS)
+             and not any(w in snake for w in NOT_COST_WORDS)]
+    components = [c for c in costs if not _snake(c).startswith('total')]
+    roles = {'revenue': revenue, 'units': units, 'cogs': cogs, 'costs': components or costs, 'profit': profit}
+    _roles_cache[key] = roles
+    return roles
+
+
+def _role_columns(roles):
+    cols = [roles['revenue'], roles['units'], roles['cogs'], *roles['costs'], roles['profit']]
+    return [c for c in cols if c]
+
+
+# --- Period x segment sums ---
+def _from_cube(cube, grain, dimension, columns):
+    if dimension is not None and dimension not in cube['meta']['dimensions']:
+        return None
+    if any(c not in cube['meta']['numeric_cols'] for c in columns):
+        return None
+    table = cube['tables'].get((CUBE_GRAINS[grain], dimension))
+    if table is None:
+        return None
+    table = table[[(c, s) for c in columns for s in ('sum', 'count')]]
+    if grain == 'yearly':
+        period = table.index.get_level_values('period').asfreq('Y').rename('period')
+        by = [period] if dimension is None else [period, table.index.get_level_values(dimension)]
+        table = reduce_table(table, by)
+    sums = table.xs('sum', axis=1, level='stat')
+    return sums[columns].astype(float)
+
+
+def _from_csv(csv_path, date_col, grain, dimension, columns):
+    usecols = [date_col] + ([dimension] if dimension else []) + columns
+    df = pd.read_csv(csv_path, usecols=usecols)
+    dates = parse_dates(df[date_col], infer_date_format(df[date_col]))
+    keys = [dates.dt.to_period(GRAINS[grain]).rename('period')]
+    if dimension:
+        keys.append(df[dimension])
+    values = df[columns].apply(pd.to_numeric, errors='coerce')
+    return values.groupby(keys, sort=True, dropna=True).sum().astype(float)
+
+
+def period_table(csv_path, date_col, roles, grain='monthly', dimension=None, cube=None):
+    """Sums of the role columns per (period[, dimension]), from the cube when it can answer."""
+    columns = _role_columns(roles)
+    table = None
+    if cube is not None:
+        with span('bridge_cube'):
+            table = _from_cube(cube, grain, dimension, columns)
+    if table is None:
+        with span('bridge_csv'):
+            table = _from_csv(csv_path, date_col, grain, dimension, columns)
+    return table
+
+
+# --- Bridges ---
+def _matrix(table, col, dimension, periods, segments):
+    """(periods x segments) array of one column."""
+    if dimension is None:
+        return table[col].to_numpy()[:, None]
+    return table[col].unstack(dimension).reindex(index=periods, columns=segments).fillna(0.0).to_numpy()
+
+
+def _revenue_steps(rev, units, segments, dimension):
+    """[(label, per-bridge values)] for the revenue part of the walk."""
+    r0, r1 = rev[:-1], rev[1:]
+    dr = r1.sum(axis=1) - r0.sum(axis=1)
+    if units is None:
+        if dimension is None:
+            return [('Revenue', dr)]
+        change = r1 - r0
+        order = np.argsort(-np.abs(change).sum(axis=0), kind='stable')
+        shown = order[:MAX_SEGMENT_STEPS]
+        steps = [(f"{segments[j]} revenue", change[:, j]) for j in shown]
+        rest = order[MAX_SEGMENT_STEPS:]
+        if len(rest):
+            steps.append((f"Other {dimension} revenue", change[:, rest].sum(axis=1)))
+        return steps
+
+    q0, q1 = units[:-1], units[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p0 = np.where(q0 > 0, r0 / q0, np.nan)
+        p1 = np.where(q1 > 0, r1 / q1, np.nan)
+    # Segments new (or gone) in a period are valued at the price of the period they exist in
+    p0, p1 = np.where(np.isnan(p0), p1, p0), np.where(np.isnan(p1), p0, p1)
+    p0 = np.nan_to_num(p0)
+    tq0, tq1 = q0.sum(axis=1), q1.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg0 = np.where(tq0 > 0, r0.sum(axis=1) / tq0, 0.0)
+    based = tq0 > 0
+    volume = np.where(based, (tq1 - tq0) * avg0, dr)
+    mix = np.where(based, (q1 * p0).sum(axis=1) - tq1 * avg0, 0.0)
+    # Price also absorbs revenue booked without units, so revenue always ties out
+    price = dr - volume - mix
+    if dimension is None:
+        return [('Volume', volume), ('Price', price)]
+    return [('Volume', volume), (f"Mix ({dimension})", mix), ('Price', price)]
+
+
+def _cogs_steps(cogs, units, name):
+    c0, c1 = cogs[:-1].sum(axis=1), cogs[1:].sum(axis=1)
+    if units is None:
+        return [(name, -(c1 - c0))]
+    q0, q1 = units[:-1].sum(axis=1), units[1:].sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        volume = np.where(q0 > 0, (q1 - q0) * c0 / q0, c1 - c0)
+    return [(f"{name} volume", -volume), (f"{name} rate", -(c1 - c0 - volume))]
+
+
+def compute_bridges(table, roles, dimension=None):
+    """Bridges between every pair of consecutive periods in a period_table.
+
+    Returns (periods, start, end, steps): profit per period, and
+    [(label, array of one value per bridge)] with each step's effect on profit.
+    """
+    periods = table.index.get_level_values('period').unique().sort_values()
+    segments = list(table.index.get_level_values(dimension).unique()) if dimension else [None]
+    matrix = {c: _matrix(table, c, dimension, periods, segments) for c in _role_columns(roles)}
+    rev = matrix[roles['revenue']]
+    units = matrix[roles['units']] if roles['units'] else None
+    steps = _revenue_steps(rev, units, segments, dimension)
+    cost_total = np.zeros(len(periods))
+    if roles['cogs']:
+        steps += _cogs_steps(matrix[roles['cogs']], units, roles['cogs'])
+        cost_total += matrix[roles['cogs']].sum(axis=1)
+    for col in roles['costs']:
+        per_period = matrix[col].sum(axis=1)
+        steps.append((col, -np.diff(per_period)))
+        cost_total += per_period
+    if roles['profit']:
+        profit = matrix[roles['profit']].sum(axis=1)
+    else:
+        profit = rev.sum(axis=1) - cost_total
+    other = np.diff(profit) - np.sum([v for _, v in steps], axis=0)
+    scale = max(float(np.abs(profit).max(initial=0.0)), 1.0)
+    if np.abs(other).max(initial=0.0) > 1e-9 * scale:
+        steps.append(('Other', other))
+    return periods, profit[:-1], profit[1:], steps
+
+
+@traced('pnl_bridge')
+def pnl_bridges(csv_path, date_col, cube=None, grain='monthly', dimension=None, last=None):
+    """Profit bridges for consecutive periods at a grain, optionally split by a dimension.
+
+    Returns {'grain', 'dimension', 'roles', 'notes', 'bridges': [{'from', 'to',
+    'start', 'end', 'steps': [{'name', 'value'}]}, ...]}, oldest first and at
+    most `last` bridges. Raises ValueError when the data can't support a bridge.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"Unknown grain '{grain}'. Choose from {list(GRAINS)}.")
+    if not date_col:
+        raise ValueError("A P&L bridge needs a date column to compare periods.")
+    if cube is not None:
+        numeric_cols = cube['meta']['numeric_cols']
+        categorical_cols = cube['meta']['categorical_cols']
+    else:
+        head = pd.read_csv(csv_path, nrows=200)
+        numeric_cols = head.select_dtypes(include=[np.number]).columns.tolist()
+        categorical_cols = [c for c in head.columns if c not in numeric_cols]
+    if dimension is not None and (dimension == date_col or dimension not in categorical_cols):
+        raise ValueError(f"'{dimension}' is not a categorical column of this dataset.")
+    roles = column_roles(numeric_cols)
+    if not roles['revenue'] or not (roles['cogs'] or roles['costs'] or roles['profit']):
+        raise ValueError("Cannot build a P&L bridge: revenue and cost or profit columns not found in the dataset.")
+
+    table = period_table(csv_path, date_col, roles, grain, dimension, cube)
+    periods, start, end, steps = compute_bridges(table, roles, dimension) if len(table) else ([], [], [], [])
+    if len(periods) < 2:
+        raise ValueError(f"Need at least two {grain} periods of data for a bridge.")
+    notes = []
+    if not roles['units']:
+        notes.append("No units column found, so revenue is not split into volume, mix and price.")
+    if not roles['profit']:
+        notes.append("No profit column found; profit is revenue minus the cost columns.")
+    labels = [str(p) for p in periods]
+    first = 0 if last is None else max(len(labels) - 1 - last, 0)
+    bridges = [{
+        'from': labels[i],
+        'to': labels[i + 1],
+        'start': float(start[i]),
+        'end': float(end[i]),
+        'steps': [{'name': name, 'value': float(values[i])} for name, values in steps],
+    } for i in range(first, len(labels) - 1)]
+    return {'grain': grain, 'dimension': dimension, 'roles': roles, 'notes': notes, 'bridges': bridges}
+
+
+# --- Prompt parsing / text ---
+def parse_bridge_request(prompt, dimensions):
+    """(grain, dimension) named in a bridge question; monthly and no dimension by default."""
+    text = prompt.lower()
+    grain = next((g for g, pattern in GRAIN_WORDS if re.search(pattern, text)), 'monthly')
+    dimension = None
+    for dim in dimensions:
+        words = _snake(dim).replace('_', ' ')
+        if re.search(rf"\b(?:by|per|across|for each)\s+(?:\w+\s+)?{re.escape(words)}", text.replace('_', ' ')):
+            dimension = dim
+            break
+    return grain, dimension
+
+
+def summarize(result):
+    """Plain-text description of the latest bridge (the chat formatter adds emphasis)."""
+    bridge = result['bridges'][-1]
+    change = bridge['end'] - bridge['start']
+    by = f" by {result['dimension']}" if result['dimension'] else ""
+    lines = [f"P&L bridge{by}, {bridge['from']} to {bridge['to']}: profit moved from {bridge['start']:,.0f} "
+             f"to {bridge['end']:,.0f} ({change:+,.0f})."]
+    ranked = sorted(bridge['steps'], key=lambda s: -abs(s['value']))
+    lines += [f"- {s['name']}: {s['value']:+,.0f}" for s in ranked[:5] if s['value']]
+    if len(result['bridges']) > 1:
+        lines.append(f"{len(result['bridges'])} {result['grain']} bridges are available as data.")
+    lines += result['notes']
+    return "\n".join(lines)
@@ -0,0 +1,418 @@
+"""Chart data for client-side rendering: the numbers behind each chart, no PNG.
+
+build_chart_data returns compact, column-oriented payloads for every chart
+type charts.generate_chart draws, aggregated on the server (from the rollup
+cube where it can answer) and downsampled to at most max_points:
+
+    line / area   value per period (grain auto-picked to fit max_points, then
+                  largest-triangle-three-buckets downsampling), with optional
+                  forecast, roc and anomalies overlays computed on that series
+    bar / pie     top categories by total value (pie adds an "Other" slice)
+    scatter       the first two numeric columns, evenly sampled
+    box           five-number summary and whiskers per numeric column
+    heatmap       Pearson matrix of up to HEATMAP_MAX_COLUMNS numeric columns
+    waterfall     the same revenue -> costs -> final steps as the PNG
+    bridge        period-over-period P&L bridges (grain incl. yearly; category
+                  is the dimension), the last max_points bridges in long form
+
+Payloads are deterministic for a dataset fingerprint and parameters, so
+chart_data_etag() can answer conditional GETs without computing anything.
+"""
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from tracing import span, traced
+from rollups import dataset_fingerprint, period_series, category_totals
+from charts import waterfall_steps
+
+try:
+    from bridge import pnl_bridges, GRAINS as BRIDGE_GRAINS
+except Exception:
+    pnl_bridges = None
+
+try:
+    import pyarrow as pa
+except Exception:
+    pa = None
+
+try:
+    from outofcore import use_out_of_core, sample_rows, pearson_corr_chunked
+except Exception:
+    use_out_of_core = None
+
+# Bump when the payload layout changes, so clients don't revalidate stale shapes
+CHART_DATA_VERSION = 1
+CHART_TYPES = ('line', 'area', 'bar', 'pie', 'scatter', 'box', 'heatmap', 'waterfall', 'bridge')
+OVERLAYS = ('forecast', 'roc', 'anomalies')
+GRAINS = ('daily', 'weekly', 'monthly', 'quarterly')
+PERIOD_FREQ = {'daily': 'D', 'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q'}
+DEFAULT_MAX_POINTS = 1000
+MAX_POINTS_LIMIT = 10000
+HEATMAP_MAX_COLUMNS = 40
+TOP_BARS = 10
+TOP_SLICES = 6
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_ENTRIES = 64
+
+
+class ArrowUnavailable(ValueError):
+    pass
+
+
+# --- Parameters / ETag ---
+def _negotiate_format(accept):
+    """'arrow' when the client asks for it and pyarrow is installed; JSON when the
+    client also takes JSON (or anything), so only an Arrow-only Accept can 406."""
+    if ARROW_MIMETYPE not in accept:
+        return 'json'
+    if pa is not None:
+        return 'arrow'
+    types = {part.split(';')[0].strip().lower() for part in accept.split(',')}
+    return 'json' if types & {'application/json', 'application/*', '*/*'} else 'arrow'
+
+
+def parse_params(args, accept=''):
+    """Validate query arguments; raises ValueError with a user-facing message."""
+    chart_type = args.get('type', 'line').lower()
+    if chart_type not in CHART_TYPES:
+        raise ValueError(f"Unknown chart type '{chart_type}'. Choose from {list(CHART_TYPES)}.")
+    grain = args.get('grain', 'auto').lower()
+    grains = list(BRIDGE_GRAINS) if chart_type == 'bridge' and pnl_bridges is not None else list(GRAINS)
+    if grain != 'auto' and grain not in grains:
+        raise ValueError(f"Unknown grain '{grain}'. Choose 'auto' or one of {grains}.")
+    try:
+        max_points = int(args.get('max_points', DEFAULT_MAX_POINTS))
+        horizon = int(args.get('horizon', 12))
+    except ValueError:
+        raise ValueError("max_points and horizon must be integers.")
+    overlays = sorted({o.strip().lower() for o in args.get('overlays', '').split(',') if o.strip()})
+    unknown = [o for o in overlays if o not in OVERLAYS]
+    if unknown:
+        raise ValueError(f"Unknown overlay(s) {unknown}. Choose from {list(OVERLAYS)}.")
+    fmt = args.get('format') or _negotiate_format(accept or '')
+    if fmt not in ('json', 'arrow'):
+        raise ValueError("format must be 'json' or 'arrow'.")
+    if fmt == 'arrow' and pa is None:
+        raise ArrowUnavailable("Arrow output needs the pyarrow package; use format=json.")
+    return {
+        'type': chart_type,
+        'grain': grain,
+        'max_points': min(max(max_points, 10), MAX_POINTS_LIMIT),
+        'overlays': overlays,
+        'horizon': min(max(horizon, 1), 365),
+        'value': args.get('value') or None,
+        'category': args.get('category') or None,
+        'format': fmt,
+    }
+
+
+def chart_data_etag(csv_path, params):
+    key = json.dumps([CHART_DATA_VERSION, dataset_fingerprint(csv_path), params], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+
+# --- Downsampling ---
+def lttb(x, y, n_out):
+    """Indices of the points largest-triangle-three-buckets keeps (first and last always)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = [0]
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        nxt_lo, nxt_hi = edges[b + 1], edges[b + 2] if b + 2 < len(edges) else n
+        avg_x, avg_y = x[nxt_lo:nxt_hi].mean(), y[nxt_lo:nxt_hi].mean()
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        area = np.abs((ax - avg_x) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (avg_y - ay))
+        keep.append(lo + int(area.argmax()))
+    keep.append(n - 1)
+    return np.asarray(keep)
+
+
+def _even_sample(df, n_out):
+    if len(df) <= n_out:
+        return df
+    return df.iloc[np.linspace(0, len(df) - 1, n_out).astype(int)]
+
+
+# --- Helpers ---
+def _num(values, digits=4):
+    """JSON-safe list of rounded floats (None for NaN)."""
+    arr = np.round(np.asarray(values, dtype=np.float64), digits)
+    return [None if np.isnan(v) else float(v) for v in arr]
+
+
+def _labels(index):
+    if isinstance(index, pd.DatetimeIndex):
+        return index.strftime('%Y-%m-%d').tolist()
+    return [str(v) for v in index]
+
+
+def _load(csv_path, columns=None):
+    with span('csv_parse'):
+        return pd.read_csv(csv_path, usecols=columns)
+
+
+def _numeric_cols(csv_path, cube):
+    if cube is not None:
+        return list(cube['meta']['numeric_cols'])
+    return pd.read_csv(csv_path, nrows=200).select_dtypes(include=[np.number]).columns.tolist()
+
+
+def _is_large(csv_path):
+    return use_out_of_core is not None and use_out_of_core(csv_path)
+
+
+# --- Time series (line / area) ---
+def _series(csv_path, date_col, value_col, cube, grain, max_points):
+    """(series, grain): value_col summed per period at the requested or auto grain."""
+    if not date_col:
+        y = pd.to_numeric(_load(csv_path, [value_col])[value_col], errors='coerce')
+        return y.reset_index(drop=True), 'row'
+    if cube is None:
+        df = _load(csv_path, [date_col, value_col])
+        dates = pd.to_datetime(df[date_col], errors='coerce')
+        values = pd.to_numeric(df[value_col], errors='coerce')[dates.notna()]
+        dates = dates[dates.notna()]
+    for g in ([grain] if grain != 'auto' else GRAINS):
+        if cube is not None:
+            s = period_series(cube, value_col, g)
+        else:
+            s = values.groupby(dates.dt.to_period(PERIOD_FREQ[g])).sum(min_count=1)
+            s.index = s.index.to_timestamp()
+        s = s.dropna() if s is not None else None
+        if s is not None and (grain != 'auto' or len(s) <= max_points):
+            break
+    if s is None:
+        raise ValueError(f"No {g} series available for '{value_col}'.")
+    return s, g
+
+
+def _overlays(series, names, horizon):
+    out = {}
+    if 'forecast' in names and len(series) >= 3:
+        # Same recent-window linear trend as predict_timeseries, on the charted series
+        values = series.to_numpy(dtype=np.float64)
+        window = int(min(max(10, horizon * 2), len(values)))
+        x = np.arange(window, dtype=float)
+        try:
+            slope, intercept = np.polyfit(x, values[-window:], 1)
+        except Exception:
+            slope, intercept = 0.0, float(values[-1])
+        future = slope * np.arange(window, window + horizon, dtype=float) + intercept
+        if isinstance(series.index, pd.DatetimeIndex):
+            freq = pd.infer_freq(series.index[-min(len(series), 50):]) or 'D'
+            periods = _labels(pd.date_range(series.index[-1], periods=horizon + 1, freq=freq)[1:])
+        else:
+            periods = [str(i) for i in range(len(series), len(series) + horizon)]
+        out['forecast'] = {'x': periods, 'y': _num(future)}
+    if 'roc' in names:
+        roc = series.pct_change().mul(100.0).replace([np.inf, -np.inf], np.nan)
+        out['roc'] = {'x': _labels(roc.index[1:]), 'y': _num(roc.iloc[1:], 2), 'unit': '%'}
+    if 'anomalies' in names and len(series) >= 4:
+        q1, q3 = np.percentile(series.to_numpy(dtype=np.float64), [25, 75])
+        lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        flagged = series[(series < lower) | (series > upper)]
+        out['anomalies'] = {'x': _labels(flagged.index), 'y': _num(flagged), 'bounds': _num([lower, upper])}
+    return out
+
+
+def _time_series(csv_path, date_col, value_col, cube, params):
+    series, grain = _series(csv_path, date_col, value_col, cube, params['grain'], params['max_points'])
+    source_points = len(series)
+    overlays = _overlays(series, params['overlays'], params['horizon'])
+    if source_points > params['max_points']:
+        x = series.index.asi8 if isinstance(series.index, pd.DatetimeIndex) else np.arange(source_points)
+        series = series.iloc[lttb(np.asarray(x, dtype=np.float64), series.to_numpy(dtype=np.float64), params['max_points'])]
+    x_name = date_col if grain != 'row' else 'row'
+    return {
+        'x': x_name, 'y': value_col, 'grain': grain,
+        'data': {x_name: _labels(series.index), value_col: _num(series)},
+        'source_points': int(source_points),
+        'overlays': overlays,
+    }
+
+
+# --- Categories (bar / pie) ---
+def _categories(csv_path, date_col, value_col, cube, params):
+    # Same default category as the PNG: the first non-numeric column other than the date
+    if cube is not None:
+        candidates = cube['meta']['categorical_cols']
+    else:
+        sample = pd.read_csv(csv_path, nrows=200)
+        candidates = [c for c in sample.columns if c != date_col and not pd.api.types.is_numeric_dtype(sample[c])]
+    category = params['category'] or (candidates[0] if candidates else None)
+    if category is None:
+        raise ValueError(f"No categorical column found for a {params['type']} chart.")
+    if category not in candidates and category != date_col:
+        raise ValueError(f"'{category}' is not a categorical column of this dataset.")
+    totals = category_totals(cube, category, value_col) if cube is not None else None
+    if totals is None:
+        df = _load(csv_path, [category, value_col])
+        totals = pd.to_numeric(df[value_col], errors='coerce').groupby(df[category]).sum()
+    totals = totals.sort_values(ascending=False)
+    top = totals.head(TOP_BARS if params['type'] == 'bar' else TOP_SLICES)
+    names, values = _labels(top.index), _num(top)
+    if params['type'] == 'pie' and len(totals) > len(top):
+        names.append('Other')
+        values += _num([totals.iloc[len(top):].sum()])
+    return {'x': category, 'y': value_col, 'data': {'name': names, 'value': values},
+            'source_points': int(len(totals))}
+
+
+# --- Distributions / relationships ---
+def _numeric_frame(csv_path, columns, cube, max_rows=None):
+    if _is_large(csv_path):
+        return sample_rows(csv_path, columns, max_points=max_rows or 200000), True
+    return _load(csv_path, columns), False
+
+
+def _scatter(csv_path, cube, params):
+    num_cols = _numeric_cols(csv_path, cube)
+    if len(num_cols) < 2:
+        raise ValueError("Not enough numeric columns for a scatter chart.")
+    x_col, y_col = num_cols[:2]
+    df, sampled = _numeric_frame(csv_path, [x_col, y_col], cube, params['max_points'])
+    source_points = len(df)
+    df = _even_sample(df, params['max_points'])
+    return {'x': x_col, 'y': y_col, 'data': {x_col: _num(df[x_col]), y_col: _num(df[y_col])},
+            'source_points': int(source_points), 'sampled': sampled or len(df) < source_points}
+
+
+def _box(csv_path, cube, params):
+    num_cols = _numeric_cols(csv_path, cube)
+    if not num_cols:
+        raise ValueError("No numeric columns for a box chart.")
+    df, sampled = _numeric_frame(csv_path, num_cols, cube)
+    values = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    q = values.quantile([0, 0.25, 0.5, 0.75, 1.0])
+    iqr = q.loc[0.75] - q.loc[0.25]
+    lo_fence, hi_fence = q.loc[0.25] - 1.5 * iqr, q.loc[0.75] + 1.5 * iqr
+    inside = values.where((values >= lo_fence) & (values <= hi_fence))
+    outliers = ((values < lo_fence) | (values > hi_fence)).sum()
+    return {'data': {
+        'column': num_cols,
+        'min': _num(q.loc[0.0]), 'q1': _num(q.loc[0.25]), 'median': _num(q.loc[0.5]),
+        'q3': _num(q.loc[0.75]), 'max': _num(q.loc[1.0]),
+        'whisker_low': _num(inside.min()), 'whisker_high': _num(inside.max()),
+        'outliers': [int(v) for v in outliers],
+    }, 'source_points': int(len(values)), 'sampled': sampled}
+
+
+def _heatmap(csv_path, cube, params):
+    num_cols = _numeric_cols(csv_path, cube)
+    if len(num_cols) < 2:
+        raise ValueError("Not enough numeric columns for a heatmap.")
+    shown = num_cols[:HEATMAP_MAX_COLUMNS]
+    if _is_large(csv_path):
+        corr = pearson_corr_chunked(csv_path, shown)
+    else:
+        corr = _load(csv_path, shown)[shown].corr()
+    return {'data': {'column': shown, 'matrix': [_num(row, 3) for row in corr.to_numpy()]},
+            'source_points': len(num_cols), 'truncated': len(shown) < len(num_cols)}
+
+
+def _waterfall(csv_path, cube, params):
+    if cube is not None:
+        # One row of column totals has the same sums and dtypes as the full file
+        total = cube['tables'].get(('total', None))
+        df = pd.DataFrame({c: [float(total[(c, 'sum')].iloc[0])] for c in cube['meta']['numeric_cols']})
+    else:
+        df = _load(csv_path)
+    steps = waterfall_steps(df)
+    if steps is None:
+        raise ValueError("Cannot build a waterfall: required columns like Revenue and COGS/OpEx not found.")
+    values = [v for _, v in steps]
+    base = [0.0] + list(np.cumsum(values[:-2])) + [0.0]
+    return {'data': {'name': [name for name, _ in steps], 'value': _num(values), 'base': _num(base)},
+            'source_points': len(steps)}
+
+
+def _bridge(csv_path, date_col, cube, params):
+    if pnl_bridges is None:
+        raise ValueError("P&L bridges are unavailable.")
+    grain = 'monthly' if params['grain'] == 'auto' else params['grain']
+    result = pnl_bridges(csv_path, date_col, cube, grain, params['category'], last=params['max_points'])
+    data = {'period': [], 'name': [], 'value': [], 'base': []}
+    for bridge in result['bridges']:
+        steps = [(bridge['from'], bridge['start'])] + [(s['name'], s['value']) for s in bridge['steps']]
+        steps.append((bridge['to'], bridge['end']))
+        values = [v for _, v in steps]
+        data['period'] += [f"{bridge['from']}..{bridge['to']}"] * len(steps)
+        data['name'] += [name for name, _ in steps]
+        data['value'] += _num(values)
+        data['base'] += _num([0.0] + list(np.cumsum(values[:-2])) + [0.0])
+    return {'data': data, 'grain': grain, 'dimension': result['dimension'], 'notes': result['notes'],
+            'source_points': len(result['bridges'])}
+
+
+@traced('chart_data')
+def build_chart_data(csv_path, date_col, value_col, cube, params):
+    """The chart payload (dict) for validated params; raises ValueError when the
+    dataset can't support the chart."""
+    chart_type = params['type']
+    value_col = params['value'] or value_col
+    if chart_type in ('line', 'area', 'bar', 'pie'):
+        if not value_col:
+            raise ValueError(f"Could not identify a numeric value column for a {chart_type} chart.")
+        if value_col not in _numeric_cols(csv_path, cube):
+            raise ValueError(f"'{value_col}' is not a numeric column of this dataset.")
+    if chart_type in ('line', 'area'):
+        body = _time_series(csv_path, date_col, value_col, cube, params)
+    elif chart_type in ('bar', 'pie'):
+        body = _categories(csv_path, date_col, value_col, cube, params)
+    elif chart_type == 'scatter':
+        body = _scatter(csv_path, cube, params)
+    elif chart_type == 'box':
+        body = _box(csv_path, cube, params)
+    elif chart_type == 'heatmap':
+        body = _heatmap(csv_path, cube, params)
+    elif chart_type == 'bridge':
+        body = _bridge(csv_path, date_col, cube, params)
+    else:
+        body = _waterfall(csv_path, cube, params)
+    body.setdefault('overlays', {})
+    return {'chart': chart_type, 'version': CHART_DATA_VERSION, **body}
+
+
+def encode(payload, fmt):
+    """(bytes, mimetype). Arrow carries payload['data'] as the table and the rest
+    of the payload as JSON in the schema metadata."""
+    if fmt == 'arrow':
+        data = payload['data']
+        if payload['chart'] == 'heatmap':
+            data = {'column': data['column'], **{c: [row[i] for row in data['matrix']] for i, c in enumerate(data['column'])}}
+        meta = {k: v for k, v in payload.items() if k != 'data'}
+        table = pa.table(data).replace_schema_metadata({'chart': json.dumps(meta)})
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue(), ARROW_MIMETYPE
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8'), 'application/json'
+
+
+def cached(etag, build):
+    """Encoded body for an ETag, building it at most once per process."""
+    with _cache_lock:
+        hit = _cache.get(etag)
+        if hit is not None:
+            _cache.move_to_end(etag)
+            return hit
+    # Built outside the lock so one slow chart doesn't stall every other request;
+    # two concurrent misses on the same ETag build identical bodies
+    hit = build()
+    with _cache_lock:
+        _cache[etag] = hit
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return hit
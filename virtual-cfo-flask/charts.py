@@ -3,14 +3,139 @@ import pandas as pd
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
 
+from tracing import span, traced
+
+try:
+    from rollups import category_totals
+except Exception:
+    category_totals = None
+
 STATIC_DIR = 'static'
 os.makedirs(STATIC_DIR, exist_ok=True)
 
-def generate_chart(chart_type, csv_path, date_col=None, value_col=None):
-    df = pd.read_csv(csv_path)
+def _plot_bar(grouped, cat, value_col, out_dir=None):
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    sns.barplot(x=grouped.index, y=grouped.values, ax=ax)
+    ax.set_xticks(ax.get_xticks(), ax.get_xticklabels(), rotation=45, ha='right')
+    ax.set_title(f"{value_col} by {cat}")
+    ax.set_ylabel(value_col)
+    out_file = os.path.join(out_dir or STATIC_DIR, 'bar_chart.png')
+    fig.tight_layout()
+    with span('savefig'):
+        fig.savefig(out_file)
+    return f"Bar chart by {cat} generated.", f'/{out_file}'
+
+def _plot_pie(grouped, cat, value_col, out_dir=None):
+    fig = Figure(figsize=(7, 7))
+    ax = fig.subplots()
+    ax.pie(grouped.values, labels=grouped.index, autopct='%1.1f%%', startangle=140)
+    ax.set_title(f"{value_col} composition by {cat}")
+    out_file = os.path.join(out_dir or STATIC_DIR, 'pie_chart.png')
+    with span('savefig'):
+        fig.savefig(out_file)
+    return f"Pie chart generated.", f'/{out_file}'
+
+def _chart_from_rollup(chart_type, cube, value_col, out_dir=None):
+    """Serve bar/pie charts from a pre-aggregated rollup cube, or None to fall back."""
+    cat_cols = cube['meta']['categorical_cols']
+    if not cat_cols:
+        return f"No categorical column found for {chart_type} chart.", None
+    cat = cat_cols[0]
+    totals = category_totals(cube, cat, value_col)
+    if totals is None:
+        return None
+    if chart_type == 'bar':
+        return _plot_bar(totals.sort_values(ascending=False).head(10), cat, value_col, out_dir)
+    return _plot_pie(totals.sort_values(ascending=False).head(6), cat, value_col, out_dir)
+
+def waterfall_steps(df):
+    """[(label, value), ...] for revenue -> COGS -> OpEx -> final, or None if the
+    revenue column or both cost columns can't be found."""
+    lower_cols = {c.lower(): c for c in df.columns}
+    def find_col(candidates):
+        for key, orig in lower_cols.items():
+            if any(term in key for term in candidates):
+                if pd.api.types.is_numeric_dtype(df[orig]):
+                    return orig
+        return None
+
+    revenue_col = find_col(['revenue', 'sales', 'gross_sales', 'total_revenue', 'net_cash_in'])
+    cogs_col = find_col(['cogs', 'cost_of_goods', 'cost of goods', 'cost'])
+    opex_col = find_col(['opex', 'operating_exp', 'operating expenses', 'total_opex', 'expenses'])
+    final_col = find_col(['operating_income', 'ebit', 'net_income', 'profit'])
+
+    if not revenue_col or not (cogs_col or opex_col):
+        return None
+
+    rev_total = pd.to_numeric(df[revenue_col], errors='coerce').sum(skipna=True)
+    cogs_total = pd.to_numeric(df[cogs_col], errors='coerce').sum(skipna=True) if cogs_col else 0
+    opex_total = pd.to_numeric(df[opex_col], errors='coerce').sum(skipna=True) if opex_col else 0
+    if final_col:
+        final_total = pd.to_numeric(df[final_col], errors='coerce').sum(skipna=True)
+    else:
+        final_total = rev_total - cogs_total - opex_total
+
+    return [
+        (revenue_col, rev_total),
+        (cogs_col or 'COGS', -cogs_total),
+        (opex_col or 'OpEx', -opex_total),
+        (final_col or 'Operating_Income', final_total),
+    ]
+
+def _plot_waterfall(steps, title, filename, out_dir=None):
+    """Draw [(label, value), ...] whose first and last entries are totals and
+    whose middle entries float from the running total; returns the file path."""
+    labels = [name for name, _ in steps]
+    values = [val for _, val in steps]
+    # Middle bars start at the running total before them; the totals stand on zero
+    bottoms = [0] + list(np.cumsum(values[:-2])) + [0]
+
+    fig = Figure(figsize=(12, 6))
+
+    ax = fig.subplots()
+    colors = []
+    for i, v in enumerate(values):
+        if i == 0:
+            colors.append('#3b82f6')  # start
+        elif i == len(values) - 1:
+            colors.append('#22c55e')  # final
+        else:
+            colors.append('#ef4444' if v < 0 else '#22c55e')
+    ax.bar(range(len(values)), values, bottom=bottoms, color=colors)
+    ax.set_xticks(range(len(values)))
+    ax.set_xticklabels(labels, rotation=20, ha='right')
+    ax.set_title(title)
+    ax.grid(True, axis='y', alpha=0.3)
+    out_file = os.path.join(out_dir or STATIC_DIR, filename)
+    fig.tight_layout()
+    with span('savefig'):
+        fig.savefig(out_file)
+    return out_file
+
+def plot_bridge(result, out_dir=None):
+    """Waterfall PNG of the latest bridge from bridge.pnl_bridges."""
+    bridge = result['bridges'][-1]
+    steps = [(bridge['from'], bridge['start'])]
+    steps += [(s['name'], s['value']) for s in bridge['steps']]
+    steps.append((bridge['to'], bridge['end']))
+    by = f" by {result['dimension']}" if result['dimension'] else ""
+    out_file = _plot_waterfall(steps, f"P&L bridge{by}: {bridge['from']} to {bridge['to']}", 'pnl_bridge.png', out_dir)
+    return f'/{out_file}'
+
+@traced('generate_chart')
+def generate_chart(chart_type, csv_path, date_col=None, value_col=None, cube=None, df=None, out_dir=None):
+    if chart_type in ('bar', 'pie') and value_col and cube is not None and category_totals is not None:
+        result = _chart_from_rollup(chart_type, cube, value_col, out_dir)
+        if result is not None:
+            return result
+
+    if df is None:
+        with span('csv_parse'):
+            df = pd.read_csv(csv_path)
 
     if date_col and date_col in df.columns:
         df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
@@ -21,65 +146,52 @@ def generate_chart(chart_type, csv_path, date_col=None, value_col=None):
     if chart_type == 'line' and value_col:
         clean = df.dropna(subset=[date_col]) if date_col and date_col in df.columns else df
         clean = clean.sort_values(by=date_col) if date_col and date_col in clean.columns else clean
-        plt.figure(figsize=(12, 6))
+        fig = Figure(figsize=(12, 6))
+        ax = fig.subplots()
         x = clean[date_col] if date_col and date_col in clean.columns else np.arange(len(clean))
         y = clean[value_col]
-        plt.plot(x, y)
-        plt.title(f"{value_col} over time")
-        plt.xlabel(date_col if date_col and date_col in clean.columns else 'Index')
-        plt.ylabel(value_col)
-        out_file = os.path.join(STATIC_DIR, 'line_chart.png')
-        plt.grid(True, alpha=0.3)
-        plt.savefig(out_file)
-        plt.close()
+        ax.plot(x, y)
+        ax.set_title(f"{value_col} over time")
+        ax.set_xlabel(date_col if date_col and date_col in clean.columns else 'Index')
+        ax.set_ylabel(value_col)
+        out_file = os.path.join(out_dir or STATIC_DIR, 'line_chart.png')
+        ax.grid(True, alpha=0.3)
+        with span('savefig'):
+            fig.savefig(out_file)
         msg = f"Line chart for {value_col} generated."
 
     elif chart_type == 'bar' and value_col:
-        cat_cols = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
+        cat_cols = [c for c in df.columns if c != date_col and not pd.api.types.is_numeric_dtype(df[c])]
         if not cat_cols:
             return "No categorical column found for bar chart.", None
         cat = cat_cols[0]
         grouped = df.groupby(cat)[value_col].sum().sort_values(ascending=False).head(10)
-        plt.figure(figsize=(12, 6))
-        sns.barplot(x=grouped.index, y=grouped.values)
-        plt.xticks(rotation=45, ha='right')
-        plt.title(f"{value_col} by {cat}")
-        plt.ylabel(value_col)
-        out_file = os.path.join(STATIC_DIR, 'bar_chart.png')
-        plt.tight_layout()
-        plt.savefig(out_file)
-        plt.close()
-        msg = f"Bar chart by {cat} generated."
+        return _plot_bar(grouped, cat, value_col, out_dir)
 
     elif chart_type == 'pie' and value_col:
-        cat_cols = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
+        cat_cols = [c for c in df.columns if c != date_col and not pd.api.types.is_numeric_dtype(df[c])]
         if not cat_cols:
             return "No categorical column found for pie chart.", None
         cat = cat_cols[0]
         grouped = df.groupby(cat)[value_col].sum().sort_values(ascending=False).head(6)
-        plt.figure(figsize=(7, 7))
-        plt.pie(grouped.values, labels=grouped.index, autopct='%1.1f%%', startangle=140)
-        plt.title(f"{value_col} composition by {cat}")
-        out_file = os.path.join(STATIC_DIR, 'pie_chart.png')
-        plt.savefig(out_file)
-        plt.close()
-        msg = f"Pie chart generated."
+        return _plot_pie(grouped, cat, value_col, out_dir)
 
     elif chart_type == 'area' and value_col:
         clean = df.dropna(subset=[date_col]) if date_col and date_col in df.columns else df
         clean = clean.sort_values(by=date_col) if date_col and date_col in clean.columns else clean
-        plt.figure(figsize=(12, 6))
+        fig = Figure(figsize=(12, 6))
+        ax = fig.subplots()
         x = clean[date_col] if date_col and date_col in clean.columns else np.arange(len(clean))
         y = clean[value_col]
-        plt.fill_between(x, y, step=None, alpha=0.4)
-        plt.plot(x, y)
-        plt.title(f"Area chart for {value_col}")
-        plt.xlabel(date_col if date_col and date_col in clean.columns else 'Index')
-        plt.ylabel(value_col)
-        out_file = os.path.join(STATIC_DIR, 'area_chart.png')
-        plt.grid(True, alpha=0.3)
-        plt.savefig(out_file)
-        plt.close()
+        ax.fill_between(x, y, step=None, alpha=0.4)
+        ax.plot(x, y)
+        ax.set_title(f"Area chart for {value_col}")
+        ax.set_xlabel(date_col if date_col and date_col in clean.columns else 'Index')
+        ax.set_ylabel(value_col)
+        out_file = os.path.join(out_dir or STATIC_DIR, 'area_chart.png')
+        ax.grid(True, alpha=0.3)
+        with span('savefig'):
+            fig.savefig(out_file)
         msg = f"Area chart generated."
 
     elif chart_type == 'scatter':
@@ -87,107 +199,58 @@ def generate_chart(chart_type, csv_path, date_col=None, value_col=None):
         if len(num_cols) < 2:
             return "Not enough numeric columns for scatter plot.", None
         x_col, y_col = num_cols[:2]
-        plt.figure(figsize=(8, 6))
-        plt.scatter(df[x_col], df[y_col], alpha=0.6)
-        plt.title(f"Scatter: {y_col} vs {x_col}")
-        plt.xlabel(x_col)
-        plt.ylabel(y_col)
-        out_file = os.path.join(STATIC_DIR, 'scatter_plot.png')
-        plt.grid(True, alpha=0.3)
-        plt.savefig(out_file)
-        plt.close()
+        fig = Figure(figsize=(8, 6))
+        ax = fig.subplots()
+        ax.scatter(df[x_col], df[y_col], alpha=0.6)
+        ax.set_title(f"Scatter: {y_col} vs {x_col}")
+        ax.set_xlabel(x_col)
+        ax.set_ylabel(y_col)
+        out_file = os.path.join(out_dir or STATIC_DIR, 'scatter_plot.png')
+        ax.grid(True, alpha=0.3)
+        with span('savefig'):
+            fig.savefig(out_file)
         msg = f"Scatter plot generated."
 
     elif chart_type == 'box':
         num_cols = df.select_dtypes(include=[np.number]).columns.tolist()
         if not num_cols:
             return "No numeric columns for box plot.", None
-        plt.figure(figsize=(10, 6))
-        sns.boxplot(data=df[num_cols])
-        plt.title("Box plot of numeric columns")
-        out_file = os.path.join(STATIC_DIR, 'box_plot.png')
-        plt.tight_layout()
-        plt.savefig(out_file)
-        plt.close()
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        sns.boxplot(data=df[num_cols], ax=ax)
+        ax.set_title("Box plot of numeric columns")
+        out_file = os.path.join(out_dir or STATIC_DIR, 'box_plot.png')
+        fig.tight_layout()
+        with span('savefig'):
+            fig.savefig(out_file)
         msg = "Box plot generated."
 
     elif chart_type == 'heatmap':
         num_cols = df.select_dtypes(include=[np.number]).columns.tolist()
         if len(num_cols) < 2:
             return "Not enough numeric columns for heatmap.", None
-        plt.figure(figsize=(10, 8))
-        sns.heatmap(df[num_cols].corr(), annot=True, cmap='coolwarm', fmt='.2f')
-        plt.title('Correlation Heatmap')
-        out_file = os.path.join(STATIC_DIR, 'heatmap.png')
-        plt.tight_layout()
-        plt.savefig(out_file)
-        plt.close()
+        fig = Figure(figsize=(10, 8))
+        ax = fig.subplots()
+        sns.heatmap(df[num_cols].corr(), annot=True, cmap='coolwarm', fmt='.2f', ax=ax)
+        ax.set_title('Correlation Heatmap')
+        out_file = os.path.join(out_dir or STATIC_DIR, 'heatmap.png')
+        fig.tight_layout()
+        with span('savefig'):
+            fig.savefig(out_file)
         msg = "Heatmap generated."
 
     elif chart_type == 'waterfall':
-        # Try to detect core columns required for a financial waterfall
-        lower_cols = {c.lower(): c for c in df.columns}
-        def find_col(candidates):
-            for key, orig in lower_cols.items():
-                if any(term in key for term in candidates):
-                    if pd.api.types.is_numeric_dtype(df[orig]):
-                        return orig
-            return None
-
-        revenue_col = find_col(['revenue', 'sales', 'gross_sales', 'total_revenue', 'net_cash_in'])
-        cogs_col = find_col(['cogs', 'cost_of_goods', 'cost of goods', 'cost'])
-        opex_col = find_col(['opex', 'operating_exp', 'operating expenses', 'total_opex', 'expenses'])
-        final_col = find_col(['operating_income', 'ebit', 'net_income', 'profit'])
-
-        if not revenue_col or not (cogs_col or opex_col):
+        steps = waterfall_steps(df)
+        if steps is None:
             return (
                 "Cannot build a waterfall chart: required columns like Revenue and COGS/OpEx not found in the dataset.",
                 None,
             )
-
-        rev_total = pd.to_numeric(df[revenue_col], errors='coerce').sum(skipna=True)
-        cogs_total = pd.to_numeric(df[cogs_col], errors='coerce').sum(skipna=True) if cogs_col else 0
-        opex_total = pd.to_numeric(df[opex_col], errors='coerce').sum(skipna=True) if opex_col else 0
-        if final_col:
-            final_total = pd.to_numeric(df[final_col], errors='coerce').sum(skipna=True)
-        else:
-            final_total = rev_total - cogs_total - opex_total
-
-        steps = [
-            (revenue_col, rev_total),
-            (cogs_col or 'COGS', -cogs_total),
-            (opex_col or 'OpEx', -opex_total),
-            (final_col or 'Operating_Income', final_total),
-        ]
-
-        # Build waterfall bars
-        labels = [name for name, _ in steps]
-        values = [val for _, val in steps]
-        running = [0]
-        for v in values[:-1]:
-            running.append(running[-1] + v)
-
-        fig, ax = plt.subplots(figsize=(12, 6))
-        colors = []
-        for i, v in enumerate(values):
-            if i == 0:
-                colors.append('#3b82f6')  # start
-            elif i == len(values) - 1:
-                colors.append('#22c55e')  # final
-            else:
-                colors.append('#ef4444' if v < 0 else '#22c55e')
-        ax.bar(range(len(values)), values, bottom=running, color=colors)
-        ax.set_xticks(range(len(values)))
-        ax.set_xticklabels(labels, rotation=20, ha='right')
-        ax.set_title('Waterfall Chart')
-        ax.grid(True, axis='y', alpha=0.3)
-        out_file = os.path.join(STATIC_DIR, 'waterfall_chart.png')
-        plt.tight_layout()
-        plt.savefig(out_file)
-        plt.close()
+        (revenue_col, rev_total), (cogs_name, neg_cogs), (opex_name, neg_opex), (final_name, final_total) = steps
+        out_file = _plot_waterfall(steps, 'Waterfall Chart', 'waterfall_chart.png', out_dir)
         msg = (
             f"Waterfall: {revenue_col}={rev_total:,.0f}, "
-            f"{cogs_col or 'COGS'}={-cogs_total:,.0f}, {opex_col or 'OpEx'}={-opex_total:,.0f}, "
+            f"{cogs_name}={neg_cogs:,.0f}, {opex_name}={neg_opex:,.0f}, "
             f"Final={final_total:,.0f}."
         )
 
@@ -0,0 +1,131 @@
+"""Compact, size-bounded dataset summaries for the CSV agent's prompt.
+
+Without one the agent spends several Gemini round trips discovering the
+schema (df.columns, df.dtypes, df.describe()...) before it starts on the
+question. The pack answers those up front from the rollup cube: column roles,
+date range, per-column stats, top categories and monthly totals. It is cached
+per dataset fingerprint, so appends or re-uploads get a fresh pack.
+"""
+import os
+import threading
+import numpy as np
+
+from rollups import get_rollup
+
+# ~4 chars per token, so about 1k prompt tokens
+MAX_PACK_CHARS = int(os.environ.get('CONTEXT_PACK_MAX_CHARS', '4000'))
+TOP_CATEGORIES = 5
+MONTHS = 24
+
+_cache = {}
+# pandas' lazily built MultiIndex lookups are not safe to initialise from
+# several threads at once, so packs are built one at a time
+_build_lock = threading.Lock()
+
+
+def _fmt(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return '-'
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def _schema_lines(meta, date_col, value_col, cube):
+    lines = [f"Rows: {meta['row_count']:,}. Columns: {len(meta['columns'])}."]
+    daily = cube['tables'].get(('daily', None))
+    for col in meta['columns']:
+        if col == date_col:
+            role = 'date'
+            if daily is not None and len(daily):
+                periods = daily.index.get_level_values('period')
+                role += f", {periods.min()} to {periods.max()}, {len(daily):,} distinct days"
+        elif col in meta['numeric_cols']:
+            role = 'numeric, primary value' if col == value_col else 'numeric'
+        elif col in meta['dimensions']:
+            role = f"category, {meta['cardinality'][col]} values"
+        else:
+            role = f"text/id, {meta['cardinality'].get(col, '?')} distinct"
+        lines.append(f"- {col}: {role}")
+    return lines
+
+
+def _stats_lines(meta, cube):
+    total = cube['tables'].get(('total', None))
+    if total is None or total.empty:
+        return []
+    lines = ["Column stats (count / missing / sum / mean / min / max):"]
+    for col in meta['numeric_cols']:
+        count = float(total[(col, 'count')].iloc[0])
+        col_sum = float(total[(col, 'sum')].iloc[0])
+        mean = col_sum / count if count else None
+        lines.append(f"- {col}: {_fmt(count)} / {_fmt(meta['row_count'] - count)} / {_fmt(col_sum)} / "
+                     f"{_fmt(mean)} / {_fmt(total[(col, 'min')].iloc[0])} / {_fmt(total[(col, 'max')].iloc[0])}")
+    return lines
+
+
+def _category_lines(meta, cube, value_col):
+    lines = []
+    for dim in meta['dimensions']:
+        table = cube['tables'].get(('total', dim))
+        if table is None or table.empty:
+            continue
+        if value_col in meta['numeric_cols']:
+            sums = table[(value_col, 'sum')].sort_values(ascending=False)
+            grand = sums.sum()
+            top = [f"{k} {_fmt(v)} ({v / grand:.0%})" if grand else f"{k} {_fmt(v)}"
+                   for k, v in sums.head(TOP_CATEGORIES).items()]
+            lines.append(f"- {dim} by {value_col}: " + '; '.join(top))
+        else:
+            first = meta['numeric_cols'][0] if meta['numeric_cols'] else None
+            if first is None:
+                continue
+            counts = table[(first, 'count')].sort_values(ascending=False)
+            lines.append(f"- {dim} by rows: " + '; '.join(f"{k} {_fmt(v)}" for k, v in counts.head(TOP_CATEGORIES).items()))
+    return ["Top categories:"] + lines if lines else []
+
+
+def _monthly_lines(meta, cube, value_col):
+    monthly = cube['tables'].get(('monthly', None))
+    if monthly is None or monthly.empty or value_col not in meta['numeric_cols']:
+        return []
+    series = monthly[(value_col, 'sum')].where(monthly[(value_col, 'count')] > 0).tail(MONTHS)
+    items = [f"{period} {_fmt(v)}" for period, v in series.items()]
+    dated = int(monthly[(value_col, 'count')].sum())
+    total = int(cube['tables'][('total', None)][(value_col, 'count')].iloc[0])
+    coverage = f", {dated:,} of {total:,} rows have a parseable date" if dated < total else ''
+    return [f"Monthly {value_col} totals (last {len(items)}{coverage}): " + '; '.join(items)]
+
+
+def build_context_pack(cube, date_col, value_col, max_chars=MAX_PACK_CHARS):
+    """Render the pack, dropping the least important lines to stay under max_chars."""
+    meta = cube['meta']
+    sections = [
+        _schema_lines(meta, date_col, value_col, cube),
+        _stats_lines(meta, cube),
+        _monthly_lines(meta, cube, value_col),
+        _category_lines(meta, cube, value_col),
+    ]
+    lines, size = [], 0
+    for section in sections:
+        for line in section:
+            if size + len(line) + 1 > max_chars:
+                lines.append("(truncated)")
+                return '\n'.join(lines)
+            lines.append(line)
+            size += len(line) + 1
+    return '\n'.join(lines)
+
+
+def get_context_pack(csv_path, date_col, value_col, cube=None):
+    """Cached pack for the dataset's current contents."""
+    if cube is None:
+        cube = get_rollup(csv_path, date_col)
+    key = (cube['meta'].get('fingerprint'), date_col, value_col)
+    pack = _cache.get(key)
+    if pack is None:
+        with _build_lock:
+            pack = _cache.get(key)
+            if pack is None:
+                pack = _cache[key] = build_context_pack(cube, date_col, value_col)
+    return pack
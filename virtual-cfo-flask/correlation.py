@@ -0,0 +1,257 @@
+"""Correlation engine for wide datasets.
+
+- top_k_pairs: strongest column pairs (Pearson or Spearman) without building
+  the full matrix. Columns are processed in BLOCK_COLUMNS-wide blocks of the
+  upper triangle; each block keeps only its best k via argpartition.
+- lagged_correlation: Pearson r of x[t] against y[t + lag] for every lag in
+  -max_lag..max_lag and many y columns at once, from FFT cross-correlations.
+- parse_lead_lag: which columns a "does X lead Y?" question is about.
+
+Missing values are handled pairwise (only rows where both sides are present
+count), matching DataFrame.corr().
+"""
+import re
+import numpy as np
+import pandas as pd
+
+BLOCK_COLUMNS = 256
+# Overlapping observations needed before a lagged r is reported
+MIN_OVERLAP = 10
+
+LEAD_WORDS = r"\b(?:leads?|leading|precedes?|ahead of)\b"
+FOLLOW_WORDS = r"\b(?:lags?|lagging|follows?|following|trails?|behind)\b"
+# Phrases that ask for lead/lag on their own; a bare direction word ("following",
+# "behind", "leading") only counts with a column named on each side of it
+LEAD_LAG_PATTERN = re.compile(
+    r"\blead[ /-]?(?:and[ -])?lag\b|\blagged (?:correlation|relationship|effect|impact)s?\b"
+    r"|\bcross[- ]correlations?\b|\b(?:leads?|lags?|precedes?|trails?)\b[^.?!]*?\bby\b"
+)
+# Any word that could make a prompt a lead/lag question, for a cheap pre-check
+LEAD_LAG_WORDS = re.compile(rf"{LEAD_WORDS}|{FOLLOW_WORDS}|\blagged\b|\bcross[- ]correlations?\b")
+# Prompt words mapped to the column-name words they stand for
+SYNONYMS = {
+    'revenue': ['revenue', 'sales', 'income', 'turnover'],
+    'sales': ['sales', 'revenue'],
+    'marketing': ['marketing', 'ads', 'advertising'],
+    'ads': ['ads', 'advertising', 'marketing'],
+    'advertising': ['advertising', 'ads', 'marketing'],
+    'costs': ['cost', 'costs', 'cogs', 'expense', 'expenses'],
+    'cost': ['cost', 'costs', 'cogs', 'expense', 'expenses'],
+    'expenses': ['expense', 'expenses', 'cost', 'costs'],
+    'profit': ['profit', 'margin'],
+    'orders': ['orders', 'order'],
+}
+
+
+# --- Pairwise correlation, block-wise ---
+def _correlation_blocks(values, block):
+    """Yield (i0, j0, r) for the upper-triangle blocks of the correlation matrix."""
+    m = values.shape[1]
+    missing = np.isnan(values)
+    if not missing.any():
+        centered = values - values.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = centered / np.sqrt((centered * centered).sum(axis=0))
+        for i0 in range(0, m, block):
+            for j0 in range(i0, m, block):
+                yield i0, j0, z[:, i0:i0 + block].T @ z[:, j0:j0 + block]
+        return
+    # Same running-moment formula as outofcore.pearson_corr_chunked, per block
+    mask = (~missing).astype(np.float64)
+    with np.errstate(invalid='ignore'):
+        x = np.nan_to_num(values - np.nan_to_num(np.nanmean(values, axis=0)))
+    for i0 in range(0, m, block):
+        a = slice(i0, i0 + block)
+        for j0 in range(i0, m, block):
+            b = slice(j0, j0 + block)
+            n = mask[:, a].T @ mask[:, b]
+            sx = x[:, a].T @ mask[:, b]
+            sy = mask[:, a].T @ x[:, b]
+            sxx = (x[:, a] * x[:, a]).T @ mask[:, b]
+            syy = mask[:, a].T @ (x[:, b] * x[:, b])
+            sxy = x[:, a].T @ x[:, b]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+            r[n < 2] = np.nan
+            yield i0, j0, r
+
+
+def _select(scores, k):
+    """Indices of the k largest finite scores, best first."""
+    finite = np.flatnonzero(np.isfinite(scores))
+    if len(finite) > k:
+        finite = finite[np.argpartition(scores[finite], -k)[-k:]]
+    return finite[np.argsort(-scores[finite], kind='stable')]
+
+
+def _ranked(pairs_i, pairs_j, r, columns, k, absolute):
+    scores = np.abs(r) if absolute else r
+    best = _select(scores, k)
+    # Ties resolve in column order, like the old sorted pair list
+    best = best[np.lexsort((pairs_j[best], pairs_i[best], -scores[best]))]
+    return [((columns[pairs_i[t]], columns[pairs_j[t]]), float(np.clip(r[t], -1.0, 1.0))) for t in best]
+
+
+def top_k_pairs(frame, k=10, method='pearson', absolute=True, block=BLOCK_COLUMNS):
+    """The k most correlated column pairs as [((a, b), r), ...], strongest first.
+
+    method is 'pearson' or 'spearman'. Spearman ranks each column once over its
+    own values, so it equals DataFrame.corr('spearman') when nothing is missing.
+    Memory is O(rows x columns + block^2), never O(columns^2).
+    """
+    columns = list(frame.columns)
+    if method == 'spearman':
+        frame = frame.rank()
+    elif method != 'pearson':
+        raise ValueError(f"Unknown correlation method '{method}'. Choose 'pearson' or 'spearman'.")
+    values = frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    cand_i, cand_j, cand_r = [], [], []
+    for i0, j0, r in _correlation_blocks(values, block):
+        rows, cols = np.indices(r.shape)
+        rows, cols = rows.ravel() + i0, cols.ravel() + j0
+        r = r.ravel()
+        upper = rows < cols
+        rows, cols, r = rows[upper], cols[upper], r[upper]
+        keep = _select(np.abs(r) if absolute else r, k)
+        cand_i.append(rows[keep])
+        cand_j.append(cols[keep])
+        cand_r.append(r[keep])
+    if not cand_r:
+        return []
+    return _ranked(np.concatenate(cand_i), np.concatenate(cand_j), np.concatenate(cand_r), columns, k, absolute)
+
+
+def top_k_from_matrix(corr, k=10, absolute=True):
+    """top_k_pairs for an already computed correlation matrix (DataFrame)."""
+    columns = list(corr.columns)
+    i, j = np.triu_indices(len(columns), 1)
+    return _ranked(i, j, corr.to_numpy(dtype=np.float64)[i, j], columns, k, absolute)
+
+
+# --- Lagged cross-correlation ---
+def lagged_correlation(x, y, max_lag=30):
+    """Pearson r of x[t] against y[t + lag] for lag = -max_lag..max_lag.
+
+    x is one series; y is a series or a 2-D array of series with the same
+    regular spacing. Positive lags mean x moves first. Returns (lags, r) with r
+    shaped (lags, columns of y). Every sum over the overlapping part is one FFT
+    cross-correlation, so the cost is O(n log n) per column for all lags.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim == 1:
+        y = y[:, None]
+    n = len(x)
+    max_lag = max(0, min(max_lag, n - 2))
+    mx, my = ~np.isnan(x), ~np.isnan(y)
+    # Centering keeps the sums small, so n*sxx - sx^2 does not cancel badly
+    with np.errstate(invalid='ignore'):
+        xc = np.where(mx, x - np.nan_to_num(np.nanmean(x)), 0.0)
+        yc = np.where(my, y - np.nan_to_num(np.nanmean(y, axis=0)), 0.0)
+    # Zero padding to n + max_lag is enough for the circular sums not to wrap
+    size = 1 << (n + max_lag - 1).bit_length()
+
+    def spectrum(a):
+        return np.fft.rfft(a, size, axis=0)
+
+    def xcorr(fa, fb):
+        # sum over t of a[t] * b[t + lag]
+        c = np.fft.irfft(np.conj(fa)[:, None] * fb, size, axis=0)
+        return np.concatenate([c[size - max_lag:], c[:max_lag + 1]]) if max_lag else c[:1]
+
+    fm, fx, fxx = spectrum(mx.astype(np.float64)), spectrum(xc), spectrum(xc * xc)
+    fmy, fy, fyy = spectrum(my.astype(np.float64)), spectrum(yc), spectrum(yc * yc)
+    count = np.rint(xcorr(fm, fmy))
+    sx, sy = xcorr(fx, fmy), xcorr(fm, fy)
+    sxx, syy, sxy = xcorr(fxx, fmy), xcorr(fm, fyy), xcorr(fx, fy)
+    vx, vy = count * sxx - sx * sx, count * syy - sy * sy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (count * sxy - sx * sy) / np.sqrt(vx * vy)
+    # FFT round-off leaves tiny non-zero variances where a window is (near) constant,
+    # so windows with almost none of the series' overall variance get no r
+    with np.errstate(invalid='ignore'):
+        flat_x = np.nanmax(x) == np.nanmin(x) if mx.any() else True
+        flat_y = np.nanmax(y, axis=0) == np.nanmin(y, axis=0)
+    tiny = 1e-10 * count * count
+    r[(count < MIN_OVERLAP) | (vx <= tiny * np.sum(xc * xc) / n) | (vy <= tiny * np.sum(yc * yc, axis=0) / n)] = np.nan
+    r[:, flat_y | flat_x] = np.nan
+    return np.arange(-max_lag, max_lag + 1), np.clip(r, -1.0, 1.0)
+
+
+def lead_lag(frame, drivers, targets, max_lag=30):
+    """Best lag of each driver/target pair, strongest relation first.
+
+    frame is a regularly spaced (e.g. daily) frame. Returns (table, curves):
+    table has driver, target, best_lag, r (at best_lag) and r_same_period;
+    curves maps (driver, target) to the r-by-lag array, with lags = -max_lag..max_lag.
+    """
+    rows, curves = [], {}
+    for driver in drivers:
+        others = [t for t in targets if t != driver]
+        if not others:
+            continue
+        lags, r = lagged_correlation(frame[driver], frame[others].to_numpy(dtype=np.float64), max_lag)
+        strength = np.where(np.isnan(r), -1.0, np.abs(r))
+        best = strength.argmax(axis=0)
+        zero = int(np.flatnonzero(lags == 0)[0])
+        for j, target in enumerate(others):
+            curves[(driver, target)] = r[:, j]
+            rows.append({
+                'driver': driver,
+                'target': target,
+                'best_lag': int(lags[best[j]]),
+                'r': float(r[best[j], j]),
+                'r_same_period': float(r[zero, j]),
+            })
+    table = pd.DataFrame(rows, columns=['driver', 'target', 'best_lag', 'r', 'r_same_period'])
+    if not table.empty:
+        table = table.assign(strength=table['r'].abs()).sort_values('strength', ascending=False, kind='stable')
+        table = table.drop(columns='strength').reset_index(drop=True)
+    return table, curves
+
+
+# --- Prompt parsing ---
+def _words(text):
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', text)
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+def _matching_columns(phrase, columns):
+    """Columns sharing the most words with the phrase (ties all kept)."""
+    wanted = set()
+    for word in _words(phrase):
+        wanted.update(SYNONYMS.get(word, [word]))
+    scores = {c: len(wanted.intersection(_words(c))) for c in columns}
+    best = max(scores.values(), default=0)
+    return [c for c in columns if best and scores[c] == best]
+
+
+def parse_lead_lag(prompt, columns):
+    """(drivers, targets) for a lead/lag question, or None if it is not one.
+
+    "does marketing lead revenue?" and "does revenue lag marketing?" both give
+    the marketing columns as drivers and the revenue/sales columns as targets.
+    With no target named, every other column is a target -- but only for an
+    explicit lead/lag phrase (LEAD_LAG_PATTERN); a bare direction word needs a
+    column on each side, so "show the following metrics" is left alone.
+    """
+    if not LEAD_LAG_WORDS.search(prompt):
+        return None
+    explicit = LEAD_LAG_PATTERN.search(prompt) is not None
+    lead = re.search(LEAD_WORDS, prompt)
+    follow = re.search(FOLLOW_WORDS, prompt)
+    split = lead or follow or re.search(r"\b(?:and|vs\.?|versus|with)\b", prompt)
+    if split is None and not explicit:
+        return None
+    # "lagged correlation of marketing": the named columns drive everything else
+    before, after = (prompt, '') if split is None else (prompt[:split.start()], prompt[split.end():])
+    if split is not None and split is follow:
+        before, after = after, before
+    drivers = _matching_columns(before, columns)
+    if not drivers:
+        return None
+    named = [t for t in _matching_columns(after, columns) if t not in drivers]
+    if not named and not explicit:
+        return None
+    targets = _matching_columns(after, columns) or [c for c in columns if c not in drivers]
+    return drivers, [t for t in targets if t not in drivers] or targets
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+
+# kind -> fn(params, progress) returning a JSON-serializable result
+HANDLERS = {}
+
+_executor = None
+_lock = threading.Lock()
+
+
+def register(kind):
+    """Decorator registering the function that runs jobs of the given kind."""
+    def wrap(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return wrap
+
+
+def _connect():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_jobs(workers=None):
+    """Create the job table and worker pool; jobs left over from a previous
+    process can never finish, so they are marked as failed."""
+    global _executor
+    with _connect() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                dedupe_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                params TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(dedupe_key, status)")
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Interrupted by server restart.', finished_at = ? "
+            "WHERE status IN ('queued', 'running')",
+            (time.time(),),
+        )
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers or JOB_WORKERS, thread_name_prefix='job')
+
+
+def _update(job_id, **fields):
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    with _connect() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def _run(job_id, kind, params):
+    _update(job_id, status='running', started_at=time.time(), message='Started')
+
+    def progress(fraction, message=None):
+        _update(job_id, progress=float(min(max(fraction, 0.0), 1.0)), message=message)
+
+    try:
+        result = HANDLERS[kind](params, progress)
+        _update(job_id, status='done', progress=1.0, message='Done',
+                result=json.dumps(result, default=str), finished_at=time.time())
+    except Exception as e:
+        print(f"ERROR: Job {job_id} ({kind}) failed: {e}")
+        _update(job_id, status='failed', error=str(e), finished_at=time.time())
+
+
+def enqueue(kind, params):
+    """Queue a job and return its id.
+
+    An identical job (same kind and params) that is still queued or running is
+    reused instead of starting a second copy of the same work.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind '{kind}'.")
+    if _executor is None:
+        init_jobs()
+    payload = json.dumps(params, sort_keys=True, default=str)
+    dedupe_key = hashlib.sha1(f"{kind}:{payload}".encode('utf-8')).hexdigest()
+    with _lock:
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running') "
+                "ORDER BY created_at LIMIT 1",
+                (dedupe_key,),
+            ).fetchone()
+            if row:
+                return row['id']
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, dedupe_key, status, params, created_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, dedupe_key, payload, time.time()),
+            )
+    _executor.submit(_run, job_id, kind, params)
+    return job_id
+
+
+def get_job(job_id):
+    """Job status, progress and (once finished) result or error, or None."""
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = {
+        'id': row['id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'progress': row['progress'],
+        'message': row['message'],
+        'created_at': row['created_at'],
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+    }
+    if row['status'] == 'done':
+        job['result'] = json.loads(row['result']) if row['result'] else None
+    if row['status'] == 'failed':
+        job['error'] = row['error']
+    return job
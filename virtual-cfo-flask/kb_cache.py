@@ -0,0 +1,224 @@
+"""Cached text extraction for knowledge-base documents.
+
+PDF parsing dominates a knowledge-base rebuild, so each PDF is parsed once:
+pages are extracted in parallel worker processes, normalized, and stored
+with their metadata under KB_CACHE_DIR as <sha256 of the file>.jsonl.gz
+(one JSON line per page). Later loads -- including rebuilds with different
+chunk settings -- read that file and never touch the PDF. Editing, renaming
+or moving a PDF is handled by the content hash: an unchanged file is a hit,
+a changed one is parsed again.
+
+    KB_CACHE_DIR          cache directory (default kb_cache)
+    KB_EXTRACT_WORKERS    processes for page extraction (default: CPU count)
+    KB_CHUNK_SIZE         characters per chunk for the index (default 1000)
+    KB_CHUNK_OVERLAP      characters shared by neighbouring chunks (default 150)
+
+Usage (warm the cache ahead of a rebuild):
+    python kb_cache.py knowledge_base --workers 4
+
+The web app warms the cache through warm_cache_subprocess and then reads it
+in-process, so the extraction pool is only ever forked from this
+single-threaded CLI process, never from the multi-threaded server.
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import threading
+import subprocess
+import unicodedata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+CACHE_DIR = os.environ.get('KB_CACHE_DIR', 'kb_cache')
+WORKERS = int(os.environ.get('KB_EXTRACT_WORKERS', '0')) or os.cpu_count() or 1
+CHUNK_SIZE = int(os.environ.get('KB_CHUNK_SIZE', '1000'))
+CHUNK_OVERLAP = int(os.environ.get('KB_CHUNK_OVERLAP', '150'))
+# Bump when extraction or normalization changes, so old cache entries are ignored
+EXTRACT_VERSION = 1
+# Smaller PDFs are parsed in-process; starting workers would cost more than it saves
+PARALLEL_MIN_PAGES = 32
+PAGES_PER_TASK = 16
+
+TEXT_EXTENSIONS = ('.txt',)
+
+_LEADER_DOTS = re.compile(r'(?:\. ?){4,}')
+_CONTROL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+_TRAILING_SPACE = re.compile(r'[ \t]+\n')
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_text(text):
+    """NFKC, no control characters, table-of-contents dot leaders collapsed,
+    no trailing spaces and at most one blank line in a row."""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _CONTROL.sub('', text)
+    text = _LEADER_DOTS.sub(' ... ', text)
+    text = _TRAILING_SPACE.sub('\n', text)
+    return _BLANK_LINES.sub('\n\n', text).strip()
+
+
+def _cache_path(digest):
+    return os.path.join(CACHE_DIR, f"{digest}.jsonl.gz")
+
+
+# --- Extraction ---
+def _extract_pages(path, start, stop):
+    """[(page, text, page_label)] for pages start..stop-1. Runs in a worker process."""
+    reader = PdfReader(path)
+    labels = reader.page_labels
+    return [(i, normalize_text(reader.pages[i].extract_text()), labels[i] if i < len(labels) else str(i + 1))
+            for i in range(start, stop)]
+
+
+def _document_info(reader):
+    info = {}
+    try:
+        for key in ('title', 'author', 'subject'):
+            value = getattr(reader.metadata, key, None) if reader.metadata else None
+            if value:
+                info[key] = str(value)
+    except Exception:
+        pass
+    return info
+
+
+def _pool_context():
+    """fork context, as batch.py's pool uses: spawn and forkserver would re-run
+    app.py in every worker. None where fork is unsupported, or when other threads
+    are running -- a fork could copy a lock one of them holds; pages are then
+    parsed in-process."""
+    if 'fork' not in multiprocessing.get_all_start_methods() or threading.active_count() > 1:
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def extract_pdf(path, workers=None):
+    """Page records ({'page', 'page_label', 'total_pages', 'text', ...}) for a PDF, parsing pages in parallel."""
+    reader = PdfReader(path)
+    total = len(reader.pages)
+    info = _document_info(reader)
+    workers = min(workers or WORKERS, max(total // PAGES_PER_TASK, 1))
+    context = _pool_context() if workers > 1 and total >= PARALLEL_MIN_PAGES else None
+    if context is None:
+        pages = _extract_pages(path, 0, total)
+    else:
+        starts = list(range(0, total, PAGES_PER_TASK))
+        stops = [min(start + PAGES_PER_TASK, total) for start in starts]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            parts = pool.map(_extract_pages, [path] * len(starts), starts, stops)
+            pages = [page for part in parts for page in part]
+    return [{**info, 'page': i, 'page_label': label, 'total_pages': total, 'text': text}
+            for i, text, label in pages]
+
+
+def _read_cache(digest):
+    path = _cache_path(digest)
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != EXTRACT_VERSION:
+                return None
+            return [json.loads(line) for line in f]
+    except Exception as e:
+        print(f"WARNING: Ignoring unreadable extraction cache '{path}': {e}")
+        return None
+
+
+def _write_cache(digest, source, pages):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(digest)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write(json.dumps({'version': EXTRACT_VERSION, 'file': os.path.basename(source), 'pages': len(pages)}) + '\n')
+        for page in pages:
+            f.write(json.dumps(page, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+def pdf_pages(path, workers=None):
+    """Cached page records for a PDF; parses (and caches) it only on a miss."""
+    digest = file_hash(path)
+    pages = _read_cache(digest)
+    if pages is not None:
+        return pages, True
+    started = time.perf_counter()
+    pages = extract_pdf(path, workers)
+    _write_cache(digest, path, pages)
+    print(f"INFO: Extracted {len(pages)} pages from '{os.path.basename(path)}' "
+          f"in {time.perf_counter() - started:.1f}s.")
+    return pages, False
+
+
+def warm_cache_subprocess(directory, workers=None):
+    """Parse uncached PDFs under directory in a fresh `python kb_cache.py` process;
+    returns its exit status."""
+    cmd = [sys.executable, os.path.abspath(__file__), directory]
+    if workers:
+        cmd += ['--workers', str(int(workers))]
+    return subprocess.call(cmd)
+
+
+# --- Documents for the index ---
+def load_documents(directory, workers=None):
+    """LangChain Documents for every PDF (one per page, from the cache) and text
+    file under directory, with the same source/page metadata PyPDFLoader gives."""
+    from langchain_core.documents import Document
+    documents = []
+    hits = misses = 0
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            ext = os.path.splitext(name)[1].lower()
+            try:
+                if ext == '.pdf':
+                    pages, hit = pdf_pages(path, workers)
+                    hits, misses = hits + hit, misses + (not hit)
+                    for page in pages:
+                        meta = {k: v for k, v in page.items() if k != 'text'}
+                        documents.append(Document(page_content=page['text'], metadata={'source': path, **meta}))
+                elif ext in TEXT_EXTENSIONS:
+                    with open(path, encoding='utf-8', errors='replace') as f:
+                        documents.append(Document(page_content=f.read(), metadata={'source': path}))
+            except Exception as e:
+                print(f"ERROR: Failed to load knowledge-base document '{path}': {e}")
+    print(f"INFO: Knowledge-base documents: {len(documents)} ({hits} PDF(s) from cache, {misses} parsed).")
+    return documents
+
+
+def split_documents(documents, chunk_size=None, chunk_overlap=None):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size or CHUNK_SIZE,
+                                              chunk_overlap=CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap)
+    return splitter.split_documents(documents)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract and cache knowledge-base PDF text.")
+    parser.add_argument('directory', nargs='?', default='knowledge_base')
+    parser.add_argument('--workers', type=int, default=None, help="extraction processes (default: CPU count)")
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+    documents = load_documents(args.directory, args.workers)
+    print(f"SUCCESS: {len(documents)} documents ready in {time.perf_counter() - started:.1f}s.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
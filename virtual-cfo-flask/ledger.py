@@ -0,0 +1,504 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+import pandas as pd
+import numpy as np
+
+from rollups import (build_rollup, build_tables, dataset_fingerprint, get_rollup, infer_date_format,
+                     merge_tables, parse_dates, save_rollup)
+from outofcore import build_rollup_chunked, iter_chunks, scan_schema, use_out_of_core
+
+LEDGER_DIR = 'ledgers'
+os.makedirs(LEDGER_DIR, exist_ok=True)
+
+# Most recent rows kept for the linear-trend forecast (predict_timeseries fits far fewer).
+FORECAST_TAIL = 500
+# Values per compactor level in the quantile sketch; exact up to 2 * SKETCH_K values.
+SKETCH_K = 8192
+# Bump when the state layout changes, so older states are rebuilt rather than misread
+STATE_VERSION = 2
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _ledger_dir(csv_path):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(LEDGER_DIR, name)
+
+
+def _state_path(csv_path):
+    return os.path.join(_ledger_dir(csv_path), 'state.pkl')
+
+
+def _column_file(csv_path, index, kind):
+    return os.path.join(_ledger_dir(csv_path), f"{index}.{'f8' if kind == 'num' else 'jsonl'}")
+
+
+def _journal_path(csv_path):
+    return os.path.join(_ledger_dir(csv_path), 'append.journal')
+
+
+@contextmanager
+def _dataset_lock(csv_path):
+    """Serialize writers of one dataset: a thread lock inside this process and,
+    where fcntl exists, an flock on the ledger directory across processes."""
+    key = os.path.abspath(csv_path)
+    with _locks_guard:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        os.makedirs(_ledger_dir(csv_path), exist_ok=True)
+        with open(os.path.join(_ledger_dir(csv_path), '.lock'), 'a') as fh:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+
+
+# --- Columnar copy of the dataset ---
+def _write_columns(csv_path, df, kinds, mode):
+    """Write (mode='w') or append (mode='a') rows to the per-column files.
+
+    Numeric columns are raw float64 so they can be appended in place and
+    memory-mapped on read; everything else is one JSON string per line.
+    """
+    for i, col in enumerate(df.columns):
+        path = _column_file(csv_path, i, kinds[col])
+        if kinds[col] == 'num':
+            with open(path, mode + 'b') as fh:
+                pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64).tofile(fh)
+        else:
+            with open(path, mode, encoding='utf-8') as fh:
+                fh.writelines(json.dumps(None if pd.isna(v) else str(v)) + '\n' for v in df[col])
+
+
+def open_columns(csv_path, columns=None, mmap_mode='r'):
+    """Columnar arrays for a dataset: numeric columns as memory maps (read-only by
+    default; mmap_mode='c' gives private copy-on-write pages)."""
+    state = load_state(csv_path)
+    if state is None:
+        return None
+    arrays = {}
+    for i, col in enumerate(state['columns']):
+        if columns is not None and col not in columns:
+            continue
+        kind = state['kinds'][col]
+        path = _column_file(csv_path, i, kind)
+        if kind == 'num':
+            arrays[col] = np.memmap(path, dtype=np.float64, mode=mmap_mode) if state['rows'] else np.empty(0)
+        else:
+            with open(path, encoding='utf-8') as fh:
+                arrays[col] = np.array([json.loads(line) for line in fh], dtype=object)
+    return arrays
+
+
+def load_frame(csv_path, columns=None, shared=False):
+    """Rebuild a DataFrame from the columnar copy, without re-parsing the CSV.
+
+    With shared=True float columns stay backed by copy-on-write memory maps, so
+    processes holding the same dataset share its pages until they write to them.
+    """
+    arrays = open_columns(csv_path, columns, mmap_mode='c' if shared else 'r')
+    if arrays is None:
+        return None
+    state = load_state(csv_path)
+    df = pd.DataFrame({col: np.asarray(values) for col, values in arrays.items()}, copy=not shared)
+    for col in df.columns:
+        if state['dtypes'][col].startswith('int') and df[col].notna().all():
+            df[col] = df[col].astype(state['dtypes'][col])
+    return df
+
+
+# --- Ingest / state ---
+def load_state(csv_path):
+    path = _state_path(csv_path)
+    return pd.read_pickle(path) if os.path.exists(path) else None
+
+
+def _save_state(csv_path, state):
+    """Stamp the state with the file's fingerprint and swap it in atomically: the
+    rename is the commit point of an ingest or append."""
+    state['version'] = STATE_VERSION
+    state['fingerprint'] = dataset_fingerprint(csv_path)
+    path = _state_path(csv_path)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    pd.to_pickle(state, tmp_path)
+    os.replace(tmp_path, path)
+    return state
+
+
+def _is_current(state, csv_path):
+    return (state is not None and state.get('version') == STATE_VERSION
+            and state.get('fingerprint') == dataset_fingerprint(csv_path))
+
+
+def _numeric_values(series):
+    return pd.to_numeric(series, errors='coerce').dropna().to_numpy(dtype=np.float64)
+
+
+def _tail(df, date_col, value_col):
+    if date_col:
+        df = df.dropna(subset=[date_col]).sort_values(by=date_col, kind='mergesort')
+    return df[[c for c in (date_col, value_col) if c]].tail(FORECAST_TAIL).reset_index(drop=True)
+
+
+def _ingest_chunked(csv_path, date_col, value_col):
+    """ingest() for files too large to load at once: every pass streams chunks."""
+    schema = scan_schema(csv_path, date_col)
+    columns = schema['columns']
+    kinds = {c: 'num' if c in schema['numeric_cols'] else 'str' for c in columns}
+    date_col = date_col if date_col in columns else None
+    value_col = value_col if value_col in columns else None
+    dtypes, sketch, tail = {}, QuantileSketch(), None
+    for i, chunk in enumerate(iter_chunks(csv_path)):
+        _write_columns(csv_path, chunk, kinds, 'a' if i else 'w')
+        for col in columns:
+            dtype = chunk[col].dtype if kinds[col] == 'num' else np.dtype(object)
+            dtypes[col] = dtype if col not in dtypes else np.result_type(dtypes[col], dtype)
+        if value_col:
+            sketch.update(_numeric_values(chunk[value_col]))
+            part = chunk[[c for c in (date_col, value_col) if c]].copy()
+            if date_col:
+                part[date_col] = parse_dates(part[date_col], schema['date_format'])
+            tail = _tail(part if tail is None else pd.concat([tail, part], ignore_index=True), date_col, value_col)
+
+    save_rollup(csv_path, build_rollup_chunked(csv_path, date_col))
+
+    state = {
+        'columns': columns,
+        'kinds': kinds,
+        'dtypes': {c: str(d) for c, d in dtypes.items()},
+        'rows': schema['row_count'],
+        'date_col': date_col,
+        'value_col': value_col,
+        'date_format': schema['date_format'],
+    }
+    if value_col:
+        state['value_sketch'] = sketch
+        state['tail'] = tail
+    return _save_state(csv_path, state)
+
+
+def ingest(csv_path, date_col, value_col, df=None):
+    """Store the columnar copy, rollup cube and running statistics for a new upload."""
+    with _dataset_lock(csv_path):
+        _recover(csv_path)
+        return _ingest(csv_path, date_col, value_col, df)
+
+
+def _ingest(csv_path, date_col, value_col, df=None):
+    if df is None and use_out_of_core(csv_path):
+        return _ingest_chunked(csv_path, date_col, value_col)
+    if df is None:
+        df = pd.read_csv(csv_path)
+    kinds = {c: 'num' if pd.api.types.is_numeric_dtype(df[c]) else 'str' for c in df.columns}
+    _write_columns(csv_path, df, kinds, 'w')
+
+    save_rollup(csv_path, build_rollup(csv_path, date_col, df=df.copy()))
+
+    date_format = infer_date_format(df[date_col]) if date_col and date_col in df.columns else None
+    parsed = df[[c for c in (date_col, value_col) if c and c in df.columns]].copy()
+    if date_col and date_col in parsed.columns:
+        parsed[date_col] = parse_dates(parsed[date_col], date_format)
+    state = {
+        'columns': list(df.columns),
+        'kinds': kinds,
+        'dtypes': {c: str(df[c].dtype) for c in df.columns},
+        'rows': int(len(df)),
+        'date_col': date_col if date_col in df.columns else None,
+        'value_col': value_col if value_col in df.columns else None,
+        'date_format': date_format,
+    }
+    if state['value_col']:
+        state['value_sketch'] = QuantileSketch().update(_numeric_values(df[value_col]))
+        state['tail'] = _tail(parsed, state['date_col'], value_col)
+    return _save_state(csv_path, state)
+
+
+def _check_schema(state, new_rows):
+    """Validate appended rows against the stored schema and align column order."""
+    expected = state['columns']
+    missing = [c for c in expected if c not in new_rows.columns]
+    unexpected = [c for c in new_rows.columns if c not in expected]
+    if missing or unexpected:
+        raise ValueError(
+            f"Appended rows do not match the dataset schema. Missing columns: {missing or 'none'}; "
+            f"unexpected columns: {unexpected or 'none'}."
+        )
+    new_rows = new_rows[expected].reset_index(drop=True)
+    for col in expected:
+        if state['kinds'][col] != 'num':
+            continue
+        coerced = pd.to_numeric(new_rows[col], errors='coerce')
+        if (coerced.isna() & new_rows[col].notna()).any():
+            raise ValueError(f"Column '{col}' expects numeric values.")
+    # Dates are coerced with the dataset's inferred format, exactly as a full re-read would
+    return new_rows
+
+
+# --- Incremental statistics ---
+class QuantileSketch:
+    """Mergeable quantile summary with bounded memory.
+
+    Values land in level 0; a level holding more than 2*k values is sorted and
+    every other one is promoted to the next level, where each value stands for
+    twice as many originals. Memory therefore grows with log(n) instead of n,
+    and quantiles are exact (pandas' linear interpolation) until the first
+    compaction, with a rank error of roughly log2(n / k) / k after it.
+    """
+
+    def __init__(self, k=SKETCH_K):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = self.max = None
+        self._offset = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.count += len(values)
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > 2 * self.k:
+                self._compact(level)
+            level += 1
+        return self
+
+    def _compact(self, level):
+        values = np.sort(self.levels[level])
+        # An odd value out stays behind, so total weight is preserved exactly
+        keep = len(values) % 2
+        promoted = values[keep:][self._offset::2]
+        # Alternating which half survives keeps the error from drifting one way
+        self._offset ^= 1
+        self.levels[level] = values[:keep]
+        if level + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+        self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(vals), 2.0 ** i) for i, vals in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        values, weights = values[order], weights[order]
+        # Each value sits at the middle of the ranks it stands for; with unit
+        # weights that is its plain rank, so this is pandas' interpolation
+        centres = np.cumsum(weights) - (weights + 1) / 2
+        return float(np.interp(q * (self.count - 1), centres, values))
+
+
+def iqr_bounds(sketch):
+    if sketch is None or not sketch.count:
+        return None
+    q1, q3 = sketch.quantile(0.25), sketch.quantile(0.75)
+    iqr = q3 - q1
+    return q1 - 1.5 * iqr, q3 + 1.5 * iqr
+
+
+def anomaly_bounds(csv_path, value_col):
+    """IQR bounds from the running statistics, if they are current for this file."""
+    state = load_state(csv_path)
+    if not _is_current(state, csv_path) or state.get('value_col') != value_col:
+        return None
+    return iqr_bounds(state.get('value_sketch'))
+
+
+def forecast_tail(csv_path, date_col, value_col):
+    """The stored most-recent rows (dates parsed, sorted), if they are current for this file."""
+    state = load_state(csv_path)
+    if (not _is_current(state, csv_path) or state.get('value_col') != value_col
+            or state.get('date_col') != date_col or state.get('tail') is None):
+        return None
+    return state['tail'].copy()
+
+
+def forecast_history(csv_path, date_col, value_col):
+    """Every row's date and value, for plotting a forecast fit on the tail: from the
+    columnar copy when it is current, else the two CSV columns."""
+    if _is_current(load_state(csv_path), csv_path):
+        df = load_frame(csv_path, [date_col, value_col])
+        if df is not None:
+            return df
+    return pd.read_csv(csv_path, usecols=[date_col, value_col])
+
+
+def forecast_from_tail(tail, date_col, value_col, prediction_length=12):
+    """Same linear-trend projection as predict_timeseries, from the stored tail only."""
+    data = tail[value_col].astype(float).values
+    if not len(data):
+        return None
+    recent_window = int(min(max(10, prediction_length * 2), len(data)))
+    y_recent = data[-recent_window:]
+    x_recent = np.arange(len(y_recent), dtype=float)
+    try:
+        slope, intercept = np.polyfit(x_recent, y_recent, 1)
+    except Exception:
+        slope, intercept = 0.0, float(y_recent[-1])
+    x_future = np.arange(len(y_recent), len(y_recent) + prediction_length, dtype=float)
+    values = (slope * x_future + intercept).tolist()
+    if date_col:
+        freq = (pd.infer_freq(tail[date_col]) if len(tail) > 2 else None) or 'D'
+        dates = pd.date_range(start=tail[date_col].iloc[-1], periods=prediction_length + 1, freq=freq)[1:]
+        periods = [d.strftime('%Y-%m-%d') for d in dates]
+    else:
+        periods = list(range(len(tail), len(tail) + prediction_length))
+    return {'periods': periods, 'values': values}
+
+
+def _ensure_trailing_newline(csv_path):
+    with open(csv_path, 'rb+') as fh:
+        fh.seek(0, os.SEEK_END)
+        if fh.tell() == 0:
+            return
+        fh.seek(-1, os.SEEK_END)
+        if fh.read(1) != b'\n':
+            fh.write(b'\n')
+
+
+def _write_journal(csv_path, state, rows_added):
+    """Record what an append is about to grow, so a crash part-way can be undone."""
+    sizes = {}
+    for i, col in enumerate(state['columns']):
+        path = _column_file(csv_path, i, state['kinds'][col])
+        sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+    entry = {'csv_size': os.path.getsize(csv_path), 'columns': sizes,
+             'rows_before': state['rows'], 'rows_after': state['rows'] + rows_added}
+    with open(_journal_path(csv_path), 'w', encoding='utf-8') as fh:
+        json.dump(entry, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _recover(csv_path):
+    """Finish or undo an append that died before its journal was removed.
+
+    The state rename is the commit point: if the saved state already covers
+    the appended rows the append went through; otherwise the CSV and column
+    files are cut back to their recorded sizes and the old state is restamped.
+    The cube needs nothing, since a changed file fingerprint rebuilds it.
+    """
+    path = _journal_path(csv_path)
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding='utf-8') as fh:
+            entry = json.load(fh)
+    except Exception:
+        # Torn journal: nothing was appended yet when it was being written
+        os.remove(path)
+        return
+    state = load_state(csv_path)
+    if _is_current(state, csv_path) and state['rows'] == entry['rows_after']:
+        os.remove(path)
+        return
+    print(f"WARNING: Rolling back an interrupted append to '{os.path.basename(csv_path)}'.")
+    os.truncate(csv_path, entry['csv_size'])
+    for col_path, size in entry['columns'].items():
+        if os.path.exists(col_path):
+            os.truncate(col_path, size)
+    if state is not None and state['rows'] == entry['rows_before']:
+        _save_state(csv_path, state)
+    os.remove(path)
+
+
+def append_rows(csv_path, new_rows, date_col, value_col):
+    """Append new rows to an existing dataset and update everything derived from it.
+
+    Only the new tail is parsed: the CSV and columnar copy are appended in
+    place, per-period cube tables are merged, the new values are added to the
+    quantile sketch behind the anomaly bounds, and the forecast refits on the
+    stored tail. Appends to one dataset are serialized, and a journal lets an
+    interrupted append be rolled back on the next write.
+    """
+    with _dataset_lock(csv_path):
+        _recover(csv_path)
+        try:
+            return _append_rows(csv_path, new_rows, date_col, value_col)
+        except Exception:
+            # Undo whatever part of this append was written before it failed
+            _recover(csv_path)
+            raise
+
+
+def _append_rows(csv_path, new_rows, date_col, value_col):
+    state = load_state(csv_path)
+    if not _is_current(state, csv_path):
+        state = _ingest(csv_path, date_col, value_col)
+    new_rows = _check_schema(state, new_rows)
+    if new_rows.empty:
+        raise ValueError("No rows to append.")
+    date_col, value_col = state['date_col'], state['value_col']
+    cube = get_rollup(csv_path, date_col)
+
+    parsed = new_rows.copy()
+    for col in cube['meta']['numeric_cols']:
+        parsed[col] = pd.to_numeric(parsed[col], errors='coerce')
+    if date_col:
+        parsed[date_col] = parse_dates(parsed[date_col], state['date_format'])
+
+    # Write order: journal, CSV, columns, cube, then the state rename commits
+    _write_journal(csv_path, state, len(new_rows))
+
+    # Stored data: CSV and columnar copy, both appended in place
+    _ensure_trailing_newline(csv_path)
+    new_rows.to_csv(csv_path, mode='a', header=False, index=False)
+    _write_columns(csv_path, new_rows, state['kinds'], 'a')
+    state['rows'] += len(new_rows)
+    for col in new_rows.columns:
+        if state['kinds'][col] == 'num':
+            new_dtype = pd.to_numeric(new_rows[col], errors='coerce').dtype
+            state['dtypes'][col] = str(np.result_type(np.dtype(state['dtypes'][col]), new_dtype))
+
+    # Running aggregates: merge the tail's partial cube into the stored one
+    meta = cube['meta']
+    delta = build_tables(parsed, date_col, meta['numeric_cols'], meta['dimensions'])
+    for key, table in delta.items():
+        cube['tables'][key] = merge_tables(cube['tables'][key], table) if key in cube['tables'] else table
+    if date_col and ('daily', None) in cube['tables']:
+        meta['cardinality'][date_col] = int(len(cube['tables'][('daily', None)]))
+    for col in meta['categorical_cols']:
+        if col in meta['dimensions']:
+            meta['cardinality'][col] = int(len(cube['tables'][('total', col)]))
+        else:
+            # Only used against small thresholds, so a lower bound is enough here
+            meta['cardinality'][col] = max(meta['cardinality'][col], int(parsed[col].nunique(dropna=True)))
+    meta['row_count'] += len(new_rows)
+    save_rollup(csv_path, cube)
+
+    summary = {'rows_appended': int(len(new_rows)), 'row_count': state['rows']}
+    if value_col:
+        # Anomaly statistics: fold the new values into the bounded sketch
+        state['value_sketch'].update(_numeric_values(parsed[value_col]))
+        bounds = iqr_bounds(state['value_sketch'])
+        if bounds:
+            new_values = pd.to_numeric(parsed[value_col], errors='coerce')
+            summary['anomaly_bounds'] = [float(bounds[0]), float(bounds[1])]
+            summary['new_anomalies'] = int(((new_values < bounds[0]) | (new_values > bounds[1])).sum())
+
+        # Forecast state: only the most recent rows feed the trend fit
+        tail_rows = parsed[[c for c in (date_col, value_col) if c]]
+        state['tail'] = _tail(pd.concat([state['tail'], tail_rows], ignore_index=True), date_col, value_col)
+        summary['forecast'] = forecast_from_tail(state['tail'], date_col, value_col)
+
+    _save_state(csv_path, state)
+    os.remove(_journal_path(csv_path))
+    return summary
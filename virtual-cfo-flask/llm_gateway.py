@@ -0,0 +1,421 @@
+"""LLM gateway: every Gemini call from the app goes through here.
+
+GatewayChatModel wraps the real chat model (or the stub) and, per call:
+
+1. checks the caller's tenant token budget,
+2. joins an identical in-flight call from the same tenant and lane instead of
+   sending a duplicate upstream,
+3. waits for a concurrency slot -- interactive calls are always served before
+   batch ones, and batch calls never take more than LLM_BATCH_MAX_CONCURRENCY,
+4. takes a token from the rate limiter (LLM_RATE_PER_MIN, LLM_BURST),
+5. retries rate-limit/unavailable errors with full-jitter exponential backoff.
+
+Callers pick their lane and tenant with llm_context(). A call that cannot get
+a slot or rate token within LLM_QUEUE_TIMEOUT_S raises LLMUnavailable; a
+tenant over budget raises BudgetExceeded. A call backing off before a retry
+gives its concurrency slot back and queues again for the next attempt.
+
+Tenants are never taken from the client: app.py maps an X-Api-Key listed in
+LLM_TENANT_KEYS ("key=tenant,key=tenant") to its tenant (tenant_for_key) and
+everyone else shares "default".
+
+    python llm_gateway.py     # checks rate limiting, coalescing, budgets and backoff against the stub model
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import heapq
+import random
+import hashlib
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from tracing import record, incr
+
+RATE_PER_MIN = float(os.environ.get('LLM_RATE_PER_MIN', '60'))
+BURST = int(os.environ.get('LLM_BURST', '10'))
+MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('LLM_BATCH_MAX_CONCURRENCY', '4'))
+QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT_S', '30'))
+MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '4'))
+RETRY_BASE = float(os.environ.get('LLM_RETRY_BASE_S', '0.5'))
+RETRY_MAX = float(os.environ.get('LLM_RETRY_MAX_S', '8'))
+# Tokens per tenant per window; 0 disables budgets
+TENANT_TOKEN_BUDGET = int(os.environ.get('LLM_TENANT_TOKEN_BUDGET', '0'))
+BUDGET_WINDOW = int(os.environ.get('LLM_BUDGET_WINDOW_S', '86400'))
+TENANT_KEYS = dict(part.strip().split('=', 1) for part in os.environ.get('LLM_TENANT_KEYS', '').split(',')
+                   if '=' in part)
+
+LANES = {'interactive': 0, 'batch': 1}
+# Substrings of provider errors worth retrying (429 / 503 / deadline)
+RETRYABLE = ('429', 'resourceexhausted', 'resource exhausted', 'rate limit', 'quota',
+             '503', 'unavailable', 'deadlineexceeded', 'deadline exceeded', 'timed out', 'timeout')
+
+_context = contextvars.ContextVar('llm_context', default={'tenant': 'default', 'priority': 'interactive'})
+
+
+class GatewayError(Exception):
+    pass
+
+
+class LLMUnavailable(GatewayError):
+    """No slot or rate-limit token within the queue timeout, or retries exhausted."""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BudgetExceeded(GatewayError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def tenant_for_key(api_key):
+    """Tenant of a configured API key, or None."""
+    if not api_key:
+        return None
+    for key, tenant in TENANT_KEYS.items():
+        if hmac.compare_digest(api_key.encode('utf-8'), key.encode('utf-8')):
+            return tenant
+    return None
+
+
+@contextmanager
+def llm_context(tenant=None, priority=None):
+    """Attribute LLM calls made inside the block to a tenant and priority lane."""
+    current = _context.get()
+    priority = priority or current['priority']
+    if priority not in LANES:
+        raise ValueError(f"Unknown priority lane '{priority}'. Choose from {list(LANES)}.")
+    token = _context.set({'tenant': tenant or current['tenant'], 'priority': priority})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec, burst):
+        self.rate = rate_per_sec
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                raise LLMUnavailable("LLM rate limit reached; try again shortly.", retry_after=max(1, round(wait)))
+            time.sleep(wait)
+
+
+class PriorityGate:
+    """Bounded concurrency; waiters are served by lane, then arrival order."""
+
+    def __init__(self, limit, batch_limit):
+        self.limit = limit
+        self.batch_limit = batch_limit
+        self.active = {lane: 0 for lane in LANES}
+        self.waiting = []
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+
+    def _ready(self, ticket, lane):
+        if self.waiting[0] != ticket or sum(self.active.values()) >= self.limit:
+            return False
+        return lane != 'batch' or self.active['batch'] < self.batch_limit
+
+    def acquire(self, lane, deadline):
+        ticket = (LANES[lane], next(self.order))
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while not self._ready(ticket, lane):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LLMUnavailable("LLM gateway is saturated; try again shortly.")
+                    self.cond.wait(remaining)
+                self.active[lane] += 1
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+
+    def release(self, lane):
+        with self.cond:
+            self.active[lane] -= 1
+            self.cond.notify_all()
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Gateway:
+    def __init__(self, rate_per_min=RATE_PER_MIN, burst=BURST, max_concurrency=MAX_CONCURRENCY,
+                 batch_max_concurrency=BATCH_MAX_CONCURRENCY, token_budget=TENANT_TOKEN_BUDGET):
+        self.bucket = TokenBucket(rate_per_min / 60.0, burst)
+        self.gate = PriorityGate(max_concurrency, batch_max_concurrency)
+        self.token_budget = token_budget
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.usage = {}  # tenant -> [window, tokens]
+
+    # --- Tenant budgets ---
+    def _window(self):
+        return int(time.time() // BUDGET_WINDOW)
+
+    def check_budget(self, tenant):
+        if not self.token_budget:
+            return
+        with self.lock:
+            window, used = self.usage.get(tenant, (self._window(), 0))
+        if window == self._window() and used >= self.token_budget:
+            incr('cfo_llm_rejected_total', reason='budget')
+            retry_after = int((window + 1) * BUDGET_WINDOW - time.time())
+            raise BudgetExceeded(f"Token budget of {self.token_budget} exhausted for tenant '{tenant}'.",
+                                 retry_after=max(1, retry_after))
+
+    def charge(self, tenant, tokens):
+        with self.lock:
+            window = self._window()
+            entry = self.usage.get(tenant)
+            if entry is None or entry[0] != window:
+                entry = self.usage[tenant] = [window, 0]
+            entry[1] += tokens
+
+    def tenant_usage(self):
+        window = self._window()
+        with self.lock:
+            return {tenant: {'tokens': used if w == window else 0, 'budget': self.token_budget or None}
+                    for tenant, (w, used) in self.usage.items()}
+
+    # --- Calls ---
+    def call(self, key, fn):
+        """Run fn() once per key at a time; concurrent callers with the same key share the result.
+
+        Only callers of the same tenant and lane share a call, so every tenant's
+        usage is charged to it and an interactive caller never waits on a batch one."""
+        ctx = _context.get()
+        self.check_budget(ctx['tenant'])
+        key = (ctx['tenant'], ctx['priority'], key)
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = _InFlight()
+        if not leader:
+            incr('cfo_llm_coalesced_total')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._call_upstream(fn, ctx)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.done.set()
+
+    def _call_upstream(self, fn, ctx):
+        lane = ctx['priority']
+        for attempt in range(MAX_RETRIES + 1):
+            queued = time.perf_counter()
+            deadline = time.monotonic() + QUEUE_TIMEOUT
+            try:
+                self.gate.acquire(lane, deadline)
+            except LLMUnavailable:
+                incr('cfo_llm_rejected_total', reason='saturated')
+                raise
+            delay = None
+            try:
+                try:
+                    self.bucket.acquire(deadline)
+                except LLMUnavailable:
+                    incr('cfo_llm_rejected_total', reason='rate_limited')
+                    raise
+                record(f'llm_queue_{lane}', time.perf_counter() - queued)
+                result = fn()
+            except GatewayError:
+                raise
+            except Exception as e:
+                if attempt == MAX_RETRIES or not _is_retryable(e):
+                    if _is_retryable(e):
+                        raise LLMUnavailable(f"LLM provider unavailable after {attempt + 1} attempt(s): {e}") from e
+                    raise
+                incr('cfo_llm_retries_total')
+                delay = random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt))
+                print(f"WARNING: LLM call failed ({e}); retry {attempt + 1}/{MAX_RETRIES} in {delay:.2f}s")
+            finally:
+                self.gate.release(lane)
+            if delay is not None:
+                # Sleep without a slot, so other calls run meanwhile; the retry queues again
+                self._backoff(delay)
+                continue
+            self.charge(ctx['tenant'], _tokens_used(result))
+            return result
+
+    def _backoff(self, delay):
+        time.sleep(delay)
+
+
+def _is_retryable(error):
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in RETRYABLE)
+
+
+def _tokens_used(result):
+    total = 0
+    for generation in result.generations:
+        usage = getattr(generation.message, 'usage_metadata', None) or {}
+        total += usage.get('total_tokens') or usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+    return total
+
+
+gateway = Gateway()
+
+
+def tenant_usage():
+    return gateway.tenant_usage()
+
+
+class GatewayChatModel(BaseChatModel):
+    """Chat model that sends every call of the wrapped model through the gateway."""
+
+    inner: BaseChatModel
+
+    @property
+    def _llm_type(self):
+        return f"gateway-{self.inner._llm_type}"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        payload = json.dumps({
+            'model': self.inner._llm_type,
+            'params': self.inner._identifying_params,
+            'messages': [[m.type, m.content] for m in messages],
+            'stop': stop,
+            'kwargs': kwargs,
+        }, sort_keys=True, default=str)
+        key = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        return gateway.call(key, lambda: self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+# --- Self-check against the stub model ---
+def self_check():
+    """Exercise coalescing, rate limiting, budgets and backoff on private
+    Gateway instances; returns a list of (check, passed, detail)."""
+    from langchain_core.messages import HumanMessage
+    from stub_models import StubChatModel
+
+    stub = StubChatModel(latency_ms=50)
+    calls = itertools.count()
+
+    def ask(text):
+        def fn():
+            next(calls)
+            return stub._generate([HumanMessage(content=text)])
+        return fn
+
+    results = []
+
+    # Identical concurrent calls reach the model once
+    gw = Gateway(rate_per_min=60000, burst=100)
+    start = next(calls)
+    threads = [threading.Thread(target=gw.call, args=('same', ask('same prompt'))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    upstream = next(calls) - start - 1
+    results.append(('coalescing', upstream == 1, f"8 identical calls -> {upstream} upstream"))
+
+    # ...but never across tenants or lanes
+    def call_as(tenant, priority):
+        with llm_context(tenant=tenant, priority=priority):
+            gw.call('shared', ask('shared prompt'))
+
+    start = next(calls)
+    threads = [threading.Thread(target=call_as, args=args)
+               for args in [('a', 'interactive'), ('b', 'interactive'), ('a', 'batch')]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    upstream = next(calls) - start - 1
+    results.append(('coalescing per tenant and lane', upstream == 3,
+                    f"3 identical calls from 2 tenants and 2 lanes -> {upstream} upstream"))
+
+    # Beyond the burst, calls are spaced by the rate
+    gw = Gateway(rate_per_min=600, burst=2)
+    started = time.monotonic()
+    for i in range(6):
+        gw.call(f'rate-{i}', ask(f'rate {i}'))
+    elapsed = time.monotonic() - started
+    results.append(('rate limiting', elapsed >= 0.35, f"6 calls at 10/s, burst 2 -> {elapsed:.2f}s (>= 0.4s expected)"))
+
+    # A tenant over budget is refused; other tenants are not
+    gw = Gateway(rate_per_min=60000, burst=100, token_budget=1)
+    with llm_context(tenant='spender'):
+        gw.call('budget-1', ask('budget 1'))
+        try:
+            gw.call('budget-2', ask('budget 2'))
+            refused = False
+        except BudgetExceeded:
+            refused = True
+    with llm_context(tenant='other'):
+        gw.call('budget-3', ask('budget 3'))
+    results.append(('budget', refused, f"usage {gw.tenant_usage()}"))
+
+    # Backoff sleeps without holding a concurrency slot
+    held = []
+
+    class Probe(Gateway):
+        def _backoff(self, delay):
+            held.append(sum(self.gate.active.values()))
+
+    gw = Probe(rate_per_min=60000, burst=100, max_concurrency=1)
+    attempts = itertools.count()
+
+    def flaky():
+        if next(attempts) == 0:
+            raise RuntimeError("429 Resource has been exhausted (self-check)")
+        return stub._generate([HumanMessage(content='flaky')])
+
+    gw.call('flaky', flaky)
+    results.append(('backoff releases slot', held == [0], f"slots held while backing off: {held}"))
+    return results
+
+
+def main():
+    failed = 0
+    for name, passed, detail in self_check():
+        failed += not passed
+        print(f"{'SUCCESS' if passed else 'ERROR'}: {name}: {detail}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
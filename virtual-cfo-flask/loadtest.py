@@ -0,0 +1,344 @@
+"""Offline end-to-end load test for the Flask app.
+
+Runs the real app in-process with MODEL_BACKEND=stub (deterministic local
+stand-ins for Gemini and the embeddings, see stub_models.py), replays a mixed
+prompt corpus against the datasets in uploads/ at a given concurrency, and
+reports throughput, p50/p95/p99 latency per prompt category and per stage
+(from the X-Timing header), and RSS of the app process and of the app process
+plus its children (sandbox zygote and workers). A run that leaves sys.stdout
+redirected fails.
+
+Usage:
+    python loadtest.py --requests 200 --concurrency 8 --llm-latency-ms 300
+    python loadtest.py --fail-p95-ms 2500 --out loadtest.json   # exits 2 on regression
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+# Prompts per category, phrased to hit the same router branches real users do
+CORPUS = {
+    'charts': [
+        "show me a bar chart of sales",
+        "plot a pie chart of revenue",
+        "line chart of revenue over time",
+        "draw a waterfall chart of profit",
+        "box plot of expenses",
+    ],
+    'forecast': [
+        "forecast revenue for the next year",
+        "predict sales for the coming months",
+    ],
+    'roc': [
+        "what is the rate of change of revenue",
+        "show the growth rate",
+    ],
+    'anomalies': [
+        "detect anomaly in revenue",
+        "are there any outliers in expenses",
+    ],
+    'agent': [
+        "what is the total revenue in this dataset?",
+        "which month had the highest expenses?",
+        "how can I improve profit margins?",
+        "what strategy should we use to reduce costs?",
+    ],
+}
+DEFAULT_MIX = {'charts': 0.3, 'forecast': 0.15, 'roc': 0.15, 'anomalies': 0.15, 'agent': 0.25}
+
+
+def _proc_rss(pid):
+    with open(f'/proc/{pid}/statm') as fh:
+        return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _proc_children(pid):
+    """Descendant pids of pid, from the parent field of /proc/<pid>/stat."""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as fh:
+                    parents[int(entry)] = int(fh.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                pass
+    found, frontier = [], [pid]
+    while frontier:
+        frontier = [child for child, parent in parents.items() if parent in frontier]
+        found += frontier
+    return found
+
+
+def rss_mb():
+    """(this process, this process plus all its children) RSS in MB; pages shared
+    by forked workers are counted once per process, so the total is an upper bound."""
+    if psutil is not None:
+        proc = psutil.Process()
+        own = proc.memory_info().rss
+        total = own
+        for child in proc.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return own / 2**20, total / 2**20
+    try:
+        own = _proc_rss(os.getpid())
+    except (OSError, ValueError):
+        return None, None
+    total = own
+    for child in _proc_children(os.getpid()):
+        try:
+            total += _proc_rss(child)
+        except (OSError, ValueError):
+            pass
+    return own / 2**20, total / 2**20
+
+
+def _parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {k: 0.0 for k in CORPUS}
+        for part in text.split(','):
+            name, _, weight = part.partition('=')
+            if name.strip() not in CORPUS:
+                raise SystemExit(f"ERROR: Unknown prompt category '{name}'. Choose from {list(CORPUS)}.")
+            mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _parse_timing(header):
+    """'stage;dur=12.3;n=1, counter;n=5, ...' -> ({stage: ms}, {counter: value})"""
+    stages, counters = {}, {}
+    for part in (header or '').split(','):
+        fields = part.strip().split(';')
+        values = dict(field.split('=', 1) for field in fields[1:] if '=' in field)
+        if 'dur' in values:
+            stages[fields[0]] = float(values['dur'])
+        elif 'n' in values:
+            counters[fields[0]] = float(values['n'])
+    return stages, counters
+
+
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+def _worker(app, plan, results, lock):
+    client = app.test_client()
+    for category, prompt, dataset in plan:
+        with client.session_transaction() as sess:
+            sess['csv_path'] = dataset
+        started = time.perf_counter()
+        error = None
+        try:
+            response = client.post('/chat', json={'prompt': prompt}, headers={'X-Timing': '1'})
+            status, timing = response.status_code, response.headers.get('X-Timing')
+            stages, counters = _parse_timing(timing)
+            if status >= 400:
+                error = (response.get_json(silent=True) or {}).get('error', response.status)
+        except Exception as e:
+            status, stages, counters, error = 599, {}, {}, str(e)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with lock:
+            results.append({'category': category, 'prompt': prompt, 'dataset': os.path.basename(dataset),
+                            'status': status, 'error': error, 'ms': elapsed_ms, 'stages': stages,
+                            'counters': counters})
+
+
+def run_load(app, datasets, requests, concurrency, mix, seed=0, warmup=0):
+    rng = random.Random(seed)
+    categories = [c for c in CORPUS if mix.get(c)]
+    weights = [mix[c] for c in categories]
+
+    def draw(n):
+        picks = []
+        for category in rng.choices(categories, weights, k=n):
+            picks.append((category, rng.choice(CORPUS[category]), rng.choice(datasets)))
+        return picks
+
+    if warmup:
+        print(f"INFO: Warming up with {warmup} request(s)...")
+        _worker(app, draw(warmup), [], threading.Lock())
+
+    plans = [[] for _ in range(concurrency)]
+    for i, item in enumerate(draw(requests)):
+        plans[i % concurrency].append(item)
+
+    results, lock = [], threading.Lock()
+    rss_samples, stop = [], threading.Event()
+
+    def sample_rss():
+        while not stop.wait(0.1):
+            rss_samples.append(rss_mb())
+
+    rss_start = rss_mb()
+    stdout_before = sys.stdout
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=_worker, args=(app, plan, results, lock)) for plan in plans]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    # Agent code capturing print output must not leave the process-wide stream
+    # pointing at a buffer (the in-process tool routes per thread; see sandbox.capture_stdout)
+    stdout_leaked = not (sys.stdout is stdout_before or getattr(sys.stdout, 'stream', None) is stdout_before)
+    if stdout_leaked:
+        leaked, sys.stdout = sys.stdout, stdout_before
+        print(f"ERROR: sys.stdout was left redirected to {type(leaked).__name__} by the run.")
+    sampler.join()
+    rss_end = rss_mb()
+    samples = rss_samples + [rss_start, rss_end]
+    own_values = [own for own, _ in samples if own is not None]
+    total_values = [total for _, total in samples if total is not None]
+
+    by_category, by_stage, counter_totals = defaultdict(list), defaultdict(list), defaultdict(float)
+    for r in results:
+        by_category[r['category']].append(r['ms'])
+        for stage, ms in r['stages'].items():
+            by_stage[stage].append(ms)
+        for name, value in r['counters'].items():
+            counter_totals[name] += value
+    failures = [r for r in results if r['status'] >= 400]
+    errors = len(failures)
+    return {
+        'requests': len(results),
+        'concurrency': concurrency,
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'seconds': elapsed,
+        'error_samples': [{k: r[k] for k in ('category', 'prompt', 'dataset', 'status', 'error')}
+                          for r in failures[:10]],
+        'throughput_rps': len(results) / elapsed if elapsed else None,
+        'latency_ms': _percentiles([r['ms'] for r in results]),
+        'categories': {c: dict(count=len(v), **_percentiles(v)) for c, v in sorted(by_category.items())},
+        'stages_ms': {s: dict(count=len(v), **_percentiles(v)) for s, v in sorted(by_stage.items())},
+        # LLM calls, tokens and agent iterations per request, from the X-Timing counters
+        'per_request': {name: total / len(results) for name, total in sorted(counter_totals.items())},
+        'rss_mb': {
+            'start': rss_start[0],
+            'peak': max(own_values) if own_values else None,
+            'end': rss_end[0],
+        },
+        'total_rss_mb': {
+            'start': rss_start[1],
+            'peak': max(total_values) if total_values else None,
+            'end': rss_end[1],
+        },
+        'stdout_leaked': stdout_leaked,
+    }
+
+
+def _print_report(report):
+    def fmt(v):
+        return f"{v:8.1f}" if v is not None else "       -"
+
+    print(f"\n{report['requests']} requests, concurrency {report['concurrency']}, "
+          f"{report['seconds']:.1f}s, {report['throughput_rps']:.2f} req/s, {report['errors']} error(s)")
+    print(f"{'':20} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    overall = report['latency_ms']
+    print(f"{'all':20} {report['requests']:>6} {fmt(overall['p50'])} {fmt(overall['p95'])} {fmt(overall['p99'])}")
+    for section in ('categories', 'stages_ms'):
+        print(f"-- {'category' if section == 'categories' else 'stage'}")
+        for name, row in report[section].items():
+            print(f"{name:20} {row['count']:>6} {fmt(row['p50'])} {fmt(row['p95'])} {fmt(row['p99'])}")
+    if report['per_request']:
+        print("-- per request: " + ', '.join(f"{name}={value:.1f}" for name, value in report['per_request'].items()))
+    for failure in report['error_samples']:
+        print(f"ERROR: {failure['status']} {failure['category']} '{failure['prompt']}' on {failure['dataset']}: "
+              f"{failure['error']}")
+    for label, key in (('RSS MB', 'rss_mb'), ('RSS MB incl. children', 'total_rss_mb')):
+        rss = report[key]
+        print(f"{label}: start {fmt(rss['start'])}  peak {fmt(rss['peak'])}  end {fmt(rss['end'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test with stub Gemini and embeddings.")
+    parser.add_argument('--datasets', nargs='*', help="CSV files or glob patterns (default: uploads/*.csv)")
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed requests before the run")
+    parser.add_argument('--mix', help="Category weights, e.g. charts=3,agent=1 (default: %s)" %
+                        ','.join(f"{k}={v}" for k, v in DEFAULT_MIX.items()))
+    parser.add_argument('--llm-latency-ms', type=float, default=50)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0,
+                        help="Fraction of stub LLM calls failing with a 429, to exercise gateway retries")
+    parser.add_argument('--embed-latency-ms', type=float, default=5)
+    parser.add_argument('--llm-rate-per-min', type=float, default=6000,
+                        help="Gateway rate limit during the run (the app default of 60/min would dominate)")
+    parser.add_argument('--no-context-pack', action='store_true',
+                        help="Run the agent without the precomputed dataset context (for A/B runs)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="Write the JSON report here")
+    parser.add_argument('--fail-p95-ms', type=float, help="Exit with status 2 if overall p95 exceeds this")
+    parser.add_argument('--fail-error-rate', type=float, default=0.0,
+                        help="Exit with status 2 if the error rate exceeds this (default: 0)")
+    args = parser.parse_args(argv)
+
+    # The app resolves uploads/, static/ and knowledge_base/ relative to its own folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    patterns = args.datasets or [os.path.join('uploads', '*.csv')]
+    datasets = sorted({os.path.abspath(p) for pattern in patterns for p in glob.glob(pattern)})
+    if not datasets:
+        print("ERROR: No datasets matched.")
+        return 1
+
+    # Must be set before app is imported
+    scratch = tempfile.mkdtemp(prefix='cfo-loadtest-')
+    os.environ.update({
+        'MODEL_BACKEND': 'stub',
+        'STUB_LLM_LATENCY_MS': str(args.llm_latency_ms),
+        'STUB_LLM_ERROR_RATE': str(args.llm_error_rate),
+        'LLM_RATE_PER_MIN': str(args.llm_rate_per_min),
+        'STUB_EMBED_LATENCY_MS': str(args.embed_latency_ms),
+        'FAISS_INDEX_PATH': os.path.join(scratch, 'faiss_index'),
+        'JOBS_DB_PATH': os.path.join(scratch, 'jobs.db'),
+        'PROFILE_SAMPLE_RATE': '0',
+        'AGENT_CONTEXT_PACK': '0' if args.no_context_pack else '1',
+    })
+    import app as cfo_app
+    cfo_app.initialize_knowledge_base()
+
+    mix = _parse_mix(args.mix)
+    print(f"INFO: {args.requests} request(s) at concurrency {args.concurrency} across {len(datasets)} dataset(s)...")
+    report = run_load(cfo_app.app, datasets, args.requests, args.concurrency, mix, args.seed, args.warmup)
+    report.update(mix=mix, context_pack=not args.no_context_pack, llm_latency_ms=args.llm_latency_ms, embed_latency_ms=args.embed_latency_ms,
+                  datasets=[os.path.basename(d) for d in datasets])
+    _print_report(report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+        print(f"SUCCESS: Report written to {args.out}")
+
+    failed = report['error_rate'] > args.fail_error_rate or report['stdout_leaked']
+    if args.fail_p95_ms is not None and (report['latency_ms']['p95'] or 0) > args.fail_p95_ms:
+        failed = True
+    if failed:
+        print("ERROR: Load test thresholds exceeded.")
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
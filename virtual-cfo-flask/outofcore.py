@@ -0,0 +1,260 @@
+import os
+import math
+import pandas as pd
+import numpy as np
+
+from rollups import (MAX_DIMENSION_CARDINALITY, ROLLUP_VERSION, build_tables, infer_date_format, merge_tables,
+                     parse_dates)
+
+# 'memory' always loads the whole CSV, 'chunked' always streams it, 'auto' streams
+# only files above OOC_THRESHOLD_MB.
+ENGINE_MODE = os.environ.get('ENGINE_MODE', 'auto').lower()
+OOC_THRESHOLD_BYTES = int(float(os.environ.get('OOC_THRESHOLD_MB', '256')) * 1024 * 1024)
+CHUNK_ROWS = int(os.environ.get('OOC_CHUNK_ROWS', '250000'))
+# Distinct values tracked per categorical column while scanning; beyond this the
+# column is reported with this cardinality and is never a cube dimension.
+CARDINALITY_CAP = 1000
+QUANTILE_BINS = 4096
+# Values an exact quantile refinement may hold in memory at once (8 MB of float64)
+EXACT_BUDGET = 1 << 20
+MAX_PLOT_POINTS = 20000
+
+
+def use_out_of_core(csv_path):
+    if ENGINE_MODE == 'chunked':
+        return True
+    if ENGINE_MODE == 'memory':
+        return False
+    return os.path.getsize(csv_path) > OOC_THRESHOLD_BYTES
+
+
+def iter_chunks(csv_path, usecols=None, chunksize=None):
+    return pd.read_csv(csv_path, usecols=usecols, chunksize=chunksize or CHUNK_ROWS)
+
+
+def scan_schema(csv_path, date_col=None):
+    """One streaming pass for the column roles a full read_csv would produce.
+
+    A column is numeric only if it is numeric in every chunk, and categorical
+    cardinalities are exact up to CARDINALITY_CAP.
+    """
+    columns, non_numeric, distinct = None, set(), {}
+    rows, date_format = 0, None
+    for chunk in iter_chunks(csv_path):
+        if columns is None:
+            columns = list(chunk.columns)
+        rows += len(chunk)
+        if date_col in chunk.columns and date_format is None:
+            date_format = infer_date_format(chunk[date_col])
+        for col in columns:
+            if not pd.api.types.is_numeric_dtype(chunk[col]):
+                non_numeric.add(col)
+            seen = distinct.setdefault(col, set())
+            if len(seen) <= CARDINALITY_CAP:
+                seen.update(chunk[col].dropna().unique()[:CARDINALITY_CAP + 1].tolist())
+    columns = columns or []
+    numeric_cols = [c for c in columns if c not in non_numeric]
+    categorical_cols = [c for c in columns if c in non_numeric]
+    return {
+        'columns': columns,
+        'numeric_cols': numeric_cols,
+        'categorical_cols': categorical_cols,
+        'cardinality': {c: min(len(distinct[c]), CARDINALITY_CAP) for c in categorical_cols},
+        'row_count': rows,
+        'date_format': date_format,
+    }
+
+
+def _coerce(chunk, numeric_cols, date_col, date_format):
+    for col in numeric_cols:
+        chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+    if date_col and date_col in chunk.columns:
+        chunk[date_col] = parse_dates(chunk[date_col], date_format)
+    return chunk
+
+
+# --- Aggregation (exact) ---
+def build_rollup_chunked(csv_path, date_col=None):
+    """Same cube as rollups.build_rollup, built from bounded-size chunks."""
+    meta = scan_schema(csv_path, date_col)
+    meta['date_col'] = date_col
+    meta['version'] = ROLLUP_VERSION
+    meta['categorical_cols'] = [c for c in meta['categorical_cols'] if c != date_col]
+    meta['dimensions'] = [c for c in meta['categorical_cols'] if meta['cardinality'][c] <= MAX_DIMENSION_CARDINALITY]
+    tables = {}
+    for chunk in iter_chunks(csv_path):
+        chunk = _coerce(chunk, meta['numeric_cols'], date_col, meta['date_format'])
+        for key, table in build_tables(chunk, date_col, meta['numeric_cols'], meta['dimensions']).items():
+            tables[key] = merge_tables(tables[key], table) if key in tables else table
+    if ('daily', None) in tables:
+        meta['cardinality'][date_col] = int(len(tables[('daily', None)]))
+    return {'meta': meta, 'tables': tables}
+
+
+def group_sum_chunked(csv_path, by, value_col):
+    """Exact df.groupby(by)[value_col].sum() by adding per-chunk partial sums."""
+    totals = None
+    for chunk in iter_chunks(csv_path, usecols=[by, value_col]):
+        part = chunk.groupby(by)[value_col].sum()
+        totals = part if totals is None else totals.add(part, fill_value=0)
+    return totals if totals is not None else pd.Series(dtype=float)
+
+
+# --- Correlation (exact) ---
+def pearson_corr_chunked(csv_path, columns):
+    """Pairwise-complete Pearson matrix, as DataFrame.corr(), from running moments.
+
+    Each chunk only contributes sums of x, x^2 and x*y over rows where both
+    columns are present, so memory is O(columns^2) regardless of row count.
+    """
+    k = len(columns)
+    n = np.zeros((k, k))
+    sx = np.zeros((k, k))
+    sxx = np.zeros((k, k))
+    sxy = np.zeros((k, k))
+    shift = None
+    for chunk in iter_chunks(csv_path, usecols=columns):
+        values = chunk[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        if shift is None:
+            # Correlation is shift-invariant; centering on the first chunk avoids cancellation
+            with np.errstate(all='ignore'):
+                shift = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) else np.zeros(k)
+        mask = (~np.isnan(values)).astype(np.float64)
+        x = np.nan_to_num(values - shift)
+        n += mask.T @ mask
+        sx += x.T @ mask            # sx[i, j] = sum of column i where j is also present
+        sxx += (x * x).T @ mask
+        sxy += x.T @ x
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = n * sxy - sx * sx.T
+        var = (n * sxx - sx * sx) * (n * sxx - sx * sx).T
+        corr = cov / np.sqrt(var)
+    corr[n < 2] = np.nan
+    return pd.DataFrame(np.clip(corr, -1.0, 1.0), index=columns, columns=columns)
+
+
+# --- Quantiles (sketch with optional exact refinement) ---
+def _order_statistics(csv_path, column, ranks, lo, hi, count, bins):
+    """{rank: value} for the given 0-based ranks of a column, in bounded memory.
+
+    Each pass handles a set of value windows [lo, hi) that hold the wanted
+    ranks. A window of at most EXACT_BUDGET values is collected and sorted;
+    a larger one is histogrammed into `bins` sub-windows and only the ones
+    holding a wanted rank go on to the next pass. Memory stays at a few
+    histograms plus EXACT_BUDGET values however the data is distributed.
+    """
+    pending = [{'lo': lo, 'hi': hi, 'closed': True, 'start': 0, 'count': count, 'ranks': ranks}]
+    found = {}
+    while pending:
+        for w in pending:
+            w['small'] = w['count'] <= EXACT_BUDGET
+            w['kept'], w['min'], w['max'] = [], np.inf, -np.inf
+            if not w['small']:
+                w['edges'] = np.linspace(w['lo'], w['hi'], bins + 1)
+                w['hist'] = np.zeros(bins, dtype=np.int64)
+        for chunk in iter_chunks(csv_path, usecols=[column]):
+            values = pd.to_numeric(chunk[column], errors='coerce').dropna().to_numpy(dtype=np.float64)
+            for w in pending:
+                inside = (values >= w['lo']) & ((values <= w['hi']) if w['closed'] else (values < w['hi']))
+                selected = values[inside]
+                if not len(selected):
+                    continue
+                if w['small']:
+                    w['kept'].append(selected)
+                    continue
+                idx = np.clip(np.searchsorted(w['edges'], selected, side='right') - 1, 0, bins - 1)
+                w['hist'] += np.bincount(idx, minlength=bins)
+                w['min'], w['max'] = min(w['min'], selected.min()), max(w['max'], selected.max())
+
+        refined = []
+        for w in pending:
+            if w['small']:
+                values = np.sort(np.concatenate(w['kept']))
+                for r in w['ranks']:
+                    found[r] = values[r - w['start']]
+            elif w['min'] == w['max']:
+                # A single repeated value: every rank in here is that value
+                for r in w['ranks']:
+                    found[r] = w['min']
+            else:
+                cumulative = np.cumsum(w['hist'])
+                children = {}
+                for r in w['ranks']:
+                    children.setdefault(int(np.searchsorted(cumulative, r - w['start'], side='right')), []).append(r)
+                for b, child_ranks in children.items():
+                    refined.append({
+                        'lo': w['edges'][b], 'hi': w['edges'][b + 1], 'closed': w['closed'] and b == bins - 1,
+                        'start': w['start'] + (int(cumulative[b - 1]) if b else 0),
+                        'count': int(w['hist'][b]), 'ranks': child_ranks,
+                    })
+        pending = refined
+    return found
+
+
+def quantiles_chunked(csv_path, column, qs, exact=True, bins=QUANTILE_BINS):
+    """Quantiles of one column in bounded memory.
+
+    A first pass finds count/min/max. With exact=False a second pass builds a
+    fixed-width histogram and the answer is interpolated inside the bin, which
+    bounds the error by one bin width ((max - min) / bins). With exact=True
+    the bins holding the target ranks are refined pass by pass until they are
+    small enough to sort (see _order_statistics), so the result matches
+    pandas' linear interpolation exactly.
+    """
+    count, lo, hi = 0, np.inf, -np.inf
+    for chunk in iter_chunks(csv_path, usecols=[column]):
+        values = pd.to_numeric(chunk[column], errors='coerce').dropna().to_numpy(dtype=np.float64)
+        if len(values):
+            count += len(values)
+            lo, hi = min(lo, values.min()), max(hi, values.max())
+    if count == 0:
+        return [np.nan for _ in qs]
+    if lo == hi:
+        return [float(lo) for _ in qs]
+
+    positions = [q * (count - 1) for q in qs]
+    if exact:
+        ranks = sorted({r for pos in positions for r in (math.floor(pos), math.ceil(pos))})
+        order_stat = _order_statistics(csv_path, column, ranks, lo, hi, count, bins)
+        results = []
+        for pos in positions:
+            below, above = order_stat[math.floor(pos)], order_stat[math.ceil(pos)]
+            results.append(float(below + (above - below) * (pos - math.floor(pos))))
+        return results
+
+    edges = np.linspace(lo, hi, bins + 1)
+    hist = np.zeros(bins, dtype=np.int64)
+    for chunk in iter_chunks(csv_path, usecols=[column]):
+        values = pd.to_numeric(chunk[column], errors='coerce').dropna().to_numpy(dtype=np.float64)
+        hist += np.histogram(values, bins=edges)[0]
+    cumulative = np.cumsum(hist)
+    results = []
+    for pos in positions:
+        b = int(np.searchsorted(cumulative, pos, side='right'))
+        before = cumulative[b - 1] if b else 0
+        frac = (pos - before + 0.5) / hist[b] if hist[b] else 0.5
+        results.append(float(edges[b] + (edges[b + 1] - edges[b]) * min(max(frac, 0.0), 1.0)))
+    return results
+
+
+# --- Row selections for plotting ---
+def sample_rows(csv_path, columns, max_points=MAX_PLOT_POINTS, row_count=None):
+    """Every k-th row of the given columns, so plots of huge files stay bounded."""
+    if row_count is None:
+        row_count = sum(len(chunk) for chunk in iter_chunks(csv_path, usecols=[columns[0]]))
+    stride = max(1, math.ceil(row_count / max_points))
+    parts, offset = [], 0
+    for chunk in iter_chunks(csv_path, usecols=columns):
+        start = (-offset) % stride
+        parts.append(chunk.iloc[start::stride])
+        offset += len(chunk)
+    return pd.concat(parts) if parts else pd.DataFrame(columns=columns)
+
+
+def filter_rows(csv_path, columns, value_col, lower, upper):
+    """Rows whose value_col falls outside [lower, upper], keeping original row labels."""
+    parts = []
+    for chunk in iter_chunks(csv_path, usecols=columns):
+        values = pd.to_numeric(chunk[value_col], errors='coerce')
+        parts.append(chunk[(values < lower) | (values > upper)])
+    return pd.concat(parts) if parts else pd.DataFrame(columns=columns)
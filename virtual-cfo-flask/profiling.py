@@ -0,0 +1,201 @@
+"""On-demand request profiling with flamegraph-ready output.
+
+A request is profiled when it carries an X-Profile header together with an
+X-Profile-Token matching PROFILE_TOKEN, or for a sampled fraction of traffic
+(PROFILE_SAMPLE_RATE, which needs no token). Each profile is a directory under
+profiles/ with:
+
+- stacks.collapsed: wall-clock stacks of the request thread from a sampling
+  profiler, one "frame;frame;frame count" line per stack (flamegraph.pl,
+  speedscope and inferno read this directly)
+- alloc.collapsed / alloc_top.txt: tracemalloc allocation stacks weighted by
+  bytes still held at the end of the request, and the top allocation sites
+- cprofile.pstats: deterministic cProfile data (only when asked for)
+- meta.json: endpoint, handler stages, dataset, duration
+
+GET /profiles and the profile files are served only to requests carrying
+the same token; without PROFILE_TOKEN, X-Profile is ignored and sampled
+profiles stay on disk only.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import random
+import hmac
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+# Modes used for sampled traffic and for a bare "X-Profile: 1"
+PROFILE_DEFAULT_MODES = os.environ.get('PROFILE_MODES', 'stack,alloc')
+# X-Profile is only honoured together with a matching X-Profile-Token, which is
+# also required to list and download profiles; unset, neither is possible
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+ALLOC_FRAMES = 25
+MODES = ('stack', 'alloc', 'cprofile')
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def authorized(headers):
+    """True if the request carries the configured profile token."""
+    token = headers.get('X-Profile-Token')
+    return bool(PROFILE_TOKEN and token) and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def requested_modes(headers):
+    """Profiling modes for a request, or None if it should not be profiled."""
+    value = headers.get('X-Profile')
+    if value:
+        if not authorized(headers):
+            return None
+        if value.lower() in ('1', 'true', 'yes', 'on'):
+            value = PROFILE_DEFAULT_MODES
+    elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        value = PROFILE_DEFAULT_MODES
+    else:
+        return None
+    modes = [m.strip().lower() for m in value.split(',') if m.strip().lower() in MODES]
+    return modes or None
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_loop(state):
+    stacks = state['stacks']
+    while not state['stop'].wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(state['thread_id'])
+        names = []
+        while frame is not None:
+            names.append(_frame_label(frame))
+            frame = frame.f_back
+        if names:
+            stacks[';'.join(reversed(names))] += 1
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(ALLOC_FRAMES)
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    """Snapshot, then stop tracing once the last concurrent profile is done."""
+    global _tracemalloc_users
+    snapshot = tracemalloc.take_snapshot()
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    return snapshot
+
+
+def start_profile(modes):
+    """Start profiling the calling thread; returns the state for stop_profile()."""
+    state = {'modes': list(modes), 'started': time.perf_counter(), 'wall_started': time.time()}
+    if 'alloc' in modes:
+        _start_tracemalloc()
+    if 'cprofile' in modes:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            state['cprofile'] = profiler
+        except ValueError as e:
+            # Python 3.12+ allows one active cProfile per process
+            print(f"WARNING: cProfile unavailable for this request: {e}")
+    if 'stack' in modes:
+        state.update(thread_id=threading.get_ident(), stacks=Counter(), stop=threading.Event())
+        state['sampler'] = threading.Thread(target=_sample_loop, args=(state,), daemon=True)
+        state['sampler'].start()
+    return state
+
+
+def _write_collapsed(path, stacks):
+    with open(path, 'w', encoding='utf-8') as fh:
+        for stack, weight in sorted(stacks.items()):
+            fh.write(f"{stack} {weight}\n")
+
+
+def _allocation_stacks(snapshot):
+    stacks = Counter()
+    for stat in snapshot.statistics('traceback'):
+        # Tracebacks are oldest frame first, the same root-first order collapsed stacks use
+        names = [f"{os.path.basename(f.filename)}:{f.lineno}" for f in stat.traceback]
+        stacks[';'.join(names)] += stat.size
+    return stacks
+
+
+def stop_profile(state, meta):
+    """Stop profiling, write the profile directory and return its id."""
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    out_dir = os.path.join(PROFILE_DIR, profile_id)
+    os.makedirs(out_dir, exist_ok=True)
+    files = []
+
+    # Snapshot first so writing the other outputs doesn't show up as allocations
+    snapshot = None
+    if 'alloc' in state['modes']:
+        snapshot = _stop_tracemalloc().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+    if 'sampler' in state:
+        state['stop'].set()
+        state['sampler'].join()
+        _write_collapsed(os.path.join(out_dir, 'stacks.collapsed'), state['stacks'])
+        files.append('stacks.collapsed')
+    if 'cprofile' in state:
+        state['cprofile'].disable()
+        state['cprofile'].dump_stats(os.path.join(out_dir, 'cprofile.pstats'))
+        files.append('cprofile.pstats')
+    if snapshot is not None:
+        _write_collapsed(os.path.join(out_dir, 'alloc.collapsed'), _allocation_stacks(snapshot))
+        with open(os.path.join(out_dir, 'alloc_top.txt'), 'w', encoding='utf-8') as fh:
+            for stat in snapshot.statistics('lineno')[:50]:
+                fh.write(f"{stat}\n")
+        files += ['alloc.collapsed', 'alloc_top.txt']
+
+    meta = dict(meta, id=profile_id, modes=state['modes'], files=files, created_at=state['wall_started'],
+                seconds=time.perf_counter() - state['started'],
+                samples=sum(state['stacks'].values()) if 'stacks' in state else None)
+    with open(os.path.join(out_dir, 'meta.json'), 'w', encoding='utf-8') as fh:
+        json.dump(meta, fh, indent=2, default=str)
+    _prune()
+    return profile_id
+
+
+def _prune():
+    if not os.path.isdir(PROFILE_DIR):
+        return
+    names = sorted(os.listdir(PROFILE_DIR))
+    for name in names[:max(0, len(names) - PROFILE_KEEP)]:
+        shutil.rmtree(os.path.join(PROFILE_DIR, name), ignore_errors=True)
+
+
+def list_profiles(limit=100):
+    """Metadata of the most recent profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True)[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name, 'meta.json'), encoding='utf-8') as fh:
+                profiles.append(json.load(fh))
+        except (OSError, ValueError):
+            continue
+    return profiles
@@ -0,0 +1,354 @@
+"""Bulk sync between uploaded CSVs and the Supabase `financial_records` table.
+
+The frontend upserts records through the REST API; this talks to
+the same Postgres database directly (RECORDS_DB_URL, e.g. Supabase's direct
+connection string) through a small connection pool:
+
+- load_csv streams a CSV in BATCH_ROWS chunks, maps its columns to the table
+  (Amazon_Sales -> amazon_sales, Revenue -> gross_sales, ...), COPYs each
+  chunk into a temporary staging table and then upserts one row per day on
+  (user_id, date) in a single statement, all in one transaction.
+- iter_pages / read_frame read a user's records back in date order with
+  keyset pagination (date > last date seen) on the (user_id, date) index.
+- export_csv writes them to a CSV, so every CSV-based analysis can run on
+  the store's data.
+
+Upserts need the unique (user_id, date) index added in supabase/migrations.
+Needs psycopg2.
+"""
+import io
+import os
+import re
+import uuid
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+from tracing import span, traced
+
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except Exception:
+    psycopg2 = None
+
+RECORDS_DB_URL = os.environ.get('RECORDS_DB_URL')
+POOL_SIZE = int(os.environ.get('RECORDS_POOL_SIZE', '4'))
+BATCH_ROWS = 50000
+DATE_SAMPLE_ROWS = 1000
+PAGE_SIZE = 5000
+TABLE = 'public.financial_records'
+
+# Table columns (the base migration plus the multi-channel one), in the order
+# of the frontend's CSV layout, which is also the export order
+COLUMNS = [
+    'amazon_sales', 'flipkart_sales', 'website_sales', 'offline_sales', 'myntra_sales', 'meesho_sales',
+    'gross_sales', 'total_orders', 'average_order_value', 'returns', 'net_sales', 'cogs', 'gross_profit',
+    'platform_fees', 'marketing_spend_digital', 'marketing_spend_offline', 'total_marketing_spend',
+    'marketing_efficiency_ratio', 'contribution_margin', 'fixed_cost_allocation', 'myntra_profit',
+    'meesho_profit', 'flipkart_profit', 'net_profit_loss', 'debt_repayment_cash_out', 'net_cash_flow',
+    'profitability_label', 'performance_category', 'marketing_efficiency_label', 'dominant_sales_channel',
+]
+INTEGER_COLUMNS = ['total_orders']
+TEXT_COLUMNS = ['profitability_label', 'performance_category', 'marketing_efficiency_label', 'dominant_sales_channel']
+NUMERIC_COLUMNS = [c for c in COLUMNS if c not in INTEGER_COLUMNS and c not in TEXT_COLUMNS]
+# Ratios aren't summed when rows share a day: they're recomputed from the summed
+# (numerator, denominator), or averaged where the file doesn't have both parts
+RATIO_COLUMNS = {
+    'average_order_value': ('gross_sales', 'total_orders'),
+    'marketing_efficiency_ratio': ('net_sales', 'total_marketing_spend'),
+}
+# Other CSV spellings of table columns (after lower-casing and snake-casing)
+COLUMN_ALIASES = {
+    'revenue': 'gross_sales', 'total_revenue': 'gross_sales', 'total_sales': 'gross_sales', 'sales': 'gross_sales',
+    'net_revenue': 'net_sales',
+    'orders': 'total_orders', 'order_count': 'total_orders',
+    'cost_of_goods_sold': 'cogs', 'cost_of_goods': 'cogs',
+    'marketing_spend': 'total_marketing_spend', 'marketing': 'total_marketing_spend',
+    'net_profit': 'net_profit_loss', 'profit': 'net_profit_loss', 'net_income': 'net_profit_loss',
+    'cash_flow': 'net_cash_flow', 'net_cash': 'net_cash_flow',
+    'debt_repayment': 'debt_repayment_cash_out',
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# --- Connections ---
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if psycopg2 is None:
+                    raise ValueError("The financial records store needs the psycopg2 package.")
+                if not RECORDS_DB_URL:
+                    raise ValueError("RECORDS_DB_URL is not set; the financial records store is unavailable.")
+                _pool = ThreadedConnectionPool(1, POOL_SIZE, RECORDS_DB_URL)
+    return _pool
+
+
+@contextmanager
+def connection():
+    """A pooled connection; commits on success, rolls back on error."""
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def check_user_id(user_id):
+    try:
+        return str(uuid.UUID(str(user_id)))
+    except ValueError:
+        raise ValueError("user_id must be a UUID.")
+
+
+# --- Column mapping ---
+def _snake(name):
+    return re.sub(r'[^a-z0-9]+', '_', str(name).strip().lower()).strip('_')
+
+
+def map_columns(columns, date_col):
+    """{csv column: table column} for the columns the table can hold."""
+    known = set(COLUMNS)
+    mapping = {date_col: 'date'}
+    for column in columns:
+        if column == date_col:
+            continue
+        target = _snake(column)
+        target = target if target in known else COLUMN_ALIASES.get(target)
+        if target and target not in mapping.values():
+            mapping[column] = target
+    return mapping
+
+
+def _date_format(values):
+    """Format parsing the most sample values; day-first is tried too, since
+    01-02-2024 alone can't tell which it is."""
+    sample = values.dropna().astype(str).head(DATE_SAMPLE_ROWS)
+    if sample.empty:
+        return None
+    best, best_count = None, -1
+    for dayfirst in (False, True):
+        fmt = guess_datetime_format(sample.iloc[0], dayfirst=dayfirst)
+        count = int(pd.to_datetime(sample, errors='coerce', format=fmt).notna().sum()) if fmt else 0
+        if count > best_count:
+            best, best_count = fmt, count
+    return best
+
+
+def _ratio_counts(numeric):
+    """Staged per-day counts of each ratio column's values, for averaging."""
+    return [f"{c}_rows" for c in numeric if c in RATIO_COLUMNS]
+
+
+def _day_value(column, numeric):
+    """SQL for one day's value of a numeric column from the staged rows."""
+    if column in INTEGER_COLUMNS:
+        # INTEGER columns round the summed numeric
+        return f"round(sum({column}))::integer"
+    if column not in RATIO_COLUMNS:
+        return f"sum({column})"
+    mean = f"sum({column}) / nullif(sum({column}_rows), 0)"
+    numerator, denominator = RATIO_COLUMNS[column]
+    if numerator in numeric and denominator in numeric:
+        return f"coalesce(sum({numerator}) / nullif(sum({denominator}), 0), {mean})"
+    return mean
+
+
+def _combine_days(frame, numeric, text):
+    """One row per index/'date' value: numbers summed, the last label and seq kept.
+    Ratio columns are summed alongside their _rows counts and resolved in SQL."""
+    days = frame.groupby('date' if 'date' in frame else frame.index, sort=False)
+    return pd.concat([days['seq'].max(), days[numeric].sum(min_count=1), days[text].last()], axis=1)
+
+
+def _parse_dates(values, date_format):
+    """Datetimes for date strings in the format guessed from the file's head, and
+    how many needed parsing one by one because a later part of the file is
+    written differently (e.g. 2024-01-31 after 01/02/2024)."""
+    parsed = pd.to_datetime(values, errors='coerce', format=date_format)
+    missed = parsed.isna() & values.notna() & (values.astype(str).str.strip() != '')
+    if date_format and missed.any():
+        dayfirst = date_format.startswith('%d')
+        parsed[missed] = pd.to_datetime(values[missed], errors='coerce', format='mixed', dayfirst=dayfirst)
+    return parsed, int((missed & parsed.notna()).sum())
+
+
+def _daily_chunk(chunk, mapping, date_format, numeric, text, first_seq):
+    """A chunk as one row per ISO date in table columns, the number of undated
+    rows dropped and of dates parsed one by one. Rows are combined on the raw
+    date text first, so only the distinct dates are parsed."""
+    out = chunk[list(mapping)].rename(columns=mapping)
+    for column in numeric:
+        out[column] = pd.to_numeric(out[column], errors='coerce')
+    for column, count in zip([c for c in numeric if c in RATIO_COLUMNS], _ratio_counts(numeric)):
+        out[count] = out[column].notna().astype('int64')
+    out['seq'] = np.arange(first_seq, first_seq + len(out))
+    daily = _combine_days(out, numeric + _ratio_counts(numeric), text)
+    parsed, mixed = _parse_dates(daily.index.to_series(), date_format)
+    dated = parsed.notna().to_numpy()
+    undated = int(len(out) - out['date'].isin(daily.index[dated]).sum())
+    daily = daily[dated]
+    daily.index = parsed[dated].dt.strftime('%Y-%m-%d')
+    return daily, undated, mixed
+
+
+def _copy_days(cur, pending, numeric, text):
+    # Formatting floats is most of COPY's cost, so days are combined across chunks first
+    daily = _combine_days(pd.concat(pending), numeric, text)
+    buffer = io.StringIO()
+    daily[['seq'] + numeric + text].to_csv(buffer, header=False)
+    buffer.seek(0)
+    with span('records_copy'):
+        cur.copy_expert("COPY staging_records FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+# --- Bulk load ---
+@traced('records_load')
+def load_csv(csv_path, user_id, date_col, batch_rows=BATCH_ROWS):
+    """Upsert a CSV into financial_records for one user; returns load statistics.
+
+    Rows sharing a date are combined (amounts summed, ratios recomputed from
+    the summed parts or averaged, the last label kept), since the table holds
+    one row per user and day. Re-loading the same file
+    is idempotent: existing days are overwritten, not added to. Dates that
+    don't match the format guessed from the head of the file are parsed one by one
+    and counted in dates_parsed_individually.
+    """
+    user_id = check_user_id(user_id)
+    header = pd.read_csv(csv_path, nrows=0).columns
+    if date_col not in header:
+        raise ValueError("A date column is required to load financial records.")
+    mapping = map_columns(header, date_col)
+    columns = list(mapping.values())
+    if len(columns) == 1:
+        raise ValueError("No CSV columns match the financial_records schema.")
+    numeric = [c for c in columns if c in NUMERIC_COLUMNS or c in INTEGER_COLUMNS]
+    text = [c for c in columns if c in TEXT_COLUMNS]
+    staged = numeric + _ratio_counts(numeric)
+    staging_types = ', '.join(['date date', 'seq bigint'] + [f"{c} numeric" for c in staged] + [f"{c} text" for c in text])
+
+    # Guessed once from the file's head, not the first chunk, so a small
+    # batch of ambiguous dates (01/02..12/02) can't fix the wrong order
+    date_format = _date_format(pd.read_csv(csv_path, usecols=[date_col], nrows=DATE_SAMPLE_ROWS)[date_col])
+    rows = skipped = mixed_dates = 0
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE staging_records ({staging_types}) ON COMMIT DROP")
+        pending, pending_rows = [], 0
+        for chunk in pd.read_csv(csv_path, usecols=list(mapping), chunksize=batch_rows):
+            daily, undated, mixed = _daily_chunk(chunk, mapping, date_format, numeric, text, rows)
+            rows += len(chunk)
+            skipped += undated
+            mixed_dates += mixed
+            pending.append(daily)
+            pending_rows += len(daily)
+            if pending_rows >= batch_rows:
+                _copy_days(cur, pending, staged, text)
+                pending, pending_rows = [], 0
+        if pending:
+            _copy_days(cur, pending, staged, text)
+
+        # Labels keep the file's last value per day
+        selected = [_day_value(c, numeric) for c in numeric]
+        selected += [f"(array_agg({c} ORDER BY seq DESC) FILTER (WHERE {c} IS NOT NULL))[1]" for c in text]
+        targets = numeric + text
+        updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in targets)
+        with span('records_upsert'):
+            cur.execute(f"""
+                INSERT INTO {TABLE} (user_id, date, {', '.join(targets)})
+                SELECT %s, date, {', '.join(selected)} FROM staging_records GROUP BY date
+                ON CONFLICT (user_id, date) DO UPDATE SET {updates}, updated_at = now()
+                RETURNING (xmax = 0)
+            """, (user_id,))
+            results = cur.fetchall()
+    inserted = sum(1 for (is_new,) in results if is_new)
+    if mixed_dates:
+        print(f"WARNING: {mixed_dates} distinct date(s) in '{os.path.basename(csv_path)}' did not match "
+              f"the format '{date_format}' and were parsed one by one.")
+    return {
+        'rows_read': rows,
+        'rows_skipped': skipped,
+        'dates_parsed_individually': mixed_dates,
+        'days': len(results),
+        'inserted': inserted,
+        'updated': len(results) - inserted,
+        'columns': {csv_col: col for csv_col, col in mapping.items()},
+    }
+
+
+# --- Reads ---
+def _date_filter(start, end):
+    clauses, args = [], []
+    if start:
+        clauses.append("date >= %s")
+        args.append(pd.Timestamp(start).date())
+    if end:
+        clauses.append("date <= %s")
+        args.append(pd.Timestamp(end).date())
+    return ''.join(f" AND {c}" for c in clauses), args
+
+
+def fetch_page(user_id, after=None, limit=PAGE_SIZE, columns=None, start=None, end=None):
+    """One page of a user's records after the given date, as (frame, next_after)."""
+    user_id = check_user_id(user_id)
+    wanted = ['date'] + [c for c in (columns or COLUMNS) if c != 'date']
+    unknown = [c for c in wanted if c != 'date' and c not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown financial_records column(s): {', '.join(unknown)}.")
+    where, args = _date_filter(start, end)
+    if after:
+        where += " AND date > %s"
+        args.append(pd.Timestamp(after).date())
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT {', '.join(wanted)} FROM {TABLE} WHERE user_id = %s{where} ORDER BY date LIMIT %s",
+                    [user_id] + args + [limit])
+        frame = pd.DataFrame.from_records(cur.fetchall(), columns=wanted)
+    for column in frame.columns:
+        if column in NUMERIC_COLUMNS:
+            frame[column] = frame[column].astype(float)
+    next_after = frame['date'].iloc[-1].isoformat() if len(frame) == limit else None
+    return frame, next_after
+
+
+def iter_pages(user_id, page_size=PAGE_SIZE, **kwargs):
+    after = None
+    while True:
+        frame, after = fetch_page(user_id, after=after, limit=page_size, **kwargs)
+        if len(frame):
+            yield frame
+        if after is None:
+            return
+
+
+@traced('records_read')
+def read_frame(user_id, **kwargs):
+    """All of a user's records (optionally a date range / column subset), oldest first."""
+    pages = list(iter_pages(user_id, **kwargs))
+    if not pages:
+        return pd.DataFrame(columns=['date'])
+    frame = pd.concat(pages, ignore_index=True)
+    frame['date'] = pd.to_datetime(frame['date'])
+    return frame
+
+
+def export_csv(user_id, csv_path, **kwargs):
+    """Write a user's records to csv_path (ISO dates) and return the row count.
+    Columns never filled for this user are left out, as they would be in an upload."""
+    frame = read_frame(user_id, **kwargs)
+    if frame.empty:
+        raise ValueError("No financial records stored for this user.")
+    frame = frame.dropna(axis=1, how='all')
+    frame['date'] = frame['date'].dt.strftime('%Y-%m-%d')
+    frame.rename(columns={'date': 'Date'}).to_csv(csv_path, index=False)
+    return len(frame)
@@ -0,0 +1,220 @@
+import os
+import hashlib
+import warnings
+import threading
+import pandas as pd
+import numpy as np
+from pandas.tseries.api import guess_datetime_format
+
+ROLLUP_DIR = 'rollups'
+os.makedirs(ROLLUP_DIR, exist_ok=True)
+
+# Period grains materialized in the cube, mapped to pandas period frequencies.
+GRAINS = {'daily': 'D', 'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q'}
+STATS = ['sum', 'count', 'min', 'max']
+# How each stat is re-aggregated when rolling up or merging partial cubes.
+STAT_REDUCERS = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+# Categorical columns above this cardinality are not worth a cube dimension.
+MAX_DIMENSION_CARDINALITY = 50
+# Bump when the cube layout or meta changes, so stored cubes are rebuilt
+ROLLUP_VERSION = 2
+
+_cache = {}
+
+
+def dataset_fingerprint(csv_path):
+    """Cheap identity for a dataset file: path, size and modification time."""
+    st = os.stat(csv_path)
+    key = f"{os.path.abspath(csv_path)}:{st.st_size}:{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def infer_date_format(series):
+    """The format pandas infers from the first non-null value, so later
+    appends parse exactly like a full re-read of the file would."""
+    first = series.dropna()
+    if first.empty or not isinstance(first.iloc[0], str):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return guess_datetime_format(first.iloc[0])
+
+
+def parse_dates(series, date_format=None):
+    if date_format:
+        return pd.to_datetime(series, errors='coerce', format=date_format)
+    return pd.to_datetime(series, errors='coerce')
+
+
+def _rollup_path(csv_path, fingerprint):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(ROLLUP_DIR, f"{name}-{fingerprint}.pkl")
+
+
+def reduce_table(table, by):
+    """Re-aggregate a (column, stat) table over new group keys.
+
+    Sums and counts add up, minimums and maximums combine, so the result is
+    exactly what a direct group-by over the underlying rows would produce.
+    """
+    grouped = table.groupby(by, sort=True)
+    parts = []
+    for stat, how in STAT_REDUCERS.items():
+        cols = [c for c in table.columns if c[1] == stat]
+        if cols:
+            parts.append(grouped[cols].agg(how))
+    return pd.concat(parts, axis=1)[list(table.columns)]
+
+
+def merge_tables(old, new):
+    """Combine two partial tables for the same (grain, dimension) key."""
+    combined = pd.concat([old, new])
+    by = [combined.index.get_level_values(i) for i in range(combined.index.nlevels)]
+    return reduce_table(combined, by)
+
+
+def _aggregate(df, keys, numeric_cols):
+    table = df.groupby(keys, sort=True, dropna=False, observed=True)[numeric_cols].agg(STATS)
+    table.columns = pd.MultiIndex.from_tuples(table.columns, names=['column', 'stat'])
+    return table
+
+
+def _frame_meta(df, date_col):
+    """Column roles as the chart handlers see them (after date parsing).
+
+    The date column is not a categorical column, but its cardinality is kept.
+    """
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    non_numeric = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
+    categorical_cols = [c for c in non_numeric if c != date_col]
+    cardinality = {c: int(df[c].nunique(dropna=True)) for c in non_numeric}
+    dimensions = [c for c in categorical_cols if cardinality[c] <= MAX_DIMENSION_CARDINALITY]
+    return {
+        'version': ROLLUP_VERSION,
+        'columns': list(df.columns),
+        'date_col': date_col,
+        'numeric_cols': numeric_cols,
+        'categorical_cols': categorical_cols,
+        'cardinality': cardinality,
+        'dimensions': dimensions,
+        'row_count': int(len(df)),
+    }
+
+
+def build_tables(df, date_col, numeric_cols, dimensions):
+    """Materialize the period x dimension tables for an already-parsed frame."""
+    tables = {}
+    has_dates = bool(date_col) and date_col in df.columns
+    if has_dates:
+        day = df[date_col].dt.to_period('D').rename('period')
+    for dim in [None] + list(dimensions):
+        if has_dates:
+            keys = [day] if dim is None else [day, df[dim]]
+            daily = _aggregate(df, keys, numeric_cols)
+            if dim is None:
+                tables[('total', None)] = reduce_table(daily, np.zeros(len(daily), dtype=int))
+            else:
+                daily = daily[daily.index.get_level_values(dim).notna()]
+                tables[('total', dim)] = reduce_table(daily, [daily.index.get_level_values(dim)])
+            # Rows with unparseable dates still count towards totals above.
+            daily = daily[daily.index.get_level_values('period').notna()]
+            tables[('daily', dim)] = daily
+            for grain, freq in GRAINS.items():
+                if grain == 'daily':
+                    continue
+                period = daily.index.get_level_values('period').asfreq(freq).rename('period')
+                by = [period] if dim is None else [period, daily.index.get_level_values(dim)]
+                tables[(grain, dim)] = reduce_table(daily, by)
+        else:
+            if dim is None:
+                tables[('total', None)] = _aggregate(df, np.zeros(len(df), dtype=int), numeric_cols)
+            else:
+                table = _aggregate(df, [df[dim]], numeric_cols)
+                tables[('total', dim)] = table[table.index.notna()]
+    return tables
+
+
+def build_rollup(csv_path, date_col=None, df=None):
+    """Read a dataset once and build its rollup cube.
+
+    The cube holds sums, counts, minimums and maximums of every numeric column
+    for each daily/weekly/monthly/quarterly period crossed with each
+    low-cardinality categorical dimension (Region, Product_Category, channel...).
+    """
+    if df is None:
+        df = pd.read_csv(csv_path)
+    date_format = None
+    if date_col and date_col in df.columns:
+        date_format = infer_date_format(df[date_col])
+        df[date_col] = parse_dates(df[date_col])
+    meta = _frame_meta(df, date_col)
+    meta['date_format'] = date_format
+    tables = build_tables(df, date_col, meta['numeric_cols'], meta['dimensions'])
+    return {'meta': meta, 'tables': tables}
+
+
+def save_rollup(csv_path, cube):
+    fingerprint = dataset_fingerprint(csv_path)
+    cube['meta']['fingerprint'] = fingerprint
+    # Write then rename, so a concurrent request never reads a half-written cube
+    path = _rollup_path(csv_path, fingerprint)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    pd.to_pickle(cube, tmp_path)
+    os.replace(tmp_path, path)
+    _cache[os.path.abspath(csv_path)] = cube
+    return cube
+
+
+def get_rollup(csv_path, date_col=None, df=None):
+    """Return the cube for a dataset, building and persisting it if needed.
+
+    An already-loaded df (which is modified in place) avoids re-reading the CSV.
+    """
+    key = os.path.abspath(csv_path)
+    fingerprint = dataset_fingerprint(csv_path)
+    cube = _cache.get(key)
+    if cube is None or cube['meta'].get('fingerprint') != fingerprint:
+        path = _rollup_path(csv_path, fingerprint)
+        cube = pd.read_pickle(path) if os.path.exists(path) else None
+    if cube is None or cube['meta'].get('date_col') != date_col or cube['meta'].get('version') != ROLLUP_VERSION:
+        print(f"INFO: Building rollup cube for '{os.path.basename(csv_path)}'...")
+        from outofcore import use_out_of_core, build_rollup_chunked
+        if df is None and use_out_of_core(csv_path):
+            return save_rollup(csv_path, build_rollup_chunked(csv_path, date_col))
+        return save_rollup(csv_path, build_rollup(csv_path, date_col, df=df))
+    _cache[key] = cube
+    return cube
+
+
+# --- Cube queries ---
+def category_totals(cube, category, value_col):
+    """Total of value_col per category value, or None if the cube can't answer."""
+    meta = cube['meta']
+    if value_col not in meta['numeric_cols']:
+        return None
+    if category == meta['date_col']:
+        table = cube['tables'].get(('daily', None))
+        if table is None:
+            return None
+        totals = table[(value_col, 'sum')].copy()
+        totals.index = totals.index.to_timestamp()
+        totals.index.name = category
+        return totals
+    table = cube['tables'].get(('total', category))
+    if table is None:
+        return None
+    totals = table[(value_col, 'sum')].copy()
+    totals.index.name = category
+    return totals
+
+
+def period_series(cube, value_col, grain='daily', stat='sum'):
+    """Time series of a numeric column at the given grain (NaN where no values)."""
+    table = cube['tables'].get((grain, None))
+    if table is None or value_col not in cube['meta']['numeric_cols']:
+        return None
+    series = table[(value_col, stat)].astype(float)
+    series = series.where(table[(value_col, 'count')] > 0)
+    series.index = series.index.to_timestamp()
+    series.index.name = cube['meta']['date_col']
+    return series.rename(value_col)
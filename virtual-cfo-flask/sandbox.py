@@ -0,0 +1,483 @@
+"""Pre-forked, resource-limited processes that run the CSV agent's generated code.
+
+create_csv_agent executes LLM-written pandas in the web worker itself and
+re-reads the CSV for every agent. Instead, a pool of SANDBOX_WORKERS processes
+is forked up front from a small zygote process with pandas preloaded. Each worker keeps
+recently used datasets loaded -- from the ledger's columnar copy, so float
+columns are memory-mapped and shared between workers -- and runs code under
+limits:
+
+    SANDBOX_CPU_SECONDS    CPU time per code run (RLIMIT_CPU, default 20)
+    SANDBOX_MEMORY_MB      memory code may allocate on top of what the worker
+                           holds once its datasets are loaded (RLIMIT_DATA, or
+                           RLIMIT_AS where that is missing; default 1024)
+    SANDBOX_WALL_SECONDS   wall time per code run before the worker is killed (default 30)
+    SANDBOX_MAX_RUNS       code runs before a worker is recycled (default 200)
+
+An agent run leases one worker for all of its steps, so variables persist
+between tool calls exactly as with PythonAstREPLTool. The zygote and workers
+start with the first lease, not at import. Needs a POSIX host;
+elsewhere AVAILABLE is False and app.py keeps the in-process agent, built by
+in_process_csv_agent so its print capture is per thread rather than a swap of
+the process-wide sys.stdout.
+"""
+import io
+import os
+import ast
+import time
+import sys
+import signal
+import socket
+import threading
+import subprocess
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Any
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pandas as pd
+import numpy as np
+
+from langchain_experimental.agents.agent_toolkits import create_csv_agent, create_pandas_dataframe_agent
+from langchain_experimental.tools.python.tool import PythonAstREPLTool, sanitize_input
+
+from rollups import dataset_fingerprint
+from tracing import record, incr
+
+POOL_SIZE = int(os.environ.get('SANDBOX_WORKERS', '2'))
+CPU_SECONDS = int(os.environ.get('SANDBOX_CPU_SECONDS', '20'))
+MEMORY_MB = int(os.environ.get('SANDBOX_MEMORY_MB', '1024'))
+WALL_SECONDS = float(os.environ.get('SANDBOX_WALL_SECONDS', '30'))
+MAX_RUNS = int(os.environ.get('SANDBOX_MAX_RUNS', '200'))
+LEASE_TIMEOUT = float(os.environ.get('SANDBOX_LEASE_TIMEOUT_S', '30'))
+# Datasets each worker keeps loaded
+WORKER_DATASETS = 2
+MAX_OUTPUT_CHARS = 20000
+
+AVAILABLE = resource is not None and hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+
+
+class SandboxError(Exception):
+    pass
+
+
+class CPUTimeExceeded(Exception):
+    pass
+
+
+# --- Worker process ---
+def _cpu_exceeded(signum, frame):
+    raise CPUTimeExceeded(f"Code used more than {CPU_SECONDS}s of CPU time and was stopped.")
+
+
+def _load_dataset(csv_path, fingerprint):
+    from ledger import load_frame, load_state
+    state = load_state(csv_path)
+    if state is not None and state.get('fingerprint') == fingerprint:
+        df = load_frame(csv_path, shared=True)
+        if df is not None:
+            return df
+    return pd.read_csv(csv_path)
+
+
+def _run_code(code, scope):
+    """PythonAstREPLTool semantics: exec all statements, eval the last one."""
+    tree = ast.parse(code)
+    buffer = io.StringIO()
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    soft_limit = int(used.ru_utime + used.ru_stime) + CPU_SECONDS
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, hard_limit))
+    try:
+        with redirect_stdout(buffer):
+            exec(ast.unparse(ast.Module(tree.body[:-1], type_ignores=[])), scope)
+            last = ast.unparse(ast.Module(tree.body[-1:], type_ignores=[]))
+            try:
+                result = eval(last, scope)
+            except SyntaxError:
+                result = None
+                exec(last, scope)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard_limit, hard_limit))
+    output = buffer.getvalue()
+    if result is not None:
+        output += str(result)
+    return output
+
+
+# RLIMIT_DATA (heap and private mappings) leaves the large virtual reservations
+# of BLAS threads and read-only memory maps alone; RLIMIT_AS is the fallback
+MEMORY_RLIMIT = getattr(resource, 'RLIMIT_DATA', None) or getattr(resource, 'RLIMIT_AS', None) if resource else None
+
+
+def _memory_in_use():
+    """Bytes the worker currently counts against MEMORY_RLIMIT (0 if unknown)."""
+    field = 'VmData:' if MEMORY_RLIMIT == getattr(resource, 'RLIMIT_DATA', None) else 'VmSize:'
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _set_memory_limit(headroom):
+    """Soft memory limit at current usage plus headroom, or none (headroom=None)."""
+    if not MEMORY_MB or MEMORY_RLIMIT is None:
+        return
+    _, hard = resource.getrlimit(MEMORY_RLIMIT)
+    soft = hard if headroom is None else _memory_in_use() + headroom
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(MEMORY_RLIMIT, (soft, hard))
+
+
+def _worker_main(conn, cwd):
+    os.chdir(cwd)
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+    # Sessions get shallow copies of the cached frames; with copy-on-write any
+    # change generated code makes (new columns, inplace drops, cell writes)
+    # copies what it touches instead of editing the data the next session sees
+    pd.set_option('mode.copy_on_write', True)
+    frames = OrderedDict()
+    scope = {}
+    while True:
+        try:
+            op, arg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            if op == 'load':
+                key = tuple(arg)
+                if key not in frames:
+                    # Loading is not the generated code's allocation: lift the
+                    # limit, then size it from what the loaded datasets take
+                    _set_memory_limit(None)
+                    frames[key] = _load_dataset(*key)
+                    while len(frames) > WORKER_DATASETS:
+                        frames.popitem(last=False)
+                frames.move_to_end(key)
+                scope = {'df': frames[key].copy(deep=False), 'pd': pd, 'np': np}
+                _set_memory_limit(MEMORY_MB * 1024 * 1024)
+                conn.send(('ok', None))
+            elif op == 'run':
+                conn.send(('ok', _run_code(arg, scope)[:MAX_OUTPUT_CHARS]))
+        except MemoryError:
+            # The heap may be in any state after this; answer, then let the pool replace us
+            conn.send(('fatal', f"MemoryError: code allocated more than the {MEMORY_MB} MB sandbox memory allowance."))
+            return
+        except Exception as e:
+            if op == 'load':
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+            else:
+                conn.send(('ok', f"{type(e).__name__}: {e}"))
+
+
+def _zygote_main(fd):
+    """Fork workers on request. Runs as its own small process (python sandbox.py),
+    so workers start from a single-threaded interpreter with pandas already
+    imported, never from the multi-threaded web process."""
+    import ledger  # noqa: F401  (preloaded so every worker shares its pages)
+    control = Connection(fd)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # the kernel reaps exited workers
+    while True:
+        try:
+            cwd = control.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            control.close()
+            parent_end.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                _worker_main(Connection(child_end.detach()), cwd)
+            finally:
+                os._exit(0)
+        child_end.close()
+        reduction.send_handle(control, parent_end.fileno(), None)
+        control.send(pid)
+        parent_end.close()
+
+
+# --- Pool (web process side) ---
+class _Worker:
+    def __init__(self, conn, pid):
+        self.conn = conn
+        self.pid = pid
+        self.runs = 0
+        self.datasets = set()
+        self.healthy = True
+
+    def alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def request(self, op, arg, timeout):
+        self.conn.send((op, arg))
+        if not self.conn.poll(timeout):
+            raise SandboxError(f"Code ran for more than {timeout:.0f}s and was stopped.")
+        return self.conn.recv()
+
+    def stop(self):
+        self.healthy = False
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class SandboxSession:
+    """One leased worker, bound to a dataset; variables persist between runs."""
+
+    def __init__(self, pool, worker, csv_path):
+        self.pool = pool
+        self.worker = worker
+        self.dataset = (os.path.abspath(csv_path), dataset_fingerprint(csv_path))
+        self._load()
+
+    def _load(self):
+        status, message = self.worker.request('load', self.dataset, WALL_SECONDS)
+        if status != 'ok':
+            raise SandboxError(f"Sandbox could not load the dataset: {message}")
+        self.worker.datasets.add(self.dataset)
+
+    def _restart(self, reason):
+        incr('cfo_sandbox_restarts_total', reason=reason)
+        self.worker.stop()
+        self.worker = self.pool.spawn()
+        self._load()
+
+    def run(self, code):
+        self.worker.runs += 1
+        incr('cfo_sandbox_runs_total')
+        started = time.perf_counter()
+        try:
+            status, output = self.worker.request('run', code, WALL_SECONDS)
+        except SandboxError as e:
+            status, output, reason = 'fatal', str(e), 'timeout'
+        except (EOFError, OSError):
+            status, output, reason = 'fatal', "The sandbox process died while running the code.", 'crashed'
+        else:
+            reason = 'memory'
+        record('sandbox_exec', time.perf_counter() - started)
+        if status == 'fatal':
+            self._restart(reason)
+            return f"{output} Variables from earlier steps are gone; `df` has been reloaded."
+        return output
+
+
+class SandboxPool:
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.cond = threading.Condition()
+        self.zygote = None
+        self.control = None
+        self.spawn_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        # Why the last worker start failed; cleared by the next successful one
+        self.error = None
+        self.leased = 0
+
+    def start(self):
+        """Start the zygote and fork the workers in the background. Called by the
+        first lease, so importing the app (twice under the debug reloader) starts nothing."""
+        with self.start_lock:
+            if self.zygote is not None:
+                return
+            parent_end, child_end = socket.socketpair()
+            self.zygote = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child_end.fileno())],
+                                           pass_fds=[child_end.fileno()])
+            child_end.close()
+            self.control = Connection(parent_end.detach())
+        print(f"INFO: Sandbox pool starting with {self.size} worker(s).")
+        threading.Thread(target=lambda: [self._replace() for _ in range(self.size)], daemon=True).start()
+
+    def spawn(self):
+        if self.zygote.poll() is not None:
+            raise SandboxError(f"the sandbox zygote process exited with status {self.zygote.returncode}")
+        with self.spawn_lock:
+            self.control.send(os.getcwd())
+            fd = reduction.recv_handle(self.control)
+            pid = self.control.recv()
+        return _Worker(Connection(fd), pid)
+
+    def _replace(self):
+        try:
+            worker = self.spawn()
+        except Exception as e:
+            print(f"ERROR: Failed to start sandbox worker: {e}")
+            with self.cond:
+                self.error = str(e) or type(e).__name__
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.error = None
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def _acquire(self, dataset):
+        deadline = time.monotonic() + LEASE_TIMEOUT
+        with self.cond:
+            while not self.idle:
+                # Nothing idle, nothing out on lease to come back, and starts failing
+                if self.error and not self.leased:
+                    raise SandboxError(f"Sandbox workers could not be started ({self.error}). "
+                                       "Restart the app, or set AGENT_SANDBOX=0 to run agent code in the web process.")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SandboxError("All sandbox workers are busy; try again shortly.")
+                self.cond.wait(remaining)
+            # Prefer a worker that already has this dataset loaded
+            warm = [w for w in self.idle if dataset in w.datasets]
+            worker = warm[0] if warm else self.idle[0]
+            self.idle.remove(worker)
+            self.leased += 1
+            return worker
+
+    def release(self, worker):
+        with self.cond:
+            self.leased -= 1
+            if worker.healthy and worker.runs < MAX_RUNS and worker.alive():
+                self.idle.append(worker)
+                self.cond.notify()
+                return
+        if worker.healthy:
+            incr('cfo_sandbox_restarts_total', reason='recycled')
+        worker.stop()
+        threading.Thread(target=self._replace, daemon=True).start()
+
+    @contextmanager
+    def lease(self, csv_path):
+        if self.zygote is None:
+            self.start()
+        started = time.perf_counter()
+        worker = self._acquire((os.path.abspath(csv_path), dataset_fingerprint(csv_path)))
+        record('sandbox_lease', time.perf_counter() - started)
+        session = None
+        try:
+            session = SandboxSession(self, worker, csv_path)
+            yield session
+        except Exception:
+            if session is None:
+                worker.stop()
+            raise
+        finally:
+            self.release(session.worker if session is not None else worker)
+
+
+class SandboxREPLTool(PythonAstREPLTool):
+    """The agent's python_repl_ast tool, executed in a sandbox worker."""
+
+    session: Any = None
+
+    def _run(self, query, run_manager=None):
+        if self.sanitize_input:
+            query = sanitize_input(query)
+        return self.session.run(query)
+
+
+pool = SandboxPool()
+
+
+@contextmanager
+def sandboxed_csv_agent(llm, csv_path, **kwargs):
+    """Like create_csv_agent, but the python_repl_ast tool runs in a leased sandbox worker.
+
+    Only the first rows are read here, for the prompt's df.head() preview.
+    """
+    with pool.lease(csv_path) as session:
+        head = pd.read_csv(csv_path, nrows=kwargs.get('number_of_head_rows', 5))
+        agent = create_pandas_dataframe_agent(llm, head, allow_dangerous_code=True, **kwargs)
+        agent.tools = [SandboxREPLTool(session=session)]
+        yield agent
+
+
+# --- In-process agent ---
+class _ThreadStdout:
+    """sys.stdout stand-in that sends a thread's writes to its capture buffer, if it has one."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_stdout_guard = threading.Lock()
+
+
+@contextmanager
+def capture_stdout(buffer):
+    """redirect_stdout for the calling thread only. redirect_stdout swaps the
+    process-wide sys.stdout, so overlapping agent runs restore each other's
+    buffers and can leave the server printing into one."""
+    with _stdout_guard:
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+        router = sys.stdout
+    previous = getattr(router.local, 'buffer', None)
+    router.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        router.local.buffer = previous
+
+
+class InProcessREPLTool(PythonAstREPLTool):
+    """The agent's python_repl_ast tool in the web process, run like _run_code."""
+
+    def _run(self, query, run_manager=None):
+        try:
+            if self.sanitize_input:
+                query = sanitize_input(query)
+            tree = ast.parse(query)
+            buffer = io.StringIO()
+            with capture_stdout(buffer):
+                exec(ast.unparse(ast.Module(tree.body[:-1], type_ignores=[])), self.globals, self.locals)
+                last = ast.unparse(ast.Module(tree.body[-1:], type_ignores=[]))
+                try:
+                    result = eval(last, self.globals, self.locals)
+                except SyntaxError:
+                    result = None
+                    exec(last, self.globals, self.locals)
+            output = buffer.getvalue()
+            return output + str(result) if result is not None else output
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+
+def in_process_csv_agent(llm, csv_path, **kwargs):
+    """create_csv_agent with its python tool swapped for InProcessREPLTool."""
+    agent = create_csv_agent(llm, csv_path, allow_dangerous_code=True, **kwargs)
+    agent.tools = [InProcessREPLTool(globals=tool.globals, locals=tool.locals) for tool in agent.tools]
+    return agent
+
+
+if __name__ == '__main__':
+    _zygote_main(int(sys.argv[1]))
@@ -0,0 +1,110 @@
+"""Deterministic local stand-ins for Gemini and the HuggingFace embeddings.
+
+Selected with MODEL_BACKEND=stub (see app.py), so the app starts without a
+GOOGLE_API_KEY or a model download. Latency is configurable to mimic the
+real services in load tests (loadtest.py):
+
+    STUB_LLM_LATENCY_MS    per chat-model call (default 50)
+    STUB_EMBED_LATENCY_MS  per embedding call (default 5)
+    STUB_LLM_ERROR_RATE    fraction of chat calls failing with a 429 (default 0)
+"""
+import os
+import re
+import time
+import random
+import hashlib
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+EMBEDDING_DIM = 384  # same as all-MiniLM-L6-v2
+
+
+def _digest(text):
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _message_text(message):
+    content = message.content
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') if isinstance(part, dict) else str(part) for part in content)
+    return content
+
+
+# Tool calls the stub agent makes before answering when the prompt carries no
+# precomputed dataset context, mirroring how Gemini first explores the frame
+DISCOVERY_STEPS = ['df.columns.tolist()', 'df.describe()']
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model that answers from a hash of the prompt.
+
+    As a CSV agent it runs real discovery tool calls (DISCOVERY_STEPS) before
+    answering, unless the prompt already has a DATASET CONTEXT block.
+    """
+
+    latency_ms: float = float(os.environ.get('STUB_LLM_LATENCY_MS', '50'))
+    error_rate: float = float(os.environ.get('STUB_LLM_ERROR_RATE', '0'))
+
+    @property
+    def _llm_type(self):
+        return 'stub-chat'
+
+    def _reply(self, prompt):
+        # Text after "Begin!" is the agent's question and scratchpad; the format
+        # instructions before it also mention "Observation:".
+        scratchpad = prompt.split('Begin!')[-1]
+        steps_done = scratchpad.count('Observation:')
+        if 'python_repl_ast' in prompt and 'DATASET CONTEXT' not in prompt and steps_done < len(DISCOVERY_STEPS):
+            return ("Thought: I need to understand the data first.\nAction: python_repl_ast\n"
+                    f"Action Input: {DISCOVERY_STEPS[steps_done]}")
+        seed = _digest(prompt)
+        return (
+            "Final Answer:\n"
+            f"- Total across the period: {seed % 100000:,}\n"
+            f"- Change versus the previous period: {(seed % 400) / 10 - 20:.1f}%\n"
+            "- Review cost lines that grew faster than revenue."
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("429 Resource has been exhausted (stub rate limit)")
+        prompt = '\n'.join(_message_text(m) for m in messages)
+        text = self._reply(prompt)
+        input_tokens, output_tokens = len(prompt) // 4, len(text) // 4
+        message = AIMessage(content=text, usage_metadata={
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class StubEmbeddings(Embeddings):
+    """Feature-hashed bag-of-words vectors: deterministic, and texts sharing
+    words still land near each other, so FAISS retrieval behaves sensibly."""
+
+    def __init__(self, latency_ms=None, dim=EMBEDDING_DIM):
+        self.latency_ms = float(os.environ.get('STUB_EMBED_LATENCY_MS', '5')) if latency_ms is None else latency_ms
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            h = _digest(word)
+            vector[h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
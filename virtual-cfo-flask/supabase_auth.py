@@ -0,0 +1,119 @@
+"""Caller identity from Supabase access tokens.
+
+Routes that read or write a user's rows over a direct database connection
+bypass Supabase row-level security, so they take the user from a verified
+access token (Authorization: Bearer <token>, the frontend's session token),
+never from a user_id the client sends.
+
+    SUPABASE_JWT_SECRET   project JWT secret; HS256 tokens are verified locally
+    SUPABASE_URL          without a secret, tokens are checked with the project's
+    SUPABASE_ANON_KEY     Auth server (GET /auth/v1/user); results are cached
+                          until the token expires, at most AUTH_CACHE_SECONDS
+"""
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+
+AUDIENCE = 'authenticated'
+AUTH_CACHE_SECONDS = 60
+LEEWAY_SECONDS = 30
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class AuthError(ValueError):
+    pass
+
+
+def bearer_token(headers):
+    value = headers.get('Authorization') or ''
+    scheme, _, token = value.partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+
+def _b64decode(part):
+    return base64.urlsafe_b64decode(part + '=' * (-len(part) % 4))
+
+
+def _claims(token):
+    try:
+        header, payload, signature = token.split('.')
+        return json.loads(_b64decode(header)), json.loads(_b64decode(payload)), header, payload, signature
+    except Exception:
+        raise AuthError("Malformed access token.")
+
+
+def _check_claims(claims):
+    now = time.time()
+    if not isinstance(claims.get('exp'), (int, float)) or claims['exp'] < now - LEEWAY_SECONDS:
+        raise AuthError("Access token has expired.")
+    audience = claims.get('aud')
+    if AUDIENCE not in (audience if isinstance(audience, list) else [audience]):
+        raise AuthError("Access token is not for a signed-in user.")
+    if not claims.get('sub'):
+        raise AuthError("Access token has no subject.")
+
+
+def _settings():
+    # Read per call: app.py loads .env after importing its modules
+    return (os.environ.get('SUPABASE_JWT_SECRET'),
+            (os.environ.get('SUPABASE_URL') or os.environ.get('VITE_SUPABASE_URL') or '').rstrip('/'),
+            os.environ.get('SUPABASE_ANON_KEY') or os.environ.get('VITE_SUPABASE_PUBLISHABLE_KEY'))
+
+
+def _verify_locally(token, secret):
+    header, claims, raw_header, raw_payload, signature = _claims(token)
+    if header.get('alg') != 'HS256':
+        raise AuthError(f"Unsupported access token algorithm '{header.get('alg')}'.")
+    expected = hmac.new(secret.encode(), f"{raw_header}.{raw_payload}".encode(), hashlib.sha256).digest()
+    try:
+        valid = hmac.compare_digest(expected, _b64decode(signature))
+    except Exception:
+        valid = False
+    if not valid:
+        raise AuthError("Invalid access token signature.")
+    _check_claims(claims)
+    return claims['sub'], claims['exp']
+
+
+def _verify_remotely(token, url, anon_key):
+    _, claims, *_ = _claims(token)
+    _check_claims(claims)
+    key = hashlib.sha256(token.encode()).hexdigest()
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit and hit[1] > time.time():
+        return hit[0], claims['exp']
+
+    request = urllib.request.Request(f"{url}/auth/v1/user",
+                                     headers={'Authorization': f"Bearer {token}", 'apikey': anon_key})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            user = json.load(response)
+    except urllib.error.HTTPError as e:
+        raise AuthError("Access token was rejected." if e.code in (401, 403) else f"Auth server error {e.code}.")
+    if user.get('id') != claims['sub']:
+        raise AuthError("Access token was rejected.")
+    with _cache_lock:
+        now = time.time()
+        for stale in [k for k, (_, until) in _cache.items() if until <= now]:
+            del _cache[stale]
+        _cache[key] = (user['id'], min(claims['exp'], now + AUTH_CACHE_SECONDS))
+    return user['id'], claims['exp']
+
+
+def verify_token(token):
+    """(user id, expiry timestamp) for a valid Supabase access token; raises AuthError."""
+    secret, url, anon_key = _settings()
+    if secret:
+        return _verify_locally(token, secret)
+    if url and anon_key:
+        return _verify_remotely(token, url, anon_key)
+    raise AuthError("Sign-in is not configured on the server (set SUPABASE_JWT_SECRET or SUPABASE_URL).")
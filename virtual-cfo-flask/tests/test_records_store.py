@@ -0,0 +1,103 @@
+import os
+import uuid
+
+import pandas as pd
+import pytest
+
+import records_store
+from records_store import map_columns, _date_format, _parse_dates, _daily_chunk
+
+
+def test_map_columns():
+    header = ['Date', 'Amazon_Sales', 'Revenue', 'Gross Sales', 'Total Orders', 'Profit', 'Notes']
+    assert map_columns(header, 'Date') == {
+        'Date': 'date',
+        'Amazon_Sales': 'amazon_sales',
+        'Revenue': 'gross_sales',          # alias; the later Gross Sales column is not mapped twice
+        'Total Orders': 'total_orders',
+        'Profit': 'net_profit_loss',
+    }
+
+
+def test_date_format_prefers_day_first_when_it_parses_more():
+    assert _date_format(pd.Series(['01/02/2024', '13/02/2024', '28/02/2024'])) == '%d/%m/%Y'
+    assert _date_format(pd.Series(['2024-02-01', '2024-02-13'])) == '%Y-%m-%d'
+
+
+def test_parse_dates_falls_back_per_value_on_mixed_formats():
+    values = pd.Series(['01/02/2024', '2024-03-15', '15 March 2024', '', 'not a date'])
+    parsed, individually = _parse_dates(values, '%d/%m/%Y')
+    assert parsed.dt.strftime('%Y-%m-%d').tolist()[:3] == ['2024-02-01', '2024-03-15', '2024-03-15']
+    assert parsed.iloc[3:].isna().all()
+    assert individually == 2
+
+
+def test_daily_chunk_combines_rows_sharing_a_day():
+    chunk = pd.DataFrame({
+        'Date': ['2024-01-01', '2024-01-01', '2024-01-02', 'bad'],
+        'Revenue': [100.0, 50.0, 10.0, 1.0],
+        'Average_Order_Value': [50.0, 50.0, None, 1.0],
+        'Profitability_Label': ['Low', None, 'High', 'x'],
+    })
+    mapping = map_columns(chunk.columns, 'Date')
+    numeric = ['gross_sales', 'average_order_value']
+    daily, undated, individually = _daily_chunk(chunk, mapping, '%Y-%m-%d', numeric, ['profitability_label'], 0)
+    assert undated == 1
+    assert individually == 0
+    assert daily.index.tolist() == ['2024-01-01', '2024-01-02']
+    first = daily.loc['2024-01-01']
+    assert first['gross_sales'] == 150.0
+    # Ratios are summed with a count here and resolved in SQL, never stored summed
+    assert (first['average_order_value'], first['average_order_value_rows']) == (100.0, 2)
+    assert first['profitability_label'] == 'Low'
+    assert first['seq'] == 1
+    assert daily.loc['2024-01-02', 'average_order_value_rows'] == 0
+
+
+@pytest.fixture
+def records_user():
+    """A throwaway auth user in the RECORDS_DB_URL database (with the supabase
+    migrations applied); its records are removed with it."""
+    if not os.environ.get('RECORDS_DB_URL') or records_store.psycopg2 is None:
+        pytest.skip("RECORDS_DB_URL is not set")
+    user_id = str(uuid.uuid4())
+    with records_store.connection() as conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO auth.users (id) VALUES (%s)", (user_id,))
+    yield user_id
+    with records_store.connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM auth.users WHERE id = %s", (user_id,))
+
+
+def test_upsert_and_keyset_round_trip(records_user, tmp_path):
+    # Day-first, and 13/01 onwards can only be read that way
+    days = pd.date_range('2024-01-10', periods=7).strftime('%d/%m/%Y').tolist()
+    csv_path = tmp_path / 'daily.csv'
+    pd.DataFrame({
+        'Date': days + [days[0]],
+        'Gross_Sales': [100.0] * 7 + [50.0],
+        'Total_Orders': [2] * 7 + [1],
+        'Average_Order_Value': [50.0] * 8,
+        'Profitability_Label': ['Low'] * 7 + ['High'],
+    }).to_csv(csv_path, index=False)
+
+    first = records_store.load_csv(csv_path, records_user, 'Date', batch_rows=3)
+    assert (first['rows_read'], first['days'], first['inserted'], first['updated']) == (8, 7, 7, 0)
+    again = records_store.load_csv(csv_path, records_user, 'Date')
+    assert (again['inserted'], again['updated']) == (0, 7)
+
+    pages = list(records_store.iter_pages(records_user, page_size=3,
+                                          columns=['gross_sales', 'total_orders', 'average_order_value',
+                                                   'profitability_label']))
+    assert [len(page) for page in pages] == [3, 3, 1]
+    frame = pd.concat(pages, ignore_index=True)
+    assert [d.isoformat() for d in frame['date']] == pd.date_range('2024-01-10', periods=7).strftime('%Y-%m-%d').tolist()
+    day_one = frame.iloc[0]
+    # Re-loading overwrote rather than added; the ratio comes from the summed parts
+    assert (day_one['gross_sales'], day_one['total_orders']) == (150.0, 3)
+    assert day_one['average_order_value'] == 50.0
+    assert day_one['profitability_label'] == 'High'
+    assert frame['gross_sales'].iloc[1:].eq(100.0).all()
+
+    window, next_after = records_store.fetch_page(records_user, after='2024-01-14', limit=10)
+    assert [d.isoformat() for d in window['date']] == ['2024-01-15', '2024-01-16']
+    assert next_after is None
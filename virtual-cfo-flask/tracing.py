@@ -0,0 +1,253 @@
+"""Per-request tracing: stage spans, LLM token/iteration counts and Prometheus metrics.
+
+Each request gets a trace (a context variable) that collects how long every
+stage took -- CSV parsing, column detection, FAISS retrieval, Gemini calls,
+agent tool runs, savefig... The same timings feed process-wide histograms that
+/metrics renders in the Prometheus text format.
+"""
+import os
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+except Exception:
+    BaseCallbackHandler = None
+
+# Seconds; wide enough for both pandas stages (ms) and agent runs (minutes).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Add the X-Timing header to every response, not only to requests asking for it.
+TIMING_HEADER_ALWAYS = os.environ.get('TIMING_HEADER', '0') == '1'
+
+_current = contextvars.ContextVar('trace', default=None)
+_lock = threading.Lock()
+_histograms = {}   # (metric, labels) -> {'buckets', 'counts', 'sum', 'count'}
+_counters = {}     # (metric, labels) -> value
+
+HELP = {
+    'cfo_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint.'),
+    'cfo_stage_duration_seconds': ('histogram', 'Latency of one processing stage.'),
+    'cfo_agent_iterations': ('histogram', 'Agent iterations (tool calls) per agent run.'),
+    'cfo_llm_calls_total': ('counter', 'LLM calls made.'),
+    'cfo_llm_tokens_total': ('counter', 'LLM tokens used, by direction.'),
+    'cfo_agent_iterations_total': ('counter', 'Agent iterations (tool calls) across all runs.'),
+    'cfo_llm_coalesced_total': ('counter', 'LLM calls answered by an identical in-flight call.'),
+    'cfo_llm_retries_total': ('counter', 'LLM calls retried after a retryable provider error.'),
+    'cfo_llm_rejected_total': ('counter', 'LLM calls rejected by the gateway, by reason.'),
+    'cfo_sandbox_runs_total': ('counter', 'Agent code runs executed in sandbox workers.'),
+    'cfo_sandbox_restarts_total': ('counter', 'Sandbox workers replaced, by reason.'),
+}
+ITERATION_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 30)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(metric, value, buckets=BUCKETS, **labels):
+    key = (metric, _labels(labels))
+    with _lock:
+        state = _histograms.get(key)
+        if state is None:
+            state = _histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state['counts'][i] += 1
+        state['sum'] += value
+        state['count'] += 1
+
+
+def incr(metric, value=1, **labels):
+    """Add to a process-wide counter and to the current trace, if any."""
+    key = (metric, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    trace = _current.get()
+    if trace is not None:
+        name = metric if not labels else f"{metric}_{'_'.join(str(v) for _, v in _labels(labels))}"
+        trace['counters'][name] = trace['counters'].get(name, 0) + value
+
+
+# --- Traces and spans ---
+def start_trace():
+    """Begin collecting spans for the current request; returns a reset token."""
+    return _current.set({'started': time.perf_counter(), 'stages': {}, 'counters': {}})
+
+
+def end_trace(token):
+    _current.reset(token)
+
+
+def current_trace():
+    return _current.get()
+
+
+def record(stage, seconds, trace=None):
+    """Record a finished stage in the histograms and in the (given or current) trace."""
+    observe('cfo_stage_duration_seconds', seconds, stage=stage)
+    trace = trace if trace is not None else _current.get()
+    if trace is not None:
+        total, calls = trace['stages'].get(stage, (0.0, 0))
+        trace['stages'][stage] = (total + seconds, calls + 1)
+
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def traced(stage):
+    """Decorator form of span()."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def timing_header(trace):
+    """Server-Timing style breakdown: 'stage;dur=<ms>;n=<calls>, ..., total;dur=<ms>'."""
+    parts = [f"{stage};dur={seconds * 1000:.1f};n={calls}" for stage, (seconds, calls) in trace['stages'].items()]
+    parts += [f"{name};n={value}" for name, value in trace['counters'].items()]
+    parts.append(f"total;dur={(time.perf_counter() - trace['started']) * 1000:.1f}")
+    return ', '.join(parts)
+
+
+# --- LangChain callbacks (Gemini calls, FAISS retrieval, agent iterations) ---
+if BaseCallbackHandler is not None:
+    class TracingCallbackHandler(BaseCallbackHandler):
+        """Times LLM, retriever and tool runs and counts tokens and agent steps.
+
+        LangChain may fire callbacks from another thread, so the trace is
+        captured when the handler is created.
+        """
+
+        def __init__(self):
+            self.trace = _current.get()
+            self.iterations = 0
+            self._started = {}
+
+        def _start(self, run_id):
+            self._started[run_id] = time.perf_counter()
+
+        def _end(self, run_id, stage):
+            started = self._started.pop(run_id, None)
+            if started is not None:
+                record(stage, time.perf_counter() - started, self.trace)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            self._end(run_id, 'llm')
+            _count_llm_call(response, self.trace)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, 'llm')
+
+        def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_retriever_end(self, documents, *, run_id, **kwargs):
+            self._end(run_id, 'faiss_retrieval')
+
+        def on_retriever_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, 'faiss_retrieval')
+
+        def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_tool_end(self, output, *, run_id, **kwargs):
+            self._end(run_id, 'agent_tool')
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, 'agent_tool')
+
+        def on_agent_action(self, action, **kwargs):
+            self.iterations += 1
+            _incr_in(self.trace, 'cfo_agent_iterations_total')
+
+        def on_agent_finish(self, finish, **kwargs):
+            observe('cfo_agent_iterations', self.iterations, buckets=ITERATION_BUCKETS)
+else:
+    TracingCallbackHandler = None
+
+
+def _incr_in(trace, metric, value=1, **labels):
+    token = _current.set(trace)
+    try:
+        incr(metric, value, **labels)
+    finally:
+        _current.reset(token)
+
+
+def _count_llm_call(response, trace):
+    _incr_in(trace, 'cfo_llm_calls_total')
+    input_tokens = output_tokens = 0
+    for generations in getattr(response, 'generations', []):
+        for generation in generations:
+            usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+            input_tokens += usage.get('input_tokens', 0)
+            output_tokens += usage.get('output_tokens', 0)
+    if input_tokens:
+        _incr_in(trace, 'cfo_llm_tokens_total', input_tokens, direction='input')
+    if output_tokens:
+        _incr_in(trace, 'cfo_llm_tokens_total', output_tokens, direction='output')
+
+
+def llm_config():
+    """RunnableConfig that reports a chain/agent invocation to the current trace."""
+    if TracingCallbackHandler is None:
+        return {}
+    return {'callbacks': [TracingCallbackHandler()]}
+
+
+# --- Prometheus exposition ---
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        histograms = {k: {**v, 'counts': list(v['counts'])} for k, v in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for metric, (kind, text) in HELP.items():
+        series = histograms if kind == 'histogram' else counters
+        keys = sorted(k for k in series if k[0] == metric)
+        if not keys:
+            continue
+        lines.append(f"# HELP {metric} {text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for key in keys:
+            labels = key[1]
+            if kind == 'counter':
+                lines.append(f"{metric}{_format_labels(labels)} {series[key]}")
+                continue
+            state = series[key]
+            for bound, count in zip(state['buckets'], state['counts']):
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {state['sum']}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {state['count']}")
+    return '\n'.join(lines) + '\n'